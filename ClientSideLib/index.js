@@ -27,9 +27,20 @@ function Page()
     this.directAppLinkProtocol = 'http-image-jpeg://';
     this.photoFolder           = 'photo';
     this.thumnailFolder        = 'thumb';
+    this.renditionFolder       = 'render';
+    this.thumbnailWidth        = 600;
+    this.thumbnailDisplayWidth = 300;
+    this.renditionWidthList    = [];
+    this.pendingImageList      = [];
+    this.failedImageList       = [];
     this.dataURI               = 'data.json';
+    this.eventsURI             = 'events';
     this.imageList             = [];
     this.imageCounter          = 0;
+    this.imageRevision         = 0;
+    this.oldestImageCounter    = 0;
+    this.pageSize              = 100;
+    this.isLoadingOlderImages  = false;
     this.isCameraConnected     = false;
     this.isNetworkConnected    = false;
     this.isOptionMenuOpen      = false;
@@ -454,6 +465,16 @@ function Page()
 
     this.handleLinkClicked = function(a)
     {
+        if ($(a).hasClass('OriginalPending'))
+        {
+            // The picture is still being downloaded from the camera
+            return false;
+        }
+        if ($(a).hasClass('OriginalFailed'))
+        {
+            // The picture could not be downloaded from the camera
+            return false;
+        }
         if (!($(a).hasClass('Downloaded')))
         {
             $(a).addClass('Downloaded');
@@ -487,10 +508,319 @@ function Page()
          $('#ToastMessage').html('');
     }
 
+    this.updateNetworkState = function(isNetworkConnected)
+    {
+        if (this.isNetworkConnected != isNetworkConnected)
+        {
+            if (isNetworkConnected == true)
+            {
+                $('#StateValue_NetworkState_Connected').removeClass('HiddenValue');
+                $('#StateValue_NetworkState_Disconnected').addClass('HiddenValue');
+            }
+            else
+            {
+                $('#StateValue_NetworkState_Connected').addClass('HiddenValue');
+                $('#StateValue_NetworkState_Disconnected').removeClass('HiddenValue');
+            }
+        }
+        this.isNetworkConnected = isNetworkConnected;
+    }
+
+    this.updateCameraState = function(isCameraConnected)
+    {
+        if (this.isCameraConnected != isCameraConnected)
+        {
+            this.isCameraConnected = isCameraConnected;
+            if (this.isCameraConnected == true)
+            {
+                $('#StateValue_CameraState_Connected').removeClass('HiddenValue');
+                $('#StateValue_CameraState_Disconnected').addClass('HiddenValue');
+            }
+            else
+            {
+                $('#StateValue_CameraState_Connected').addClass('HiddenValue');
+                $('#StateValue_CameraState_Disconnected').removeClass('HiddenValue');
+            }
+        }
+    }
+
+    this.loadListOfDownloadedJpegFiles = function()
+    {
+        listOfDownloadedJpegFiles = null;
+        if(typeof(Storage) != 'undefined')
+        {
+            listOfDownloadedJpegFiles = JSON.parse(localStorage.getItem('ListOfDownloadedJpegFiles'));
+        }
+        return listOfDownloadedJpegFiles;
+    }
+
+    this.createThumbnailFrame = function(imageName, listOfDownloadedJpegFiles)
+    {
+        var context = this;
+        uniquePictureId = '_IMG_' + imageName;
+        frameDiv = $('<div>', { 'class': 'ThumbnailFrame' });
+        thumbDiv = $('<div>', { 'class': 'Thumbnail' });
+        link = "";
+        if  (this.optionUseDirectAppLinks == true)
+        {
+            link = this.directAppLinkProtocol + window.location.hostname + ':' + window.location.port + '/' + this.photoFolder + '/' + imageName;
+        }
+        else
+        {
+            link = window.location.protocol + '//' + window.location.hostname + ':' + window.location.port + '/' + this.photoFolder + '/' + imageName;
+        }
+        a = $('<a>',
+        {
+            'id' : uniquePictureId,
+            'class': 'Thumbnail Minimized',
+            'href': link
+        });
+        a.click(function(){ return context.handleLinkClicked(this); });
+        if ($.inArray(imageName, this.pendingImageList) > -1)
+        {
+            $(a).addClass('OriginalPending');
+        }
+        if ($.inArray(imageName, this.failedImageList) > -1)
+        {
+            $(a).addClass('OriginalFailed');
+        }
+        thumbnailSource = this.thumnailFolder + '/' + imageName;
+        img = $('<img>',
+        {
+            'class' : 'Thumbnail',
+            'src'   : thumbnailSource,
+            'srcset': this.createSourceSet(imageName, thumbnailSource),
+            'sizes' : this.thumbnailDisplayWidth + 'px',
+            'alt'   : imageName
+        });
+        txt = $('<div class="ThumbnailText">' + imageName + '</div>');
+        $(a).append(img);
+        $(a).append(txt);
+        $(thumbDiv).append(a);
+        $(frameDiv).append(thumbDiv);
+        if(listOfDownloadedJpegFiles != null)
+        {
+            found = ($.inArray(uniquePictureId, listOfDownloadedJpegFiles) > -1);
+            if (found == true)
+            {
+                $(a).addClass('Downloaded');
+            }
+        }
+        return frameDiv;
+    }
+
+    this.createSourceSet = function(imageName, thumbnailSource)
+    {
+        // High density screens pick a rendition, if the thumbnail is too small for them
+        sourceSet = thumbnailSource + ' ' + this.thumbnailWidth + 'w';
+        if (($.inArray(imageName, this.pendingImageList) > -1) || ($.inArray(imageName, this.failedImageList) > -1))
+        {
+            // Renditions are made from the original, the arrival of the original is sent as update
+            return sourceSet;
+        }
+        for (widthIndex in this.renditionWidthList)
+        {
+            width = this.renditionWidthList[widthIndex];
+            if (width > this.thumbnailWidth)
+            {
+                sourceSet += ', ' + this.renditionFolder + '/' + width + '/' + imageName + ' ' + width + 'w';
+            }
+        }
+        return sourceSet;
+    }
+
+    this.addImages = function(imageCounter, imageList)
+    {
+        if (imageCounter > this.imageCounter)
+        {
+            listOfDownloadedJpegFiles = this.loadListOfDownloadedJpegFiles();
+            // Update images
+            this.imageCounter = imageCounter;
+            reversedList = imageList;
+            reversedList.reverse();
+            for (imageIndex in reversedList)
+            {
+                imageName = imageList[imageIndex];
+                this.imageList.push(imageName);
+                $('#ThumbnailList').append(this.createThumbnailFrame(imageName, listOfDownloadedJpegFiles));
+            }
+            setTimeout(function(){$('a.Minimized').removeClass('Minimized');}, 10);
+            if (this.optionAutomaticScrolling == true)
+            {
+                setTimeout(function(){$('html, body').animate({scrollTop: ($('html, body').height() - $(window).height()) }, 750);}, 250);
+            }
+        }
+    }
+
+    this.updateImages = function(imageRevision, updatedImageList)
+    {
+        if (imageRevision > this.imageRevision)
+        {
+            this.imageRevision = imageRevision;
+            // Replace provisional thumbnails, the revision bypasses the browser cache
+            for (imageIndex in updatedImageList)
+            {
+                imageName = updatedImageList[imageIndex];
+                thumbnailSource = this.thumnailFolder + '/' + imageName + '?revision=' + imageRevision;
+                $(document.getElementById('_IMG_' + imageName)).find('img.Thumbnail').attr(
+                {
+                    'src'   : thumbnailSource,
+                    'srcset': this.createSourceSet(imageName, thumbnailSource)
+                });
+            }
+        }
+    }
+
+    this.updatePendingImages = function(pendingImageList, failedImageList)
+    {
+        for (imageIndex in this.pendingImageList)
+        {
+            $(document.getElementById('_IMG_' + this.pendingImageList[imageIndex])).removeClass('OriginalPending');
+        }
+        for (imageIndex in pendingImageList)
+        {
+            $(document.getElementById('_IMG_' + pendingImageList[imageIndex])).addClass('OriginalPending');
+        }
+        this.pendingImageList = pendingImageList;
+        // A failed original stays failed, the list only grows
+        for (imageIndex in failedImageList)
+        {
+            $(document.getElementById('_IMG_' + failedImageList[imageIndex])).addClass('OriginalFailed');
+        }
+        this.failedImageList = failedImageList;
+    }
+
+    this.insertOlderImages = function(imageList)
+    {
+        listOfDownloadedJpegFiles = this.loadListOfDownloadedJpegFiles();
+        // Keep the visible pictures in place while the page grows above them
+        documentHeight = $(document).height();
+        for (imageIndex in imageList)
+        {
+            imageName = imageList[imageIndex];
+            this.imageList.unshift(imageName);
+            $('#ThumbnailList').prepend(this.createThumbnailFrame(imageName, listOfDownloadedJpegFiles));
+        }
+        $(window).scrollTop($(window).scrollTop() + $(document).height() - documentHeight);
+        setTimeout(function(){$('a.Minimized').removeClass('Minimized');}, 10);
+    }
+
+    this.loadFirstPage = function()
+    {
+        // Start with the newest pictures only, older ones are loaded on scrolling
+        $.ajax({
+            url: (this.dataURI + '?count=0&limit=' + this.pageSize),
+            context: this,
+            success:function(data, status, request)
+            {
+                this.updateNetworkState(true);
+                this.updateCameraState(data['isCameraConnected'] == 1);
+                this.renditionWidthList = data['renditionWidthList'];
+                this.updatePendingImages(data['pendingImageList'], data['failedImageList']);
+                this.addImages(data['imageCounter'], data['imageList']);
+                this.imageRevision = data['imageRevision'];
+                if (data['oldestImageCounter'] != null)
+                {
+                    this.oldestImageCounter = data['oldestImageCounter'];
+                }
+                var context = this;
+                $(window).scroll(function(){ context.handleScrolled(); });
+                this.startContentUpdates();
+            },
+            error:function(request, result, error)
+            {
+                this.updateNetworkState(false);
+                var context = this;
+                setTimeout(function(){context.loadFirstPage();}, 5000);
+            }
+        });
+    }
+
+    this.handleScrolled = function()
+    {
+        if ((this.oldestImageCounter > 1) && (this.isLoadingOlderImages == false) && ($(window).scrollTop() < 200))
+        {
+            this.loadOlderImages();
+        }
+    }
+
+    this.loadOlderImages = function()
+    {
+        this.isLoadingOlderImages = true;
+        $.ajax({
+            url: (this.dataURI + '?before=' + this.oldestImageCounter + '&limit=' + this.pageSize),
+            context: this,
+            success:function(data, status, request)
+            {
+                this.insertOlderImages(data['imageList']);
+                if (data['oldestImageCounter'] != null)
+                {
+                    this.oldestImageCounter = data['oldestImageCounter'];
+                }
+                else
+                {
+                    this.oldestImageCounter = 0;
+                }
+                this.isLoadingOlderImages = false;
+            },
+            error:function(request, result, error)
+            {
+                this.isLoadingOlderImages = false;
+            }
+        });
+    }
+
+    this.startContentUpdates = function()
+    {
+        // Prefer a single Server-Sent Events stream over repeated long polls
+        if (typeof(EventSource) === 'undefined')
+        {
+            this.loadContent();
+            return;
+        }
+        var context = this;
+        var eventStreamHasBeenOpened = false;
+        var eventSource = new EventSource(this.eventsURI + '?count=' + this.imageCounter + '&revision=' + this.imageRevision);
+        eventSource.onopen = function(event)
+        {
+            eventStreamHasBeenOpened = true;
+            context.updateNetworkState(true);
+        }
+        eventSource.addEventListener('camera', function(event)
+        {
+            data = JSON.parse(event.data);
+            context.updateCameraState(data['isCameraConnected'] == 1);
+        });
+        eventSource.addEventListener('images', function(event)
+        {
+            data = JSON.parse(event.data);
+            context.updatePendingImages(data['pendingImageList'], data['failedImageList']);
+            context.addImages(data['imageCounter'], data['imageList']);
+        });
+        eventSource.addEventListener('updates', function(event)
+        {
+            data = JSON.parse(event.data);
+            context.updatePendingImages(data['pendingImageList'], data['failedImageList']);
+            context.updateImages(data['imageRevision'], data['updatedImageList']);
+        });
+        eventSource.onerror = function(event)
+        {
+            if (eventStreamHasBeenOpened == false)
+            {
+                // The server doesn't provide an event stream, fall back to long polling
+                eventSource.close();
+                context.loadContent();
+                return;
+            }
+            // The browser reconnects on its own and resumes with the last event id
+            context.updateNetworkState(false);
+        }
+    }
+
     this.loadContent = function()
     {
         $.ajax({
-            url: ('data.json?count=' + this.imageCounter),
+            url: (this.dataURI + '?count=' + this.imageCounter + '&revision=' + this.imageRevision),
             context: this,
             success:function(data, status, request)
             {
@@ -508,85 +838,15 @@ function Page()
                     }
                 }
                 // Update network state
-                if (this.isNetworkConnected == false)
-                {
-                    $('#StateValue_NetworkState_Connected').removeClass('HiddenValue');
-                    $('#StateValue_NetworkState_Disconnected').addClass('HiddenValue');
-                }
-                this.isNetworkConnected = true;
-
+                this.updateNetworkState(true);
                 // Upadate camera state
-                if (this.isCameraConnected != (data['isCameraConnected'] == 1))
-                {
-                    this.isCameraConnected = (data['isCameraConnected'] == 1);
-                    if (this.isCameraConnected == true)
-                    {
-                        $('#StateValue_CameraState_Connected').removeClass('HiddenValue');
-                        $('#StateValue_CameraState_Disconnected').addClass('HiddenValue');
-                    }
-                    else
-                    {
-                        $('#StateValue_CameraState_Connected').addClass('HiddenValue');
-                        $('#StateValue_CameraState_Disconnected').removeClass('HiddenValue');
-                    }
-                }
-                if (data['imageCounter'] > this.imageCounter)
-                {
-                    listOfDownloadedJpegFiles = null;
-                    if(typeof(Storage) != 'undefined')
-                    {
-                        listOfDownloadedJpegFiles = JSON.parse(localStorage.getItem('ListOfDownloadedJpegFiles'));
-                    }
-                    // Update images
-                    context = this
-                    this.imageCounter = data['imageCounter'];
-                    reversedList = data['imageList'];
-                    reversedList.reverse();
-                    for (imageIndex in reversedList)
-                    {
-                        imageName = data['imageList'][imageIndex];
-                        uniquePictureId = '_IMG_' + imageName;
-                        this.imageList.push(imageName);
-                        frameDiv = $('<div>', { 'class': 'ThumbnailFrame' });
-                        thumbDiv = $('<div>', { 'class': 'Thumbnail' });
-                        link = "";
-                        if  (this.optionUseDirectAppLinks == true)
-                        {
-                            link = this.directAppLinkProtocol + window.location.hostname + ':' + window.location.port + '/' + this.photoFolder + '/' + imageName;
-                        }
-                        else
-                        {
-                            link = window.location.protocol + '//' + window.location.hostname + ':' + window.location.port + '/' + this.photoFolder + '/' + imageName;
-                        }
-                        a = $('<a>',
-                        {
-                            'id' : uniquePictureId,
-                            'class': 'Thumbnail Minimized',
-                            'href': link
-                        });
-                        a.click(function(){ return context.handleLinkClicked(this); });
-                        img = $('<img>', { class: 'Thumbnail', src: this.thumnailFolder + '/' + imageName, alt: imageName });
-                        txt = $('<div class="ThumbnailText">' + imageName + '</div>');
-                        $(a).append(img);
-                        $(a).append(txt);
-                        $(thumbDiv).append(a);
-                        $(frameDiv).append(thumbDiv);
-                        $('#ThumbnailList').append(frameDiv);
-                        if(listOfDownloadedJpegFiles != null)
-                        {
-                            found = ($.inArray(uniquePictureId, listOfDownloadedJpegFiles) > -1);
-                            if (found == true)
-                            {
-                                $(a).addClass('Downloaded');
-                            }
-                        }
-                    }
-                    setTimeout(function(){$('a.Minimized').removeClass('Minimized');}, 10);
-                    if (this.optionAutomaticScrolling == true)
-                    {
-                        setTimeout(function(){$('html, body').animate({scrollTop: ($('html, body').height() - $(window).height()) }, 750);}, 250);
-                    }
-                }
+                this.updateCameraState(data['isCameraConnected'] == 1);
+                // Pending originals first, the source sets of new and updated thumbnails depend on them
+                this.updatePendingImages(data['pendingImageList'], data['failedImageList']);
+                // Update images
+                this.addImages(data['imageCounter'], data['imageList']);
+                // Replace updated thumbnails
+                this.updateImages(data['imageRevision'], data['updatedImageList']);
                 // Start next update interval with 100ms
                 var context = this;
                 setTimeout(function(){context.loadContent();}, 100);
@@ -594,12 +854,7 @@ function Page()
             error:function(request, result, error)
             {
                 // Update network state
-                if (this.isNetworkConnected == true)
-                {
-                    $('#StateValue_NetworkState_Connected').addClass('HiddenValue');
-                    $('#StateValue_NetworkState_Disconnected').removeClass('HiddenValue');
-                }
-                this.isNetworkConnected = false;
+                this.updateNetworkState(false);
                 // Start next update interval with 5s
                 var context = this;
                 setTimeout(function(){context.loadContent();}, 5000);
@@ -613,5 +868,5 @@ $(document).ready(function()
 {
     page = new Page();
     page.init();
-    page.loadContent();
+    page.loadFirstPage();
 });
@@ -44,6 +44,23 @@ import threading
 import multiprocessing
 import Queue
 import httplib
+import email.utils
+import select
+import socket
+import errno
+import StringIO
+import mimetools
+import json
+import heapq
+import collections
+import tempfile
+import struct
+import hashlib
+import zlib
+import atexit
+import math
+import mmap
+import ctypes
 
 
 try:
@@ -52,38 +69,478 @@ except ImportError:
     NetworkManager = None
     pass
 
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+        pass
+
 # Global constants
 
 NOTIFY_IMAGELIST_UPDATE = 'NOTIFY_IMAGELIST_UPDATE'
 
 
+class EmbeddedPreviewReader:
+    """
+    Reads the preview images cameras embed in their files without decoding
+    the picture. JPEG files carry a small thumbnail in the IFD1 of their
+    EXIF segment, which is returned as JPEG data by read_exif_thumbnail().
+    TIFF based RAW files and RAF files carry a large JPEG preview, which
+    is returned by read_raw_preview() without reading the raw image data.
+    """
+
+    RAW_FILE_EXTENSIONS = ('.cr2', '.nef', '.nrw', '.arw', '.srf', '.sr2', '.dng', '.pef', '.rw2', '.srw', '.raf')
+
+    JPEG_MARKER_SOI = 0xD8
+    JPEG_MARKER_EOI = 0xD9
+    JPEG_MARKER_SOS = 0xDA
+    JPEG_MARKER_APP1 = 0xE1
+    JPEG_MARKER_SOF_BASELINE_LIST = (0xC0, 0xC1, 0xC2)
+    JPEG_HEADER_READ_SIZE = 65536
+    JPEG_TRAILER_READ_SIZE = 4096
+    EXIF_HEADER = 'Exif\x00\x00'
+    RAF_HEADER = 'FUJIFILMCCD-RAW '
+    RAF_JPEG_OFFSET_POSITION = 84
+
+    TIFF_TYPE_SHORT = 3
+    TIFF_TYPE_LONG = 4
+    TIFF_TAG_JPEG_FROM_RAW = 0x002E
+    TIFF_TAG_COMPRESSION = 0x0103
+    TIFF_TAG_STRIP_OFFSETS = 0x0111
+    TIFF_TAG_STRIP_BYTE_COUNTS = 0x0117
+    TIFF_TAG_SUB_IFDS = 0x014A
+    TIFF_TAG_JPEG_OFFSET = 0x0201
+    TIFF_TAG_JPEG_LENGTH = 0x0202
+    TIFF_COMPRESSION_OLD_JPEG = 6
+    TIFF_COMPRESSION_JPEG = 7
+
+    MAX_IFD_ENTRY_COUNT = 1024
+    MAX_IFD_COUNT = 64
+
+    @staticmethod
+    def is_raw_file(file_name):
+        return os.path.splitext(file_name)[1].lower() in EmbeddedPreviewReader.RAW_FILE_EXTENSIONS
+
+    @staticmethod
+    def read_ifd(tiff_data, ifd_offset, byte_order):
+        """
+        Parses the IFD at ifd_offset of tiff_data and returns the tuple
+        (entry_dict, next_ifd_offset). entry_dict maps the tags to the values
+        of SHORT and LONG entries with a single value, and to the tuple
+        (type, count, value_offset) for all other entries.
+        Raises struct.error, if tiff_data is truncated.
+        """
+        entry_count = struct.unpack_from(byte_order + 'H', tiff_data, ifd_offset)[0]
+        if entry_count > EmbeddedPreviewReader.MAX_IFD_ENTRY_COUNT:
+            raise struct.error('Invalid IFD entry count')
+        entry_dict = {}
+        for entry_index in range(entry_count):
+            entry_offset = ifd_offset + 2 + entry_index * 12
+            tag, value_type, count = struct.unpack_from(byte_order + 'HHI', tiff_data, entry_offset)
+            if (value_type == EmbeddedPreviewReader.TIFF_TYPE_SHORT) and (count == 1):
+                entry_dict[tag] = struct.unpack_from(byte_order + 'H', tiff_data, entry_offset + 8)[0]
+            elif (value_type == EmbeddedPreviewReader.TIFF_TYPE_LONG) and (count == 1):
+                entry_dict[tag] = struct.unpack_from(byte_order + 'I', tiff_data, entry_offset + 8)[0]
+            else:
+                value_offset = struct.unpack_from(byte_order + 'I', tiff_data, entry_offset + 8)[0]
+                entry_dict[tag] = (value_type, count, value_offset)
+        next_ifd_offset = struct.unpack_from(byte_order + 'I', tiff_data, ifd_offset + 2 + entry_count * 12)[0]
+        return entry_dict, next_ifd_offset
+
+    @staticmethod
+    def read_file_ifd(file_handler, ifd_offset, byte_order):
+        """
+        Like read_ifd(), but reads only the IFD at ifd_offset from file_handler.
+        """
+        file_handler.seek(ifd_offset)
+        count_data = file_handler.read(2)
+        entry_count = struct.unpack(byte_order + 'H', count_data)[0]
+        if entry_count > EmbeddedPreviewReader.MAX_IFD_ENTRY_COUNT:
+            raise struct.error('Invalid IFD entry count')
+        ifd_data = count_data + file_handler.read(entry_count * 12 + 4)
+        return EmbeddedPreviewReader.read_ifd(ifd_data, 0, byte_order)
+
+    @staticmethod
+    def get_byte_order(tiff_data):
+        # Panasonic RW2 files use their own magic number in a TIFF header
+        if tiff_data[0:4] in ('II*\x00', 'IIU\x00'):
+            return '<'
+        if tiff_data[0:4] == 'MM\x00*':
+            return '>'
+        raise struct.error('Invalid TIFF header')
+
+    @staticmethod
+    def get_jpeg_size(file_handler, jpeg_offset, jpeg_length):
+        """
+        Returns the tuple (width, height) of the JPEG image at jpeg_offset or
+        None, if there is no baseline or progressive JPEG image. Lossless JPEG
+        images are rejected, since RAW files use them for the raw image data.
+        """
+        file_handler.seek(jpeg_offset)
+        header_data = file_handler.read(min(jpeg_length, EmbeddedPreviewReader.JPEG_HEADER_READ_SIZE))
+        if not header_data.startswith('\xff' + chr(EmbeddedPreviewReader.JPEG_MARKER_SOI)):
+            return None
+        position = 2
+        while position + 4 <= len(header_data):
+            if header_data[position] != '\xff':
+                return None
+            marker = ord(header_data[position + 1])
+            if marker == 0xFF:
+                # Fill byte
+                position += 1
+                continue
+            if marker in EmbeddedPreviewReader.JPEG_MARKER_SOF_BASELINE_LIST:
+                if position + 9 > len(header_data):
+                    return None
+                height, width = struct.unpack('>HH', header_data[position + 5:position + 9])
+                return width, height
+            if marker == EmbeddedPreviewReader.JPEG_MARKER_SOS:
+                return None
+            position += 2 + struct.unpack('>H', header_data[position + 2:position + 4])[0]
+        return None
+
+    @staticmethod
+    def get_raw_preview_candidates(file_handler, header_data):
+        """
+        Returns the list of (offset, length) tuples of all images, which may be a
+        JPEG preview. All IFDs of the TIFF structure are visited, including SubIFDs.
+        """
+        if header_data.startswith(EmbeddedPreviewReader.RAF_HEADER):
+            file_handler.seek(EmbeddedPreviewReader.RAF_JPEG_OFFSET_POSITION)
+            return [struct.unpack('>II', file_handler.read(8))]
+        byte_order = EmbeddedPreviewReader.get_byte_order(header_data)
+        candidate_list = []
+        ifd_offset_list = [struct.unpack_from(byte_order + 'I', header_data, 4)[0]]
+        visited_ifd_offset_set = set()
+        while (len(ifd_offset_list) > 0) and (len(visited_ifd_offset_set) < EmbeddedPreviewReader.MAX_IFD_COUNT):
+            ifd_offset = ifd_offset_list.pop(0)
+            if (ifd_offset == 0) or (ifd_offset in visited_ifd_offset_set):
+                continue
+            visited_ifd_offset_set.add(ifd_offset)
+            entry_dict, next_ifd_offset = EmbeddedPreviewReader.read_file_ifd(file_handler, ifd_offset, byte_order)
+            ifd_offset_list.append(next_ifd_offset)
+            sub_ifds = entry_dict.get(EmbeddedPreviewReader.TIFF_TAG_SUB_IFDS)
+            if isinstance(sub_ifds, (int, long)):
+                ifd_offset_list.append(sub_ifds)
+            elif isinstance(sub_ifds, tuple) and (sub_ifds[1] <= EmbeddedPreviewReader.MAX_IFD_COUNT):
+                file_handler.seek(sub_ifds[2])
+                sub_ifd_data = file_handler.read(sub_ifds[1] * 4)
+                ifd_offset_list.extend(struct.unpack(byte_order + 'I' * sub_ifds[1], sub_ifd_data))
+            jpeg_offset = entry_dict.get(EmbeddedPreviewReader.TIFF_TAG_JPEG_OFFSET)
+            jpeg_length = entry_dict.get(EmbeddedPreviewReader.TIFF_TAG_JPEG_LENGTH)
+            if isinstance(jpeg_offset, (int, long)) and isinstance(jpeg_length, (int, long)):
+                candidate_list.append((jpeg_offset, jpeg_length))
+            compression = entry_dict.get(EmbeddedPreviewReader.TIFF_TAG_COMPRESSION)
+            strip_offset = entry_dict.get(EmbeddedPreviewReader.TIFF_TAG_STRIP_OFFSETS)
+            strip_length = entry_dict.get(EmbeddedPreviewReader.TIFF_TAG_STRIP_BYTE_COUNTS)
+            if (compression in (EmbeddedPreviewReader.TIFF_COMPRESSION_OLD_JPEG,
+                                EmbeddedPreviewReader.TIFF_COMPRESSION_JPEG)) and \
+                    isinstance(strip_offset, (int, long)) and isinstance(strip_length, (int, long)):
+                candidate_list.append((strip_offset, strip_length))
+            jpeg_from_raw = entry_dict.get(EmbeddedPreviewReader.TIFF_TAG_JPEG_FROM_RAW)
+            if isinstance(jpeg_from_raw, tuple):
+                candidate_list.append((jpeg_from_raw[2], jpeg_from_raw[1]))
+        return candidate_list
+
+    @staticmethod
+    def read_raw_preview(raw_path):
+        """
+        Returns the JPEG data of the largest preview embedded in the
+        RAW file at raw_path or None.
+        """
+        try:
+            with open(raw_path, 'rb') as file_handler:
+                header_data = file_handler.read(16)
+                best_candidate = None
+                best_pixel_count = 0
+                for jpeg_offset, jpeg_length in EmbeddedPreviewReader.get_raw_preview_candidates(file_handler,
+                                                                                                 header_data):
+                    jpeg_size = EmbeddedPreviewReader.get_jpeg_size(file_handler, jpeg_offset, jpeg_length)
+                    if (jpeg_size is not None) and (jpeg_size[0] * jpeg_size[1] > best_pixel_count):
+                        best_candidate = jpeg_offset, jpeg_length
+                        best_pixel_count = jpeg_size[0] * jpeg_size[1]
+                if best_candidate is None:
+                    return None
+                file_handler.seek(best_candidate[0])
+                jpeg_data = file_handler.read(best_candidate[1])
+            if len(jpeg_data) != best_candidate[1]:
+                return None
+            return jpeg_data
+        except (IOError, struct.error):
+            return None
+
+    @staticmethod
+    def read_exif_segment(file_handler):
+        """
+        Returns the TIFF structure of the EXIF segment of a JPEG file or None.
+        Only the markers in front of the image data are read.
+        """
+        if file_handler.read(2) != '\xff' + chr(EmbeddedPreviewReader.JPEG_MARKER_SOI):
+            return None
+        while True:
+            marker_data = file_handler.read(4)
+            if (len(marker_data) < 4) or (marker_data[0] != '\xff'):
+                return None
+            marker = ord(marker_data[1])
+            length = struct.unpack('>H', marker_data[2:4])[0]
+            if (marker == EmbeddedPreviewReader.JPEG_MARKER_SOS) or (length < 2):
+                return None
+            segment_data = file_handler.read(length - 2)
+            if (marker == EmbeddedPreviewReader.JPEG_MARKER_APP1) and \
+                    segment_data.startswith(EmbeddedPreviewReader.EXIF_HEADER):
+                return segment_data[len(EmbeddedPreviewReader.EXIF_HEADER):]
+
+    @staticmethod
+    def read_exif_thumbnail(picture_file):
+        """
+        Returns the JPEG data of the thumbnail embedded in the EXIF
+        segment of the JPEG file at picture_file or None. picture_file
+        is a path or an open file object.
+        """
+        try:
+            if isinstance(picture_file, basestring):
+                with open(picture_file, 'rb') as file_handler:
+                    tiff_data = EmbeddedPreviewReader.read_exif_segment(file_handler)
+            else:
+                tiff_data = EmbeddedPreviewReader.read_exif_segment(picture_file)
+            if tiff_data is None:
+                return None
+            byte_order = EmbeddedPreviewReader.get_byte_order(tiff_data)
+            ifd0_offset = struct.unpack_from(byte_order + 'I', tiff_data, 4)[0]
+            ifd0_dict, ifd1_offset = EmbeddedPreviewReader.read_ifd(tiff_data, ifd0_offset, byte_order)
+            if ifd1_offset == 0:
+                return None
+            ifd1_dict, next_ifd_offset = EmbeddedPreviewReader.read_ifd(tiff_data, ifd1_offset, byte_order)
+            jpeg_offset = ifd1_dict.get(EmbeddedPreviewReader.TIFF_TAG_JPEG_OFFSET)
+            jpeg_length = ifd1_dict.get(EmbeddedPreviewReader.TIFF_TAG_JPEG_LENGTH)
+            if not isinstance(jpeg_offset, (int, long)) or not isinstance(jpeg_length, (int, long)):
+                return None
+            jpeg_data = tiff_data[jpeg_offset:jpeg_offset + jpeg_length]
+            if (len(jpeg_data) != jpeg_length) or not jpeg_data.startswith('\xff\xd8'):
+                return None
+            return jpeg_data
+        except (IOError, struct.error):
+            return None
+
+    @staticmethod
+    def is_complete_jpeg(file_path):
+        """
+        Returns False, if the JPEG file at file_path is missing, empty or
+        cut off, that is, it has no EOI marker close to its end. Cameras
+        may append data after the EOI marker of the picture.
+        """
+        try:
+            with open(file_path, 'rb') as file_handler:
+                if file_handler.read(2) != '\xff' + chr(EmbeddedPreviewReader.JPEG_MARKER_SOI):
+                    return False
+                file_handler.seek(0, os.SEEK_END)
+                file_handler.seek(max(file_handler.tell() - EmbeddedPreviewReader.JPEG_TRAILER_READ_SIZE, 2))
+                return '\xff' + chr(EmbeddedPreviewReader.JPEG_MARKER_EOI) in file_handler.read()
+        except IOError:
+            return False
+
+
+class SharedPictureBuffer:
+    """
+    Ring buffer in shared memory, which hands the downloaded pictures from
+    the tethering process to the thumbnail workers without writing and
+    reading them back from disk. It has to be created before these processes
+    are started, so they inherit the mapping. put() stores a picture and
+    returns its slot, or None if it doesn't fit into the free space, pictures
+    are never overwritten. The main process registers the slots it receives
+    and releases them once their thumbnails have been created.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._buffer = mmap.mmap(-1, size)
+        # Absolute positions, which grow without wrapping around
+        self._writePosition = multiprocessing.Value(ctypes.c_ulonglong, 0)
+        self._releasePosition = multiprocessing.Value(ctypes.c_ulonglong, 0)
+        self._lock = threading.Lock()
+        self._slotList = []
+        self._registeredPosition = 0
+
+    def put(self, data):
+        length = len(data)
+        start = self._writePosition.value
+        if start + length - self._releasePosition.value > self._size:
+            return None
+        index = start % self._size
+        first_length = min(length, self._size - index)
+        self._buffer[index:index + first_length] = data[:first_length]
+        if first_length < length:
+            self._buffer[0:length - first_length] = data[first_length:]
+        self._writePosition.value = start + length
+        return start, length
+
+    def get(self, slot):
+        start, length = slot
+        index = start % self._size
+        first_length = min(length, self._size - index)
+        data = self._buffer[index:index + first_length]
+        if first_length < length:
+            data += self._buffer[0:length - first_length]
+        return data
+
+    def register(self, slot):
+        with self._lock:
+            self._slotList.append(slot)
+            self._registeredPosition = slot[0] + slot[1]
+
+    def release(self, slot):
+        with self._lock:
+            if slot in self._slotList:
+                self._slotList.remove(slot)
+            # Slots are registered in the order they have been put
+            if len(self._slotList) > 0:
+                self._releasePosition.value = self._slotList[0][0]
+            else:
+                self._releasePosition.value = self._registeredPosition
+
+
 class ThumbnailCreationProcess(multiprocessing.Process):
+    """
+    Creates the thumbnails of the jobs from job_queue. The JPEG decoder scales
+    the picture by 1/2, 1/4 or 1/8 while decoding, so only the remaining
+    downscaling is done by the resampling filter. With exif_preview, the
+    thumbnail embedded in the picture is saved first and reported as
+    provisional result, before the final thumbnail replaces it. Jobs with
+    a rendition width create a rendition of that width at ThumbnailPath.
+    RAW pictures are scaled from their embedded JPEG preview, which is
+    extracted to PreviewPath first. Jobs with a SharedSlot decode the
+    picture from shared_buffer, while it is still being written to disk.
+    Results carry the PipelineMetrics time stamps of the job, from the
+    QueueTime of the job on.
+    """
 
     JOB_KEY_PICTURE_NAME = 'PictureName'
     JOB_KEY_PICTURE_PATH = 'PicturePath'
     JOB_KEY_THUMBNAIL_PATH = 'ThumbnailPath'
+    JOB_KEY_SEQUENCE_NUMBER = 'SequenceNumber'
+    JOB_KEY_RENDITION_WIDTH = 'RenditionWidth'
+    JOB_KEY_PREVIEW_PATH = 'PreviewPath'
+    JOB_KEY_SHARED_SLOT = 'SharedSlot'
+    JOB_KEY_QUEUE_TIME = 'QueueTime'
 
     RESULT_KEY_PICTURE_NAME = 'PictureName'
     RESULT_KEY_SUCCESS = 'Success'
+    RESULT_KEY_SEQUENCE_NUMBER = 'SequenceNumber'
+    RESULT_KEY_WORKER_INDEX = 'WorkerIndex'
+    RESULT_KEY_IS_PROVISIONAL = 'IsProvisional'
+    RESULT_KEY_DIMENSIONS = 'Dimensions'
+    RESULT_KEY_STAGE_TIMES = 'StageTimes'
 
-    def __init__(self, job_queue, result_queue):
+    THUMBNAIL_SIZE = 600, 600
+    THUMBNAIL_QUALITY = 75
+    RENDITION_QUALITY = 85
+
+    def __init__(self, job_queue, result_queue, worker_index=0, exif_preview=False, shared_buffer=None):
         super(ThumbnailCreationProcess, self).__init__()
         self._job_queue = job_queue
         self._result_queue = result_queue
+        self._worker_index = worker_index
+        self._exif_preview = exif_preview
+        self._shared_buffer = shared_buffer
+
+    @staticmethod
+    def save_file_atomically(file_path, data):
+        """
+        Writes data to a temporary file and renames it to file_path,
+        so a reader never sees a partially written file.
+        """
+        temporary_path = file_path + '.tmp'
+        with open(temporary_path, 'wb') as file_handler:
+            file_handler.write(data)
+        os.rename(temporary_path, file_path)
+
+    @staticmethod
+    def save_scaled_picture(picture_file, target_path, size, quality):
+        """
+        Saves the picture scaled down to fit into size at target_path and
+        returns the dimensions of the picture. picture_file is a path or an
+        open file object.
+        """
+        image = Image.open(picture_file)
+        width, height = image.size
+        scale = min(float(size[0]) / width, float(size[1]) / height, 1.0)
+        # Selects the smallest DCT scale, which still covers the final size
+        image.draft('RGB', (max(int(width * scale), 1), max(int(height * scale), 1)))
+        image.thumbnail(size, Image.ANTIALIAS)
+        temporary_path = target_path + '.tmp'
+        image.save(temporary_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+        os.rename(temporary_path, target_path)
+        return width, height
+
+    def get_decodable_picture_path(self, picture_path, preview_path):
+        """
+        Returns the path of the JPEG image to scale, extracting the
+        preview of a RAW picture, if it doesn't exist yet.
+        """
+        if preview_path is None:
+            return picture_path
+        if not os.path.isfile(preview_path):
+            preview_data = EmbeddedPreviewReader.read_raw_preview(picture_path)
+            if preview_data is None:
+                raise IOError('No JPEG preview in "{0}"'.format(picture_path))
+            self.save_file_atomically(preview_path, preview_data)
+        return preview_path
+
+    @staticmethod
+    def get_picture_file(picture_path, picture_data):
+        """
+        Returns a file object for picture_data, if the picture has been
+        taken from the shared buffer, else picture_path.
+        """
+        if picture_data is None:
+            return picture_path
+        return StringIO.StringIO(picture_data)
 
     def run(self):
         while True:
             job_dict = self._job_queue.get()
             picture_name = job_dict[self.JOB_KEY_PICTURE_NAME]
             picture_path = job_dict[self.JOB_KEY_PICTURE_PATH]
+            preview_path = job_dict.get(self.JOB_KEY_PREVIEW_PATH)
             thumbnail_path = job_dict[self.JOB_KEY_THUMBNAIL_PATH]
+            stage_times = {PipelineMetrics.STAMP_THUMBNAIL_STARTED: time.time()}
+            if job_dict.get(self.JOB_KEY_QUEUE_TIME) is not None:
+                stage_times[PipelineMetrics.STAMP_THUMBNAIL_QUEUED] = job_dict[self.JOB_KEY_QUEUE_TIME]
             result_dict = {self.RESULT_KEY_PICTURE_NAME: picture_name,
-                           self.RESULT_KEY_SUCCESS: True}
+                           self.RESULT_KEY_SUCCESS: True,
+                           self.RESULT_KEY_SEQUENCE_NUMBER: job_dict.get(self.JOB_KEY_SEQUENCE_NUMBER),
+                           self.RESULT_KEY_WORKER_INDEX: self._worker_index,
+                           self.RESULT_KEY_IS_PROVISIONAL: False,
+                           self.RESULT_KEY_DIMENSIONS: None,
+                           self.RESULT_KEY_STAGE_TIMES: stage_times}
+            rendition_width = job_dict.get(self.JOB_KEY_RENDITION_WIDTH)
+            shared_slot = job_dict.get(self.JOB_KEY_SHARED_SLOT)
+            picture_data = None
             try:
-                size = 600, 600
-                image = Image.open(picture_path)
-                image.thumbnail(size, Image.ANTIALIAS)
-                image.save(thumbnail_path, 'JPEG', quality=75, optimize=True, progressive=True)
+                if (shared_slot is not None) and (self._shared_buffer is not None):
+                    picture_data = self._shared_buffer.get(shared_slot)
+                else:
+                    picture_path = self.get_decodable_picture_path(picture_path, preview_path)
+                if rendition_width is not None:
+                    # Only the width is limited, like srcset width descriptors expect
+                    self.save_scaled_picture(picture_path, thumbnail_path, (rendition_width, sys.maxint),
+                                             self.RENDITION_QUALITY)
+                else:
+                    if self._exif_preview is True:
+                        preview_data = EmbeddedPreviewReader.read_exif_thumbnail(
+                            self.get_picture_file(picture_path, picture_data))
+                        if preview_data is not None:
+                            self.save_file_atomically(thumbnail_path, preview_data)
+                            provisional_result_dict = dict(result_dict)
+                            provisional_result_dict[self.RESULT_KEY_IS_PROVISIONAL] = True
+                            self._result_queue.put(provisional_result_dict)
+                    result_dict[self.RESULT_KEY_DIMENSIONS] = self.save_scaled_picture(
+                        self.get_picture_file(picture_path, picture_data), thumbnail_path,
+                        self.THUMBNAIL_SIZE, self.THUMBNAIL_QUALITY)
+                stage_times[PipelineMetrics.STAMP_THUMBNAIL_CREATED] = time.time()
             except IOError:
                 result_dict[self.RESULT_KEY_SUCCESS] = False
             finally:
@@ -91,20 +548,322 @@ class ThumbnailCreationProcess(multiprocessing.Process):
         return
 
 
-class DemoTetheringProcess(multiprocessing.Process):
+class ThumbnailWorkerPool:
+    """
+    Supervised pool of ThumbnailCreationProcess workers, one per CPU core
+    by default. Jobs wait in a bounded list, add_job() blocks while it is
+    full. A dispatcher hands a job to each idle worker, either the oldest
+    or, with newest_first, the most recent one. Results are returned by
+    get_result() in the order the jobs have been added, unless newest_first
+    is set, then they are returned as soon as they are done. Provisional
+    results precede the final result of their job. run_job() waits for the
+    result of a job instead. Its priority jobs are run ahead of the queued
+    jobs, they take turns with the queued jobs and occupy all but one
+    worker at most, so a burst of them doesn't hold back the thumbnails.
+    run_background_job() waits for a job, which only runs while no other
+    job is waiting. Crashed workers are restarted and their current job is reported as
+    failed.
+    """
 
-    RESULT_KEY_CAMERA_IS_CONNECTED = 'CameraIsConnected'
-    RESULT_KEY_SOURCE_PATH = 'SourcePath'
-    RESULT_KEY_PICTUE = 'Picture'
+    KEY_PROCESS = 'KEY_PROCESS'
+    KEY_JOB_QUEUE = 'KEY_JOB_QUEUE'
+    KEY_CURRENT_JOB = 'KEY_CURRENT_JOB'
 
-    def __init__(self, result_queue, photo_path, initial_counter):
-        super(DemoTetheringProcess, self).__init__()
-        self._result_queue = result_queue
-        self._jpg_counter = initial_counter
-        self._photo_path = photo_path
+    def __init__(self, logger, worker_count, queue_size, newest_first, exif_preview=False, shared_buffer=None):
+        self._logger = logger
+        self._workerCount = worker_count
+        self._queueSize = queue_size
+        self._newestFirst = newest_first
+        self._exifPreview = exif_preview
+        self._sharedBuffer = shared_buffer
+        self._lock = threading.Lock()
+        self._jobCondition = threading.Condition(self._lock)
+        self._jobList = collections.deque()
+        self._priorityJobList = collections.deque()
+        self._backgroundJobList = collections.deque()
+        self._priorityWorkerLimit = max(worker_count - 1, 1)
+        self._runningPrioritySet = set()
+        self._lastJobWasPriority = False
+        self._priorityEventDict = {}
+        self._priorityResultDict = {}
+        self._nextSequenceNumber = 0
+        self._workerList = []
+        self._idleWorkerQueue = Queue.Queue()
+        self._workerResultQueue = multiprocessing.Queue()
+        self._resultQueue = Queue.Queue()
+        self._resultBuffer = {}
+        self._nextResultSequenceNumber = 0
+
+    def start(self):
+        for worker_index in range(self._workerCount):
+            self._workerList.append({self.KEY_PROCESS: None,
+                                     self.KEY_JOB_QUEUE: None,
+                                     self.KEY_CURRENT_JOB: None})
+            self.start_worker(worker_index)
+            self._idleWorkerQueue.put(worker_index)
+        for target in (self.dispatch_jobs, self.receive_worker_results, self.watch_workers):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def start_worker(self, worker_index):
+        # A new job queue, since a crashed worker may have left the old one locked
+        job_queue = multiprocessing.Queue()
+        process = ThumbnailCreationProcess(job_queue, self._workerResultQueue, worker_index,
+                                           self._exifPreview, self._sharedBuffer)
+        process.daemon = True
+        process.start()
+        worker_dict = self._workerList[worker_index]
+        worker_dict[self.KEY_PROCESS] = process
+        worker_dict[self.KEY_JOB_QUEUE] = job_queue
+
+    def add_job(self, job_dict):
+        with self._jobCondition:
+            job_dict[ThumbnailCreationProcess.JOB_KEY_QUEUE_TIME] = time.time()
+            while len(self._jobList) >= self._queueSize:
+                self._jobCondition.wait()
+            job_dict[ThumbnailCreationProcess.JOB_KEY_SEQUENCE_NUMBER] = self._nextSequenceNumber
+            self._nextSequenceNumber += 1
+            self._jobList.append(job_dict)
+            self._jobCondition.notify_all()
+
+    def run_job(self, job_dict, is_priority=True):
+        """
+        Runs job_dict and returns its result dict, which is not returned by
+        get_result(). A priority job runs ahead of the queued jobs, any other
+        job is queued like the jobs of add_job().
+        """
+        if is_priority is True:
+            return self.wait_for_job(job_dict, self._priorityJobList)
+        return self.wait_for_job(job_dict, self._jobList)
+
+    def run_background_job(self, job_dict):
+        """
+        Runs job_dict, once no other job is waiting, and returns its result
+        dict, which is not returned by get_result().
+        """
+        return self.wait_for_job(job_dict, self._backgroundJobList)
+
+    def wait_for_job(self, job_dict, job_list):
+        finished_event = threading.Event()
+        job_dict[ThumbnailCreationProcess.JOB_KEY_QUEUE_TIME] = time.time()
+        with self._jobCondition:
+            if job_list is self._jobList:
+                while len(self._jobList) >= self._queueSize:
+                    self._jobCondition.wait()
+            sequence_number = self._nextSequenceNumber
+            self._nextSequenceNumber += 1
+            job_dict[ThumbnailCreationProcess.JOB_KEY_SEQUENCE_NUMBER] = sequence_number
+            self._priorityEventDict[sequence_number] = finished_event
+            if self._newestFirst is False:
+                # Keeps the ordered results from waiting for this sequence number
+                self._resultBuffer[sequence_number] = None
+            job_list.append(job_dict)
+            self._jobCondition.notify_all()
+        finished_event.wait()
+        with self._lock:
+            result_dict = self._priorityResultDict.pop(sequence_number)
+        return result_dict
+
+    def get_queue_length(self):
+        with self._lock:
+            queue_length = len(self._jobList)
+        return queue_length
+
+    def get_result(self):
+        return self._resultQueue.get()
+
+    def is_priority_job_next(self):
+        """
+        Must be called with the lock held.
+        """
+        if (len(self._priorityJobList) == 0) or (len(self._runningPrioritySet) >= self._priorityWorkerLimit):
+            return False
+        return (len(self._jobList) == 0) or (self._lastJobWasPriority is False)
 
-    def create_demo_photo(self, picture_name):
-        target_path = os.path.join(self._photo_path, picture_name)
+    def dispatch_jobs(self):
+        while True:
+            worker_index = self._idleWorkerQueue.get()
+            with self._jobCondition:
+                while (len(self._jobList) == 0) and (self.is_priority_job_next() is False) and \
+                        (len(self._backgroundJobList) == 0):
+                    self._jobCondition.wait()
+                self._lastJobWasPriority = self.is_priority_job_next()
+                if self._lastJobWasPriority is True:
+                    job_dict = self._priorityJobList.popleft()
+                    self._runningPrioritySet.add(job_dict[ThumbnailCreationProcess.JOB_KEY_SEQUENCE_NUMBER])
+                elif len(self._jobList) == 0:
+                    job_dict = self._backgroundJobList.popleft()
+                elif self._newestFirst is True:
+                    job_dict = self._jobList.pop()
+                else:
+                    job_dict = self._jobList.popleft()
+                self._jobCondition.notify_all()
+                worker_dict = self._workerList[worker_index]
+                worker_dict[self.KEY_CURRENT_JOB] = job_dict
+                worker_dict[self.KEY_JOB_QUEUE].put(job_dict)
+
+    def receive_worker_results(self):
+        while True:
+            result_dict = self._workerResultQueue.get()
+            worker_index = result_dict[ThumbnailCreationProcess.RESULT_KEY_WORKER_INDEX]
+            sequence_number = result_dict[ThumbnailCreationProcess.RESULT_KEY_SEQUENCE_NUMBER]
+            with self._lock:
+                worker_dict = self._workerList[worker_index]
+                current_job = worker_dict[self.KEY_CURRENT_JOB]
+                if (current_job is None) or \
+                        (current_job[ThumbnailCreationProcess.JOB_KEY_SEQUENCE_NUMBER] != sequence_number):
+                    # The job has already been reported as failed by the watchdog
+                    continue
+                if result_dict[ThumbnailCreationProcess.RESULT_KEY_IS_PROVISIONAL] is True:
+                    self.deliver_result(result_dict)
+                    continue
+                worker_dict[self.KEY_CURRENT_JOB] = None
+                self._idleWorkerQueue.put(worker_index)
+                self.deliver_result(result_dict)
+
+    def watch_workers(self):
+        while True:
+            time.sleep(5)
+            with self._lock:
+                for worker_index, worker_dict in enumerate(self._workerList):
+                    if worker_dict[self.KEY_PROCESS].is_alive():
+                        continue
+                    self._logger.log(Logger.LOG_LEVEL_WARN, "Thumbnail process has crashed, restarting it")
+                    current_job = worker_dict[self.KEY_CURRENT_JOB]
+                    worker_dict[self.KEY_CURRENT_JOB] = None
+                    if current_job is not None:
+                        result_dict = {ThumbnailCreationProcess.RESULT_KEY_PICTURE_NAME:
+                                       current_job[ThumbnailCreationProcess.JOB_KEY_PICTURE_NAME],
+                                       ThumbnailCreationProcess.RESULT_KEY_SUCCESS: False,
+                                       ThumbnailCreationProcess.RESULT_KEY_SEQUENCE_NUMBER:
+                                       current_job[ThumbnailCreationProcess.JOB_KEY_SEQUENCE_NUMBER],
+                                       ThumbnailCreationProcess.RESULT_KEY_WORKER_INDEX: worker_index,
+                                       ThumbnailCreationProcess.RESULT_KEY_IS_PROVISIONAL: False}
+                        self.deliver_result(result_dict)
+                    self.start_worker(worker_index)
+                    if current_job is not None:
+                        # An idle worker is still listed in the idle worker queue
+                        self._idleWorkerQueue.put(worker_index)
+
+    def deliver_result(self, result_dict):
+        """
+        Passes result_dict on to get_result(), keeping the order of the jobs
+        unless newest_first is set. A buffered provisional result is replaced
+        by the final result of its job. Must be called with the lock held.
+        """
+        sequence_number = result_dict[ThumbnailCreationProcess.RESULT_KEY_SEQUENCE_NUMBER]
+        if sequence_number in self._priorityEventDict:
+            self._priorityResultDict[sequence_number] = result_dict
+            self._priorityEventDict.pop(sequence_number).set()
+            self._runningPrioritySet.discard(sequence_number)
+            # A worker may wait for the next priority job
+            self._jobCondition.notify_all()
+            return
+        if (self._newestFirst is True) or (sequence_number < self._nextResultSequenceNumber):
+            # Final result of a job, whose provisional result has already been returned
+            self._resultQueue.put(result_dict)
+            return
+        self._resultBuffer[sequence_number] = result_dict
+        while self._nextResultSequenceNumber in self._resultBuffer:
+            result_dict = self._resultBuffer.pop(self._nextResultSequenceNumber)
+            if result_dict is not None:
+                self._resultQueue.put(result_dict)
+            self._nextResultSequenceNumber += 1
+
+
+class DemoCameraBackend:
+    """
+    Stands in for the gphoto2 module in demo mode. The demo camera connects
+    after CONNECTION_DELAY seconds and takes a picture every PICTURE_INTERVAL
+    seconds, which it reports with GP_EVENT_FILE_ADDED like a real camera.
+    The backend is the camera as well, only the calls used by
+    TetheringProcess are provided.
+    """
+
+    GP_EVENT_TIMEOUT = 1
+    GP_EVENT_FILE_ADDED = 2
+    GP_FILE_TYPE_PREVIEW = 0
+    GP_FILE_TYPE_NORMAL = 1
+    GP_ERROR_MODEL_NOT_FOUND = -105
+    GPhoto2Error = gphoto.GPhoto2Error
+
+    CONNECTION_DELAY = 20
+    PICTURE_INTERVAL = 35
+    PREVIEW_SIZE = 160, 120
+
+    CameraFilePath = collections.namedtuple('CameraFilePath', ['folder', 'name'])
+
+    class CameraFile:
+
+        def __init__(self, data):
+            self._data = data
+
+        def save(self, target_path):
+            with open(target_path, 'wb') as file_handler:
+                file_handler.write(self._data)
+
+        def get_data_and_size(self):
+            return self._data
+
+    def __init__(self):
+        self._startTime = None
+        self._storagePath = None
+        self._pictureCounter = 0
+        self._nextPictureTime = None
+
+    def Context(self):
+        return None
+
+    def Camera(self):
+        return self
+
+    def check_result(self, result):
+        error_code, value = result
+        if error_code < 0:
+            raise self.GPhoto2Error(error_code)
+        return value
+
+    def init(self, context):
+        if self._startTime is None:
+            self._startTime = time.time()
+            self._nextPictureTime = self._startTime + self.PICTURE_INTERVAL
+            # The memory card of the demo camera
+            self._storagePath = tempfile.mkdtemp()
+        if time.time() < self._startTime + self.CONNECTION_DELAY:
+            raise self.GPhoto2Error(self.GP_ERROR_MODEL_NOT_FOUND)
+
+    def exit(self, context):
+        pass
+
+    def wait_for_event(self, timeout, context):
+        remaining_time = self._nextPictureTime - time.time()
+        if remaining_time > timeout / 1000.0:
+            time.sleep(timeout / 1000.0)
+            return self.GP_EVENT_TIMEOUT, None
+        time.sleep(max(remaining_time, 0))
+        self._nextPictureTime += self.PICTURE_INTERVAL
+        self._pictureCounter += 1
+        file_name = 'IMG_{0:04d}.JPG'.format(self._pictureCounter)
+        self.create_demo_photo(os.path.join(self._storagePath, file_name), file_name)
+        return self.GP_EVENT_FILE_ADDED, self.CameraFilePath(self._storagePath, file_name)
+
+    def gp_camera_file_get(self, camera, folder, name, file_type, context):
+        file_path = os.path.join(folder, name)
+        if file_type == self.GP_FILE_TYPE_PREVIEW:
+            image = Image.open(file_path)
+            image.thumbnail(self.PREVIEW_SIZE, Image.ANTIALIAS)
+            preview_data = StringIO.StringIO()
+            image.save(preview_data, 'JPEG')
+            return 0, self.CameraFile(preview_data.getvalue())
+        with open(file_path, 'rb') as file_handler:
+            data = file_handler.read()
+        # Keeps the memory card from filling up
+        os.remove(file_path)
+        return 0, self.CameraFile(data)
+
+    @staticmethod
+    def create_demo_photo(target_path, picture_name):
         image_width = 1200
         image_height = 800
         # Choose random colors
@@ -130,53 +889,177 @@ class DemoTetheringProcess(multiprocessing.Process):
         # Save image
         image.save(target_path, "JPEG")
 
-    def run(self):
-        ticker = 0
-        while True:
-            if ticker == 4:
-                result_dict = {self.RESULT_KEY_CAMERA_IS_CONNECTED: True,
-                               self.RESULT_KEY_SOURCE_PATH: None,
-                               self.RESULT_KEY_PICTUE: None}
-                self._result_queue.put(result_dict)
-            elif ticker > 4:
-                if (ticker % 7) == 0:
-                    # Create new JPEG image
-                    self._jpg_counter += 1
-                    picture_name = '{0}-IMG_{1:04d}.jpg'.format(time.strftime('%Y-%m-%d-%H-%M-%S'),
-                                                                self._jpg_counter)
-                    self.create_demo_photo(picture_name)
-                    # Process the downloaded picture
-                    result_dict = {self.RESULT_KEY_CAMERA_IS_CONNECTED: True,
-                                   self.RESULT_KEY_SOURCE_PATH: picture_name,
-                                   self.RESULT_KEY_PICTUE: picture_name}
-                    self._result_queue.put(result_dict)
-            else:
-                result_dict = {self.RESULT_KEY_CAMERA_IS_CONNECTED: False,
-                               self.RESULT_KEY_SOURCE_PATH: None,
-                               self.RESULT_KEY_PICTUE: None}
-                self._result_queue.put(result_dict)
-            time.sleep(5)
-            ticker += 1
-
 
 class TetheringProcess(multiprocessing.Process):
+    """
+    Downloads the pictures taken with the camera. The camera thread polls
+    the events and downloads each picture into memory, a pool of writer
+    threads saves them to disk. A bounded queue sits between both stages,
+    so the camera buffer drains at USB speed while the disk catches up.
+    Results are reported in the order the pictures have been taken, with
+    the PipelineMetrics time stamps of the stages from the camera event on.
+    With preview_first, the preview of each picture is downloaded first and
+    saved as its thumbnail, which is reported with RESULT_KEY_IS_PREVIEW.
+    The writers report the size, modification time and SHA-256 hash of
+    each picture, the hash is computed from the downloaded data, not read
+    back from disk. With a shared_buffer, each JPEG picture is put into it
+    right after the download and reported with RESULT_KEY_SHARED_SLOT,
+    before it is written to disk. Pictures, which could not be downloaded
+    or written, are reported with their name and RESULT_KEY_FAILED. backend
+    is the gphoto2 module or a stand-in for it.
+    """
 
     RESULT_KEY_CAMERA_IS_CONNECTED = 'CameraIsConnected'
     RESULT_KEY_SOURCE_PATH = 'SourcePath'
     RESULT_KEY_PICTUE = 'Picture'
+    RESULT_KEY_IS_PREVIEW = 'IsPreview'
+    RESULT_KEY_STAGE_TIMES = 'StageTimes'
+    RESULT_KEY_SHARED_SLOT = 'SharedSlot'
+    RESULT_KEY_FILE_SIZE = 'FileSize'
+    RESULT_KEY_MODIFICATION_TIME = 'ModificationTime'
+    RESULT_KEY_CONTENT_HASH = 'ContentHash'
+    RESULT_KEY_FAILED = 'Failed'
 
-    def __init__(self, result_queue, photo_path, initial_counter):
+    def __init__(self, result_queue, photo_path, initial_counter, thumbnail_path=None, preview_first=False,
+                 backend=gphoto, writer_count=2, write_queue_size=8, use_fsync=False, shared_buffer=None):
         super(TetheringProcess, self).__init__()
         self._result_queue = result_queue
         self._jpg_counter = initial_counter
         self._raw_counter = initial_counter
         self._photo_path = photo_path
+        self._thumbnail_path = thumbnail_path
+        self._preview_first = preview_first
+        self._backend = backend
+        self._writer_count = writer_count
+        self._write_queue_size = write_queue_size
+        self._use_fsync = use_fsync
+        self._shared_buffer = shared_buffer
+        self._write_queue = None
+        self._result_lock = threading.Lock()
+        self._result_buffer = {}
+        self._next_sequence_number = 0
+        self._next_result_sequence_number = 0
+
+    def start_writers(self):
+        self._write_queue = Queue.Queue(self._write_queue_size)
+        for writer_index in range(self._writer_count):
+            writer_thread = threading.Thread(target=self.write_pictures)
+            writer_thread.daemon = True
+            writer_thread.start()
+
+    def write_pictures(self):
+        while True:
+            sequence_number, picture_name, source_path, camera_file, stage_times = self._write_queue.get()
+            stage_times[PipelineMetrics.STAMP_WRITE_STARTED] = time.time()
+            picture_path = os.path.join(self._photo_path, picture_name)
+            result_dict = self.create_failure_result(source_path, picture_name)
+            try:
+                # The picture is listed as soon as it is complete
+                camera_file.save(picture_path + '.tmp')
+                if self._use_fsync is True:
+                    with open(picture_path + '.tmp', 'rb') as file_handler:
+                        os.fsync(file_handler.fileno())
+                os.rename(picture_path + '.tmp', picture_path)
+                file_stat = os.stat(picture_path)
+                stage_times[PipelineMetrics.STAMP_WRITTEN] = time.time()
+                content_hash = hashlib.sha256(memoryview(camera_file.get_data_and_size()).tobytes()).hexdigest()
+                stage_times[PipelineMetrics.STAMP_HASHED] = time.time()
+                result_dict = {self.RESULT_KEY_CAMERA_IS_CONNECTED: True,
+                               self.RESULT_KEY_SOURCE_PATH: source_path,
+                               self.RESULT_KEY_PICTUE: picture_name,
+                               self.RESULT_KEY_IS_PREVIEW: False,
+                               self.RESULT_KEY_STAGE_TIMES: stage_times,
+                               self.RESULT_KEY_FILE_SIZE: file_stat.st_size,
+                               self.RESULT_KEY_MODIFICATION_TIME: file_stat.st_mtime,
+                               self.RESULT_KEY_CONTENT_HASH: content_hash}
+            except Exception:
+                # Reported as failed, so later pictures aren't held back and the picture isn't pending forever,
+                # the writer goes on with the next picture
+                try:
+                    os.remove(picture_path + '.tmp')
+                except OSError:
+                    pass
+            finally:
+                self.put_result_in_order(sequence_number, result_dict)
+
+    def create_failure_result(self, source_path, picture_name):
+        return {self.RESULT_KEY_CAMERA_IS_CONNECTED: True,
+                self.RESULT_KEY_SOURCE_PATH: source_path,
+                self.RESULT_KEY_PICTUE: picture_name,
+                self.RESULT_KEY_IS_PREVIEW: False,
+                self.RESULT_KEY_FAILED: True}
+
+    def get_next_sequence_number(self):
+        sequence_number = self._next_sequence_number
+        self._next_sequence_number += 1
+        return sequence_number
+
+    def put_result_in_order(self, sequence_number, result_dict):
+        with self._result_lock:
+            self._result_buffer[sequence_number] = result_dict
+            while self._next_result_sequence_number in self._result_buffer:
+                self._result_queue.put(self._result_buffer.pop(self._next_result_sequence_number))
+                self._next_result_sequence_number += 1
+
+    def download_picture(self, camera, context, source_file_path, picture_name, event_time):
+        backend = self._backend
+        stage_times = {PipelineMetrics.STAMP_CAMERA_EVENT: event_time}
+        source_file_name, source_file_extension = os.path.splitext(source_file_path.name)
+        source_path = os.path.join(source_file_path.folder, source_file_name)
+        if (self._preview_first is True) and (self._thumbnail_path is not None):
+            try:
+                preview_file = backend.check_result(backend.gp_camera_file_get(camera,
+                                                                               source_file_path.folder,
+                                                                               source_file_path.name,
+                                                                               backend.GP_FILE_TYPE_PREVIEW,
+                                                                               context))
+                thumbnail_path = os.path.join(self._thumbnail_path, picture_name)
+                preview_file.save(thumbnail_path + '.tmp')
+                os.rename(thumbnail_path + '.tmp', thumbnail_path)
+                result_dict = {self.RESULT_KEY_CAMERA_IS_CONNECTED: True,
+                               self.RESULT_KEY_SOURCE_PATH: source_path,
+                               self.RESULT_KEY_PICTUE: picture_name,
+                               self.RESULT_KEY_IS_PREVIEW: True,
+                               self.RESULT_KEY_STAGE_TIMES: dict(stage_times)}
+                self._result_queue.put(result_dict)
+            except backend.GPhoto2Error:
+                # Not every camera provides previews, the picture is downloaded anyway
+                pass
+        stage_times[PipelineMetrics.STAMP_DOWNLOAD_STARTED] = time.time()
+        try:
+            camera_file = backend.check_result(backend.gp_camera_file_get(camera,
+                                                                          source_file_path.folder,
+                                                                          source_file_path.name,
+                                                                          backend.GP_FILE_TYPE_NORMAL,
+                                                                          context))
+        except backend.GPhoto2Error:
+            # Its preview may have been listed already, the camera is reconnected afterwards
+            self.put_result_in_order(self.get_next_sequence_number(),
+                                     self.create_failure_result(source_path, picture_name))
+            raise
+        stage_times[PipelineMetrics.STAMP_DOWNLOADED] = time.time()
+        if (self._shared_buffer is not None) and picture_name.endswith('.jpg'):
+            shared_slot = self._shared_buffer.put(memoryview(camera_file.get_data_and_size()).tobytes())
+            if shared_slot is not None:
+                # The thumbnail is created from memory, while the picture is written
+                result_dict = {self.RESULT_KEY_CAMERA_IS_CONNECTED: True,
+                               self.RESULT_KEY_SOURCE_PATH: source_path,
+                               self.RESULT_KEY_PICTUE: picture_name,
+                               self.RESULT_KEY_IS_PREVIEW: False,
+                               self.RESULT_KEY_SHARED_SLOT: shared_slot,
+                               self.RESULT_KEY_STAGE_TIMES: dict(stage_times)}
+                self._result_queue.put(result_dict)
+        sequence_number = self.get_next_sequence_number()
+        # Blocks while the writers are behind, the camera buffers the pictures meanwhile
+        self._write_queue.put((sequence_number, picture_name, source_path, camera_file, stage_times))
 
     def run(self):
+        backend = self._backend
+        self.start_writers()
         while True:
             try:
-                context = gphoto.Context()
-                camera = gphoto.Camera()
+                context = backend.Context()
+                camera = backend.Camera()
                 camera.init(context)
                 result_dict = {self.RESULT_KEY_CAMERA_IS_CONNECTED: True,
                                self.RESULT_KEY_SOURCE_PATH: None,
@@ -184,8 +1067,9 @@ class TetheringProcess(multiprocessing.Process):
                 self._result_queue.put(result_dict)
                 while True:
                     event_type, event_data = camera.wait_for_event(1000, context)
-                    if event_type == gphoto.GP_EVENT_FILE_ADDED:
+                    if event_type == backend.GP_EVENT_FILE_ADDED:
                         # Handle new picture
+                        event_time = time.time()
                         source_file_path = event_data
                         source_file_name, source_file_extension = os.path.splitext(source_file_path.name)
                         # Download and save the picture
@@ -194,39 +1078,16 @@ class TetheringProcess(multiprocessing.Process):
                             self._jpg_counter += 1
                             picture_name = '{0}-IMG_{1:04d}.jpg'.format(time.strftime('%Y-%m-%d-%H-%M-%S'),
                                                                         self._jpg_counter)
-                            picture_path = os.path.join(self._photo_path, picture_name)
-                            camera_file = gphoto.check_result(gphoto.gp_camera_file_get(camera,
-                                                                                        source_file_path.folder,
-                                                                                        source_file_path.name,
-                                                                                        gphoto.GP_FILE_TYPE_NORMAL,
-                                                                                        context))
-                            camera_file.save(picture_path)
-                            source_path = os.path.join(source_file_path.folder, source_file_name)
-                            result_dict = {self.RESULT_KEY_CAMERA_IS_CONNECTED: True,
-                                           self.RESULT_KEY_SOURCE_PATH: source_path,
-                                           self.RESULT_KEY_PICTUE: picture_name}
-                            self._result_queue.put(result_dict)
                         else:
                             # Handle RAW picture files
                             self._raw_counter += 1
                             picture_name = '{0}-IMG_{1:04d}{2}'.format(time.strftime('%Y-%m-%d-%H-%M-%S'),
                                                                        self._raw_counter,
                                                                        source_file_extension)
-                            picture_path = os.path.join(self._photo_path, picture_name)
-                            camera_file = gphoto.check_result(gphoto.gp_camera_file_get(camera,
-                                                                                        source_file_path.folder,
-                                                                                        source_file_path.name,
-                                                                                        gphoto.GP_FILE_TYPE_NORMAL,
-                                                                                        context))
-                            camera_file.save(picture_path)
-                            source_path = os.path.join(source_file_path.folder, source_file_name)
-                            result_dict = {self.RESULT_KEY_CAMERA_IS_CONNECTED: True,
-                                           self.RESULT_KEY_SOURCE_PATH: source_path,
-                                           self.RESULT_KEY_PICTUE: None}
-                            self._result_queue.put(result_dict)
+                        self.download_picture(camera, context, source_file_path, picture_name, event_time)
                 camera.exit(context)
                 break
-            except gphoto.GPhoto2Error:
+            except backend.GPhoto2Error:
                 result_dict = {self.RESULT_KEY_CAMERA_IS_CONNECTED: False,
                                self.RESULT_KEY_SOURCE_PATH: None,
                                self.RESULT_KEY_PICTUE: None}
@@ -234,13 +1095,34 @@ class TetheringProcess(multiprocessing.Process):
                 time.sleep(5)
                 continue
 
+
+class DemoTetheringProcess(TetheringProcess):
+    """
+    TetheringProcess with a DemoCameraBackend instead of a real camera.
+    """
+
+    def __init__(self, result_queue, photo_path, initial_counter, thumbnail_path=None, preview_first=False,
+                 writer_count=2, write_queue_size=8, use_fsync=False, shared_buffer=None):
+        super(DemoTetheringProcess, self).__init__(result_queue, photo_path, initial_counter, thumbnail_path,
+                                                   preview_first, DemoCameraBackend(),
+                                                   writer_count, write_queue_size, use_fsync, shared_buffer)
+
 # Notification Center class
 
 
 class NotificationCenter:
+    """
+    Broadcasts named events to waiting threads. Every event name has a
+    generation counter, that is incremented by each fire. Waiters pass
+    the generation they have seen before checking their condition, so
+    an event fired in between is never lost. Each waiter blocks on its
+    own lock, a single thread releases waiters whose timeout is over.
+    """
 
     __INSTANCE = None
 
+    TIMEOUT_RESOLUTION = 0.1
+
     @classmethod
     def shared_instance(cls):
         if cls.__INSTANCE is None:
@@ -251,18 +1133,35 @@ class NotificationCenter:
         if self.__INSTANCE is not None:
             raise ValueError("An instantiation already exists!")
         self._lock = threading.Lock()
+        self._generationDict = {}
+        self._waiterDict = {}
         self._eventDict = {}
+        self._deadlineHeap = []
+        self._waiterSequenceNumber = 0
+        self._hasDeadlines = threading.Event()
+        self._timeoutThread = threading.Thread(target=self.release_timed_out_waiters)
+        self._timeoutThread.daemon = True
+        self._timeoutThread.start()
+
+    def get_generation(self, event_name):
+        with self._lock:
+            generation = self._generationDict.get(event_name, 0)
+        return generation
 
     def fire_event(self, event_name):
         with self._lock:
-            try:
-                event_list = self._eventDict[event_name]
-            except KeyError:
-                event_list = []
-            for event in event_list:
-                event.set()
+            self._generationDict[event_name] = self._generationDict.get(event_name, 0) + 1
+            waiter_dict = self._waiterDict.pop(event_name, {})
+            for waiter_lock in waiter_dict.values():
+                waiter_lock.release()
+            event_list = list(self._eventDict.get(event_name, []))
+        for event in event_list:
+            event.set()
 
     def assign_event_to_list(self, event, event_name):
+        """
+        Assigns an object with a set() method, that gets called on every fire of event_name.
+        """
         with self._lock:
             try:
                 event_list = self._eventDict[event_name]
@@ -281,15 +1180,223 @@ class NotificationCenter:
                 if event in event_list:
                     event_list.remove(event)
 
+    def wait_for_event(self, event_name, generation, timeout):
+        """
+        Blocks until event_name has been fired after generation or until timeout
+        seconds have passed. Returns immediately if the event has been fired since
+        generation was read. Returns the current generation of event_name.
+        """
+        waiter_lock = threading.Lock()
+        waiter_lock.acquire()
+        with self._lock:
+            current_generation = self._generationDict.get(event_name, 0)
+            if current_generation != generation:
+                return current_generation
+            self._waiterSequenceNumber += 1
+            self._waiterDict.setdefault(event_name, {})[self._waiterSequenceNumber] = waiter_lock
+            heapq.heappush(self._deadlineHeap, (time.time() + timeout, self._waiterSequenceNumber, event_name))
+            self._hasDeadlines.set()
+        waiter_lock.acquire()
+        return self.get_generation(event_name)
+
     def wait_once_for_event_with_timeout(self, event_name, timeout):
-        event = threading.Event()
-        self.assign_event_to_list(event, event_name)
-        timeout_timer = threading.Timer(timeout, event.set)
-        timeout_timer.start()
-        event.wait()
-        timeout_timer.cancel()
-        self.resign_event_from_list(event, event_name)
-        event.clear()
+        self.wait_for_event(event_name, self.get_generation(event_name), timeout)
+
+    def release_timed_out_waiters(self):
+        while True:
+            self._hasDeadlines.wait()
+            with self._lock:
+                now = time.time()
+                while (len(self._deadlineHeap) > 0) and (self._deadlineHeap[0][0] <= now):
+                    deadline, sequence_number, event_name = heapq.heappop(self._deadlineHeap)
+                    # Waiters released by fire_event are gone from the waiter dict already
+                    waiter_lock = self._waiterDict.get(event_name, {}).pop(sequence_number, None)
+                    if waiter_lock is not None:
+                        waiter_lock.release()
+                if len(self._deadlineHeap) == 0:
+                    self._hasDeadlines.clear()
+                    sleep_time = 0
+                else:
+                    sleep_time = min(self._deadlineHeap[0][0] - now, self.TIMEOUT_RESOLUTION)
+            time.sleep(sleep_time)
+
+# Pipeline Metrics class
+
+
+class PipelineMetrics:
+    """
+    Aggregates the time stamps, that pictures collect on their way from the
+    camera to the viewers and hubs. The time stamps travel with the result
+    dicts of TetheringProcess and ThumbnailCreationProcess and are recorded
+    by record_timestamps(). A picture is tracked from its camera event on,
+    the newest PICTURE_LIMIT pictures are kept. Every stage of STAGE_LIST,
+    whose time stamps are both known, is observed once per picture, every
+    milestone of MILESTONE_LIST is observed as time since the camera event.
+    The quantiles of the last SAMPLE_LIMIT observations, together with the
+    gauges added by add_gauge(), are returned in the Prometheus text format.
+    """
+
+    STAMP_CAMERA_EVENT = 'camera_event'
+    STAMP_DOWNLOAD_STARTED = 'download_started'
+    STAMP_DOWNLOADED = 'downloaded'
+    STAMP_WRITE_STARTED = 'write_started'
+    STAMP_WRITTEN = 'written'
+    STAMP_HASHED = 'hashed'
+    STAMP_THUMBNAIL_QUEUED = 'thumbnail_queued'
+    STAMP_THUMBNAIL_STARTED = 'thumbnail_started'
+    STAMP_THUMBNAIL_CREATED = 'thumbnail_created'
+    STAMP_LISTED = 'listed'
+    STAMP_FIRST_FETCH = 'first_fetch'
+    STAMP_HUB_THUMBNAIL = 'hub_thumbnail'
+    STAMP_HUB_PHOTO = 'hub_photo'
+
+    STAGE_DOWNLOAD = 'download'
+    STAGE_WRITE_QUEUE = 'write_queue'
+    STAGE_WRITE = 'write'
+    STAGE_HASH = 'hash'
+
+    STAGE_LIST = ((STAGE_DOWNLOAD, STAMP_DOWNLOAD_STARTED, STAMP_DOWNLOADED),
+                  (STAGE_WRITE_QUEUE, STAMP_DOWNLOADED, STAMP_WRITE_STARTED),
+                  (STAGE_WRITE, STAMP_WRITE_STARTED, STAMP_WRITTEN),
+                  (STAGE_HASH, STAMP_WRITTEN, STAMP_HASHED),
+                  ('thumbnail_queue', STAMP_THUMBNAIL_QUEUED, STAMP_THUMBNAIL_STARTED),
+                  ('thumbnail_encode', STAMP_THUMBNAIL_STARTED, STAMP_THUMBNAIL_CREATED),
+                  ('first_fetch', STAMP_LISTED, STAMP_FIRST_FETCH))
+    MILESTONE_LIST = (('stored', STAMP_HASHED),
+                      ('listed', STAMP_LISTED),
+                      ('first_fetch', STAMP_FIRST_FETCH),
+                      ('hub_thumbnail', STAMP_HUB_THUMBNAIL),
+                      ('hub_photo', STAMP_HUB_PHOTO))
+
+    STAGE_METRIC_NAME = 'picture_streamer_stage_seconds'
+    MILESTONE_METRIC_NAME = 'picture_streamer_milestone_seconds'
+    QUANTILE_LIST = (0.5, 0.95, 0.99)
+    PICTURE_LIMIT = 1024
+    SAMPLE_LIMIT = 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timestampDict = collections.OrderedDict()
+        self._intervalList = [(self.STAGE_METRIC_NAME, 'stage', stage, start_stamp, end_stamp)
+                              for stage, start_stamp, end_stamp in self.STAGE_LIST]
+        self._intervalList += [(self.MILESTONE_METRIC_NAME, 'milestone', milestone, self.STAMP_CAMERA_EVENT, stamp)
+                               for milestone, stamp in self.MILESTONE_LIST]
+        # Maps (metric name, label value) to [samples, sum, count]
+        self._summaryDict = {}
+        for metric_name, label_name, label_value, start_stamp, end_stamp in self._intervalList:
+            self._summaryDict[(metric_name, label_value)] = [collections.deque(maxlen=self.SAMPLE_LIMIT), 0.0, 0]
+        self._gaugeList = []
+
+    @staticmethod
+    def get_stage_duration(timestamp_dict, stage):
+        """
+        Returns the seconds spent in stage according to timestamp_dict, 0.0 if unknown.
+        """
+        for list_stage, start_stamp, end_stamp in PipelineMetrics.STAGE_LIST:
+            if (list_stage == stage) and (start_stamp in timestamp_dict) and (end_stamp in timestamp_dict):
+                return max(timestamp_dict[end_stamp] - timestamp_dict[start_stamp], 0.0)
+        return 0.0
+
+    def record_timestamp(self, picture_name, stamp, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.record_timestamps(picture_name, {stamp: timestamp})
+
+    def record_timestamps(self, picture_name, timestamp_dict):
+        """
+        Records the time stamps of timestamp_dict for picture_name, only the
+        first time stamp of each kind is kept. Time stamps of pictures, which
+        aren't tracked, are ignored, unless they contain the camera event.
+        """
+        with self._lock:
+            picture_timestamp_dict = self._timestampDict.get(picture_name)
+            if picture_timestamp_dict is None:
+                if self.STAMP_CAMERA_EVENT not in timestamp_dict:
+                    return
+                picture_timestamp_dict = {}
+                self._timestampDict[picture_name] = picture_timestamp_dict
+                if len(self._timestampDict) > self.PICTURE_LIMIT:
+                    self._timestampDict.popitem(last=False)
+            new_stamp_set = set()
+            for stamp, timestamp in timestamp_dict.items():
+                if stamp not in picture_timestamp_dict:
+                    picture_timestamp_dict[stamp] = timestamp
+                    new_stamp_set.add(stamp)
+            for metric_name, label_name, label_value, start_stamp, end_stamp in self._intervalList:
+                if (start_stamp not in new_stamp_set) and (end_stamp not in new_stamp_set):
+                    continue
+                if (start_stamp in picture_timestamp_dict) and (end_stamp in picture_timestamp_dict):
+                    duration = max(picture_timestamp_dict[end_stamp] - picture_timestamp_dict[start_stamp], 0.0)
+                    summary = self._summaryDict[(metric_name, label_value)]
+                    summary[0].append(duration)
+                    summary[1] += duration
+                    summary[2] += 1
+
+    def add_gauge(self, metric_name, help_text, get_value, label_name=None):
+        """
+        Adds a gauge, whose value is returned by get_value. With a label_name,
+        get_value returns a dict, which maps the label values to the values.
+        """
+        with self._lock:
+            self._gaugeList.append((metric_name, help_text, get_value, label_name))
+
+    @staticmethod
+    def format_label(label_name, label_value):
+        if isinstance(label_value, unicode):
+            label_value = label_value.encode('utf-8')
+        label_value = str(label_value)
+        label_value = label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{0}="{1}"'.format(label_name, label_value)
+
+    @staticmethod
+    def get_quantile(sorted_sample_list, quantile):
+        if len(sorted_sample_list) == 0:
+            return float('nan')
+        index = int(math.ceil(quantile * len(sorted_sample_list))) - 1
+        return sorted_sample_list[min(max(index, 0), len(sorted_sample_list) - 1)]
+
+    @staticmethod
+    def format_value(value):
+        if isinstance(value, float):
+            if math.isnan(value):
+                return 'NaN'
+            return repr(value)
+        return str(value)
+
+    def get_prometheus_text(self):
+        """
+        Returns the /metrics document in the Prometheus text format.
+        """
+        with self._lock:
+            summary_list = []
+            for metric_name, label_name, label_value, start_stamp, end_stamp in self._intervalList:
+                sample_deque, sample_sum, sample_count = self._summaryDict[(metric_name, label_value)]
+                summary_list.append((metric_name, label_name, label_value, sorted(sample_deque), sample_sum,
+                                     sample_count))
+            gauge_list = list(self._gaugeList)
+        help_dict = {self.STAGE_METRIC_NAME: 'Seconds pictures spend in each stage of the pipeline.',
+                     self.MILESTONE_METRIC_NAME: 'Seconds from the camera event until pictures reach a milestone.'}
+        line_list = []
+        for metric_name, label_name, label_value, sample_list, sample_sum, sample_count in summary_list:
+            if metric_name in help_dict:
+                line_list.append('# HELP {0} {1}'.format(metric_name, help_dict.pop(metric_name)))
+                line_list.append('# TYPE {0} summary'.format(metric_name))
+            label = self.format_label(label_name, label_value)
+            for quantile in self.QUANTILE_LIST:
+                line_list.append('{0}{{{1},quantile="{2}"}} {3}'.format(
+                    metric_name, label, quantile, self.format_value(self.get_quantile(sample_list, quantile))))
+            line_list.append('{0}_sum{{{1}}} {2}'.format(metric_name, label, self.format_value(sample_sum)))
+            line_list.append('{0}_count{{{1}}} {2}'.format(metric_name, label, sample_count))
+        for metric_name, help_text, get_value, label_name in gauge_list:
+            line_list.append('# HELP {0} {1}'.format(metric_name, help_text))
+            line_list.append('# TYPE {0} gauge'.format(metric_name))
+            if label_name is None:
+                line_list.append('{0} {1}'.format(metric_name, self.format_value(get_value())))
+                continue
+            for label_value, value in sorted(get_value().items()):
+                line_list.append('{0}{{{1}}} {2}'.format(metric_name, self.format_label(label_name, label_value),
+                                                         self.format_value(value)))
+        return '\n'.join(line_list) + '\n'
 
 # Configuration class
 
@@ -305,26 +1412,83 @@ class Configuration:
             '-session',
             '-sslcert',
             '-log',
+            '-logsize',
+            '-logrotate',
+            '-logbackups',
+            '-logformat',
+            '-logqueue',
             '-demo',
+            '-async',
+            '-workers',
+            '-downloadworkers',
+            '-thumbworkers',
+            '-thumbqueue',
+            '-newestfirst',
+            '-exifpreview',
+            '-renditions',
+            '-rendercache',
+            '-previewfirst',
+            '-writers',
+            '-ingestqueue',
+            '-fsync',
+            '-sharedbuffer',
+            '-hubcafile',
+            '-hubuploads',
+            '-hubbandwidth',
+            '-hubrendition',
             '-reboot',
             '-shutdown']
         self._config = {
             'HttpPortNumber': 8888,
             'RunAsDaemon': False,
             'RunInDemoMode': False,
+            'RunAsyncHttpServer': False,
+            'HttpWorkerCount': 8,
+            'HttpDownloadWorkerCount': 8,
+            'ThumbnailWorkerCount': 0,
+            'ThumbnailQueueSize': 256,
+            'ThumbnailNewestFirst': False,
+            'ThumbnailExifPreview': False,
+            'RenditionWidthList': [1024, 1600, 2400],
+            'RenditionCacheSize': 512,
+            'PreviewFirstIngest': False,
+            'IngestWriterCount': 2,
+            'IngestQueueSize': 8,
+            'IngestFsync': False,
+            'SharedBufferSize': 0,
+            'HubUploadWorkerCount': 2,
+            'HubBandwidthLimit': 0,
+            'HubRenditionUpload': True,
             'DataFolder': './PictureDataFolder/',
             'SessionName': '',
             'SSLCertPath': '',
+            'HubCAFilePath': '',
             'LogFilePath': '',
+            'LogRotationSize': 0,
+            'LogRotationInterval': 0,
+            'LogBackupCount': 5,
+            'LogJsonFormat': False,
+            'LogQueueSize': 4096,
             'ThumbnailFolder': 'Thumbnails',
             'PhotoFolder': 'Photos',
+            'RenditionFolder': 'Renditions',
+            'PreviewFolder': 'Previews',
+            'HubJournalFile': 'HubUploads.journal',
+            'MetadataJournalFile': 'PictureMetadata.journal',
             'RebootCommand': '',
             'ShutdownCommand': ''}
 
     def print_usage_information_and_exit(self):
         usage = "Usage: {0} [-port <NUMBER>] [-daemon <yes|no>]".format(self._script) + \
                 "[-dir <DATA DIRECTORY>] [-session <SESSIONNAME>]" + \
-                "[-sslcert <FILE>] -log [LOGFILE] [-demo <yes|no>]"
+                "[-sslcert <FILE>] -log [LOGFILE] [-logsize <MEGABYTES>] [-logrotate <HOURS>]" + \
+                "[-logbackups <NUMBER>] [-logformat <text|json>] [-logqueue <NUMBER>] [-demo <yes|no>]" + \
+                "[-async <yes|no>] [-workers <NUMBER>] [-downloadworkers <NUMBER>]" + \
+                "[-thumbworkers <NUMBER>] [-thumbqueue <NUMBER>] [-newestfirst <yes|no>]" + \
+                "[-exifpreview <yes|no>] [-renditions <WIDTH,...>] [-rendercache <MEGABYTES>]" + \
+                "[-previewfirst <yes|no>] [-writers <NUMBER>] [-ingestqueue <NUMBER>] [-fsync <yes|no>]" + \
+                "[-sharedbuffer <MEGABYTES>] [-hubcafile <FILE>]" + \
+                "[-hubuploads <NUMBER>] [-hubbandwidth <KILOBYTES/S>] [-hubrendition <yes|no>]"
         print usage
         sys.exit(1)
 
@@ -344,7 +1508,7 @@ class Configuration:
             else:
                 if current_key == '-port':
                     if 1024 < int(arg) < 10000:
-                        self._config['PortNumber'] = int(arg)
+                        self._config['HttpPortNumber'] = int(arg)
                     else:
                         print "Invalid port number!"
                         exit(1)
@@ -354,6 +1518,76 @@ class Configuration:
                 elif current_key == '-demo':
                     if arg == 'yes':
                         self._config['RunInDemoMode'] = True
+                elif current_key == '-async':
+                    if arg == 'yes':
+                        self._config['RunAsyncHttpServer'] = True
+                elif current_key == '-workers':
+                    if 0 < int(arg) <= 256:
+                        self._config['HttpWorkerCount'] = int(arg)
+                    else:
+                        print "Invalid number of workers!"
+                        sys.exit(1)
+                elif current_key == '-downloadworkers':
+                    if 0 < int(arg) <= 256:
+                        self._config['HttpDownloadWorkerCount'] = int(arg)
+                    else:
+                        print "Invalid number of download workers!"
+                        sys.exit(1)
+                elif current_key == '-thumbworkers':
+                    if 0 < int(arg) <= 64:
+                        self._config['ThumbnailWorkerCount'] = int(arg)
+                    else:
+                        print "Invalid number of thumbnail workers!"
+                        sys.exit(1)
+                elif current_key == '-thumbqueue':
+                    if int(arg) > 0:
+                        self._config['ThumbnailQueueSize'] = int(arg)
+                    else:
+                        print "Invalid thumbnail queue size!"
+                        sys.exit(1)
+                elif current_key == '-newestfirst':
+                    if arg == 'yes':
+                        self._config['ThumbnailNewestFirst'] = True
+                elif current_key == '-exifpreview':
+                    if arg == 'yes':
+                        self._config['ThumbnailExifPreview'] = True
+                elif current_key == '-renditions':
+                    width_list = sorted(set(int(width) for width in arg.split(',') if width != ''))
+                    if all(64 <= width <= 8192 for width in width_list):
+                        self._config['RenditionWidthList'] = width_list
+                    else:
+                        print "Invalid rendition widths!"
+                        sys.exit(1)
+                elif current_key == '-previewfirst':
+                    if arg == 'yes':
+                        self._config['PreviewFirstIngest'] = True
+                elif current_key == '-writers':
+                    if 0 < int(arg) <= 16:
+                        self._config['IngestWriterCount'] = int(arg)
+                    else:
+                        print "Invalid number of writers!"
+                        sys.exit(1)
+                elif current_key == '-ingestqueue':
+                    if int(arg) > 0:
+                        self._config['IngestQueueSize'] = int(arg)
+                    else:
+                        print "Invalid ingest queue size!"
+                        sys.exit(1)
+                elif current_key == '-fsync':
+                    if arg == 'yes':
+                        self._config['IngestFsync'] = True
+                elif current_key == '-sharedbuffer':
+                    if 0 <= int(arg) <= 4096:
+                        self._config['SharedBufferSize'] = int(arg)
+                    else:
+                        print "Invalid shared buffer size!"
+                        sys.exit(1)
+                elif current_key == '-rendercache':
+                    if int(arg) > 0:
+                        self._config['RenditionCacheSize'] = int(arg)
+                    else:
+                        print "Invalid rendition cache size!"
+                        sys.exit(1)
                 elif current_key == '-dir':
                     if os.path.exists(arg) and os.path.isdir(arg) and os.access(arg, os.W_OK):
                         self._config['DataFolder'] = arg
@@ -365,8 +1599,56 @@ class Configuration:
                 elif current_key == '-sslcert':
                     if os.path.exists(arg) and os.path.isfile(arg):
                         self._config['SSLCertPath'] = arg
+                elif current_key == '-hubcafile':
+                    if os.path.exists(arg) and os.path.isfile(arg):
+                        self._config['HubCAFilePath'] = arg
+                    else:
+                        print "Invalid CA file for hubs!"
+                        sys.exit(1)
+                elif current_key == '-hubuploads':
+                    if 0 < int(arg) <= 16:
+                        self._config['HubUploadWorkerCount'] = int(arg)
+                    else:
+                        print "Invalid number of hub uploads!"
+                        sys.exit(1)
+                elif current_key == '-hubbandwidth':
+                    if int(arg) >= 0:
+                        self._config['HubBandwidthLimit'] = int(arg)
+                    else:
+                        print "Invalid hub bandwidth!"
+                        sys.exit(1)
+                elif current_key == '-hubrendition':
+                    if arg == 'no':
+                        self._config['HubRenditionUpload'] = False
                 elif current_key == '-log':
                     self._config['LogFilePath'] = str(arg)
+                elif current_key == '-logsize':
+                    if int(arg) >= 0:
+                        self._config['LogRotationSize'] = int(arg)
+                    else:
+                        print "Invalid log size!"
+                        sys.exit(1)
+                elif current_key == '-logrotate':
+                    if int(arg) >= 0:
+                        self._config['LogRotationInterval'] = int(arg)
+                    else:
+                        print "Invalid log rotation interval!"
+                        sys.exit(1)
+                elif current_key == '-logbackups':
+                    if 0 <= int(arg) <= 100:
+                        self._config['LogBackupCount'] = int(arg)
+                    else:
+                        print "Invalid number of log backups!"
+                        sys.exit(1)
+                elif current_key == '-logformat':
+                    if arg == 'json':
+                        self._config['LogJsonFormat'] = True
+                elif current_key == '-logqueue':
+                    if int(arg) > 0:
+                        self._config['LogQueueSize'] = int(arg)
+                    else:
+                        print "Invalid log queue size!"
+                        sys.exit(1)
                 elif current_key == '-reboot':
                     self._config['RebootCommand'] = str(arg)
                 elif current_key == '-shutdown':
@@ -417,37 +1699,456 @@ class ZeroconfService:
 
 
 class Logger:
+    """
+    Writes the log in a background thread, so callers never wait for the
+    file system. log() puts the message into a queue of queue_size entries.
+    If the queue is full, the message is dropped and counted, and the
+    number of dropped messages is logged with the next written message.
+    The writer keeps the log file open and writes its messages through the
+    buffer of the file. The buffer is flushed FLUSH_INTERVAL seconds after
+    the first unflushed message, errors are flushed right away. The file is
+    rotated, when it would exceed rotation_size bytes or has been written
+    for rotation_interval seconds, 0 turns either off. The newest
+    backup_count old files are kept as <log>.1, <log>.2 and so on. With
+    is_json_format, the file gets a JSON object per line instead of text.
+    """
 
     LOG_LEVEL_INFO = 'INFO:'
     LOG_LEVEL_WARN = 'WARNING:'
     LOG_LEVEL_ERROR = 'ERROR:'
     LOG_LEVEL_FATAL = 'FATAL ERROR:'
 
-    def __init__(self, logfile_path, run_as_deamon):
+    FLUSH_INTERVAL = 1.0
+    FLUSH_LEVELS = (LOG_LEVEL_ERROR, LOG_LEVEL_FATAL)
+    FILE_BUFFER_SIZE = 64 * 1024
+    CLOSE_TIMEOUT = 5.0
+
+    def __init__(self, logfile_path, run_as_deamon, queue_size=4096, rotation_size=0, rotation_interval=0,
+                 backup_count=5, is_json_format=False):
         self._logFilePath = logfile_path
         self._runAsDeamon = run_as_deamon
+        self._rotationSize = rotation_size
+        self._rotationInterval = rotation_interval
+        self._backupCount = backup_count
+        self._isJsonFormat = is_json_format
         self._lock = threading.Lock()
+        self._messageQueue = Queue.Queue(queue_size)
+        self._droppedCount = 0
+        self._droppedTotalCount = 0
+        self._fileHandler = None
+        self._fileSize = 0
+        self._fileOpenTime = 0
+        self._writerThread = threading.Thread(target=self.write_messages)
+        self._writerThread.daemon = True
+        self._writerThread.start()
+        # The messages logged right before the interpreter exits are written as well
+        atexit.register(self.close)
 
     def log(self, log_level, log_message):
-        with self._lock:
-            formatted_message = '[{0}] {1} {2}'.format(str(datetime.datetime.now()), log_level, log_message)
-            if self._logFilePath != '':
-                with open(self._logFilePath, 'a') as logFile:
-                    logFile.write("{0}\n".format(formatted_message))
-            if self._runAsDeamon is False:
-                print(formatted_message)
+        try:
+            self._messageQueue.put_nowait((time.time(), log_level, log_message))
+        except Queue.Full:
+            with self._lock:
+                self._droppedCount += 1
+                self._droppedTotalCount += 1
 
-# Server class
+    def get_dropped_count(self):
+        """
+        Returns the number of messages dropped since the start.
+        """
+        with self._lock:
+            dropped_count = self._droppedTotalCount
+        return dropped_count
 
+    def close(self):
+        """
+        Writes the waiting messages and closes the log file.
+        """
+        if not self._writerThread.is_alive():
+            return
+        try:
+            self._messageQueue.put(None, True, self.CLOSE_TIMEOUT)
+        except Queue.Full:
+            return
+        self._writerThread.join(self.CLOSE_TIMEOUT)
 
-class ThreadingHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
-    pass
+    def take_dropped_count(self):
+        with self._lock:
+            dropped_count = self._droppedCount
+            self._droppedCount = 0
+        return dropped_count
+
+    def write_messages(self):
+        flush_deadline = None
+        while True:
+            timeout = None
+            if flush_deadline is not None:
+                timeout = max(flush_deadline - time.time(), 0)
+            try:
+                entry = self._messageQueue.get(True, timeout)
+            except Queue.Empty:
+                self.flush_file()
+                flush_deadline = None
+                continue
+            if entry is None:
+                self.write_dropped_count(time.time())
+                self.close_file()
+                return
+            log_time, log_level, log_message = entry
+            self.write_dropped_count(log_time)
+            self.write_message(log_time, log_level, log_message)
+            if log_level in self.FLUSH_LEVELS:
+                self.flush_file()
+                flush_deadline = None
+            elif flush_deadline is None:
+                flush_deadline = time.time() + self.FLUSH_INTERVAL
+
+    def write_dropped_count(self, log_time):
+        dropped_count = self.take_dropped_count()
+        if dropped_count > 0:
+            self.write_message(log_time, self.LOG_LEVEL_WARN,
+                               '{0} log messages dropped, the log queue was full'.format(dropped_count))
+
+    def write_message(self, log_time, log_level, log_message):
+        log_date_time = datetime.datetime.fromtimestamp(log_time)
+        formatted_message = '[{0}] {1} {2}'.format(str(log_date_time), log_level, log_message)
+        if self._runAsDeamon is False:
+            print(formatted_message)
+        if self._logFilePath == '':
+            return
+        if self._isJsonFormat is True:
+            line = json.dumps({'time': log_date_time.isoformat(),
+                               'level': log_level.rstrip(':'),
+                               'message': log_message}) + '\n'
+        else:
+            line = formatted_message + '\n'
+        try:
+            if self._fileHandler is None:
+                self.open_file()
+            if self.is_rotation_due(len(line)):
+                self.rotate_file()
+            self._fileHandler.write(line)
+            self._fileSize += len(line)
+        except (IOError, OSError):
+            # The message is lost, the file is opened again for the next one
+            self.close_file()
+            with self._lock:
+                self._droppedTotalCount += 1
+
+    def open_file(self):
+        self._fileHandler = open(self._logFilePath, 'a', self.FILE_BUFFER_SIZE)
+        self._fileSize = os.fstat(self._fileHandler.fileno()).st_size
+        self._fileOpenTime = time.time()
+
+    def flush_file(self):
+        if self._fileHandler is None:
+            return
+        try:
+            self._fileHandler.flush()
+        except (IOError, OSError):
+            self.close_file()
+
+    def close_file(self):
+        if self._fileHandler is None:
+            return
+        file_handler = self._fileHandler
+        self._fileHandler = None
+        try:
+            file_handler.close()
+        except (IOError, OSError):
+            pass
+
+    def is_rotation_due(self, line_length):
+        if (self._rotationSize > 0) and (self._fileSize > 0) and \
+                (self._fileSize + line_length > self._rotationSize):
+            return True
+        if (self._rotationInterval > 0) and (time.time() - self._fileOpenTime >= self._rotationInterval):
+            return True
+        return False
+
+    def rotate_file(self):
+        """
+        Renames the log file to <log>.1 after shifting the older files by one,
+        the oldest one beyond backup_count is overwritten.
+        """
+        self.close_file()
+        for backup_index in range(self._backupCount - 1, 0, -1):
+            backup_path = '{0}.{1}'.format(self._logFilePath, backup_index)
+            if os.path.exists(backup_path):
+                os.rename(backup_path, '{0}.{1}'.format(self._logFilePath, backup_index + 1))
+        if self._backupCount > 0:
+            os.rename(self._logFilePath, '{0}.1'.format(self._logFilePath))
+        else:
+            os.remove(self._logFilePath)
+        self.open_file()
+
+# Zip Stream Writer class
+
+
+class ZipStreamWriter:
+    """
+    Writes a store only ZIP archive in a single pass through the function
+    write, for example the sendall of a socket. The files aren't compressed,
+    JPEGs wouldn't get any smaller. The CRC of a file is known only after
+    its data has been written, so CRC and sizes follow the data in a data
+    descriptor. Files, offsets and archives beyond the limits of the
+    classic format get ZIP64 records. Only the central directory entries
+    are kept in memory, a few dozen bytes per file.
+    """
+
+    ZIP64_LIMIT = 0xFFFFFFFF
+    ZIP64_COUNT_LIMIT = 0xFFFF
+    # Values of the classic records, which tell to look into the ZIP64 records
+    ZIP64_MARKER = 0xFFFFFFFF
+    ZIP64_COUNT_MARKER = 0xFFFF
+
+    LOCAL_HEADER_SIGNATURE = 0x04034b50
+    DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+    CENTRAL_HEADER_SIGNATURE = 0x02014b50
+    ZIP64_END_SIGNATURE = 0x06064b50
+    ZIP64_LOCATOR_SIGNATURE = 0x07064b50
+    END_SIGNATURE = 0x06054b50
+
+    ZIP64_EXTRA_ID = 0x0001
+    VERSION = 20
+    ZIP64_VERSION = 45
+    # Made by a Unix system, external attributes are the file mode
+    CREATOR_SYSTEM = 3
+    FILE_MODE = 0100644
+    FLAG_DATA_DESCRIPTOR = 0x0008
+    FLAG_UTF8_NAME = 0x0800
+
+    def __init__(self, write, chunk_size=64 * 1024):
+        self._write = write
+        self._chunkSize = chunk_size
+        self._offset = 0
+        self._entryList = []
+
+    def write_record(self, data):
+        self._write(data)
+        self._offset += len(data)
+
+    @staticmethod
+    def get_dos_date_time(modification_time):
+        local_time = time.localtime(modification_time)
+        if local_time.tm_year < 1980:
+            return 0, (1 << 5) | 1
+        dos_time = (local_time.tm_hour << 11) | (local_time.tm_min << 5) | (local_time.tm_sec // 2)
+        dos_date = ((local_time.tm_year - 1980) << 9) | (local_time.tm_mon << 5) | local_time.tm_mday
+        return dos_time, dos_date
+
+    def add_file(self, archive_name, file_handler, file_size, modification_time):
+        """
+        Writes file_size bytes of file_handler as archive_name. A file, which
+        turns out to be shorter, is archived with the bytes it has.
+        """
+        if isinstance(archive_name, unicode):
+            archive_name = archive_name.encode('utf-8')
+        flags = self.FLAG_DATA_DESCRIPTOR
+        try:
+            archive_name.decode('ascii')
+        except UnicodeDecodeError:
+            flags |= self.FLAG_UTF8_NAME
+        dos_time, dos_date = self.get_dos_date_time(modification_time)
+        header_offset = self._offset
+        is_zip64 = file_size >= self.ZIP64_LIMIT
+        if is_zip64 is True:
+            extra = struct.pack('<HHQQ', self.ZIP64_EXTRA_ID, 16, 0, 0)
+            version = self.ZIP64_VERSION
+            size_placeholder = self.ZIP64_MARKER
+        else:
+            extra = ''
+            version = self.VERSION
+            size_placeholder = 0
+        self.write_record(struct.pack('<IHHHHHIIIHH', self.LOCAL_HEADER_SIGNATURE, version, flags, 0,
+                                      dos_time, dos_date, 0, size_placeholder, size_placeholder,
+                                      len(archive_name), len(extra)) + archive_name + extra)
+        crc = 0
+        size = 0
+        while size < file_size:
+            chunk = file_handler.read(min(self._chunkSize, file_size - size))
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            self.write_record(chunk)
+            size += len(chunk)
+        crc &= 0xFFFFFFFF
+        if is_zip64 is True:
+            self.write_record(struct.pack('<IIQQ', self.DATA_DESCRIPTOR_SIGNATURE, crc, size, size))
+        else:
+            self.write_record(struct.pack('<IIII', self.DATA_DESCRIPTOR_SIGNATURE, crc, size, size))
+        self._entryList.append((archive_name, flags, dos_time, dos_date, crc, size, header_offset, is_zip64))
+
+    def write_central_directory_entry(self, entry):
+        archive_name, flags, dos_time, dos_date, crc, size, header_offset, is_zip64 = entry
+        zip64_field_list = []
+        if is_zip64 is True:
+            zip64_field_list += [size, size]
+            size = self.ZIP64_MARKER
+        if header_offset >= self.ZIP64_LIMIT:
+            zip64_field_list.append(header_offset)
+            header_offset = self.ZIP64_MARKER
+        extra = ''
+        version = self.VERSION
+        if len(zip64_field_list) > 0:
+            extra = struct.pack('<HH', self.ZIP64_EXTRA_ID, 8 * len(zip64_field_list)) + \
+                struct.pack('<{0}Q'.format(len(zip64_field_list)), *zip64_field_list)
+            version = self.ZIP64_VERSION
+        self.write_record(struct.pack('<IHHHHHHIIIHHHHHII', self.CENTRAL_HEADER_SIGNATURE,
+                                      (self.CREATOR_SYSTEM << 8) | version, version, flags, 0, dos_time, dos_date,
+                                      crc, size, size, len(archive_name), len(extra), 0, 0, 0,
+                                      self.FILE_MODE << 16, header_offset) + archive_name + extra)
+
+    def close(self):
+        """
+        Writes the central directory, which ends the archive.
+        """
+        directory_offset = self._offset
+        for entry in self._entryList:
+            self.write_central_directory_entry(entry)
+        directory_size = self._offset - directory_offset
+        entry_count = len(self._entryList)
+        if (entry_count >= self.ZIP64_COUNT_LIMIT) or (directory_offset >= self.ZIP64_LIMIT) or \
+                (directory_size >= self.ZIP64_LIMIT):
+            zip64_end_offset = self._offset
+            self.write_record(struct.pack('<IQHHIIQQQQ', self.ZIP64_END_SIGNATURE, 44,
+                                          (self.CREATOR_SYSTEM << 8) | self.ZIP64_VERSION, self.ZIP64_VERSION,
+                                          0, 0, entry_count, entry_count, directory_size, directory_offset))
+            self.write_record(struct.pack('<IIQI', self.ZIP64_LOCATOR_SIGNATURE, 0, zip64_end_offset, 1))
+            entry_count = self.ZIP64_COUNT_MARKER
+            directory_size = self.ZIP64_MARKER
+            directory_offset = self.ZIP64_MARKER
+        self.write_record(struct.pack('<IHHHHIIH', self.END_SIGNATURE, 0, 0, entry_count, entry_count,
+                                      directory_size, directory_offset, 0))
+        self._entryList = []
+
+# Server class
+
+
+class ThreadingHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    # Open event streams and long polls don't keep the interpreter from exiting
+    daemon_threads = True
+
+    def __init__(self, server_address, request_handler_class):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, request_handler_class)
+        self._lock = threading.Lock()
+        self._connectionCount = 0
+        self._parkedLongPollCount = 0
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self._connectionCount += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self._lock:
+            self._connectionCount -= 1
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def change_parked_long_poll_count(self, delta):
+        with self._lock:
+            self._parkedLongPollCount += delta
+
+    def get_connection_count(self):
+        return self._connectionCount
+
+    def get_parked_long_poll_count(self):
+        return self._parkedLongPollCount
 
 # HTTP Handler class
 
 
 class PhotoStreamHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
+    FILE_CHUNK_SIZE = 64 * 1024
+
+    # Requests to /data.json without new pictures wait for an update,
+    # unless the server has already parked them elsewhere
+    wait_for_image_list_update = True
+
+    EVENT_STREAM_HEARTBEAT_INTERVAL = 15.0
+    EVENT_STREAM_RETRY_INTERVAL = 2000
+
+    # Configuration keys of the folders, which /archive.zip takes the files of each kind from
+    ARCHIVE_FOLDER_KEYS = {'photo': 'PhotoFolder', 'thumb': 'ThumbnailFolder'}
+
+    @staticmethod
+    def get_image_list_update_delay(client_image_counter):
+        if client_image_counter > 0:
+            return 21.0
+        return 2.0
+
+    @staticmethod
+    def get_positive_integer_parameter(getvars, name):
+        try:
+            value = int(getvars[name][0])
+        except (KeyError, ValueError):
+            return None
+        if value <= 0:
+            return None
+        return value
+
+    @staticmethod
+    def get_revision_parameter(getvars):
+        """
+        Returns the revision parameter or None, if the client doesn't track
+        thumbnail updates. Other than counters, 0 is a valid revision.
+        """
+        try:
+            value = int(getvars['revision'][0])
+        except (KeyError, ValueError):
+            return None
+        if value < 0:
+            return None
+        return value
+
+    @staticmethod
+    def get_event_stream_counter(client_image_counter, last_event_id):
+        """
+        Returns the image counter to resume an event stream from. A reconnecting
+        EventSource sends the id of the last received event, which is the
+        image counter, and that wins over the count parameter of the URL.
+        """
+        if (last_event_id is not None) and last_event_id.strip().isdigit():
+            return int(last_event_id.strip())
+        return client_image_counter
+
+    @staticmethod
+    def create_server_sent_events(client_image_counter, client_camera_state, client_revision):
+        """
+        Returns the tuple (events, image_counter, camera_is_connected, revision),
+        where events contains the Server-Sent Events the client is missing, that is
+        a camera event if the camera state differs from client_camera_state, an
+        images event with all pictures newer than client_image_counter and an
+        updates event with the pictures, whose thumbnail or original has arrived
+        since client_revision. The pictures waiting for their original and those,
+        whose original has failed, are listed in both events. events is an empty string, if the client is up to date.
+        """
+        shared_photo_list = Application.shared_instance().get_phared_photo_list()
+        camera_is_connected = shared_photo_list.get_camera_is_connected()
+        image_counter, name_list = shared_photo_list.get_counter_and_photo_list_till(client_image_counter)
+        revision, updated_name_list = shared_photo_list.get_revision_and_updated_photo_list(client_revision)
+        pending_name_list = shared_photo_list.get_pending_original_list()
+        failed_name_list = shared_photo_list.get_failed_original_list()
+        events = ''
+        if camera_is_connected is not client_camera_state:
+            camera_data = json.dumps({'isCameraConnected': int(camera_is_connected)})
+            events += 'event: camera\ndata: {0}\n\n'.format(camera_data)
+        if len(name_list) > 0:
+            image_data = json.dumps({'imageCounter': image_counter, 'imageList': name_list,
+                                     'pendingImageList': pending_name_list,
+                                     'failedImageList': failed_name_list})
+            events += 'id: {0}\nevent: images\ndata: {1}\n\n'.format(image_counter, image_data)
+        else:
+            image_counter = client_image_counter
+        if len(updated_name_list) > 0:
+            update_data = json.dumps({'imageRevision': revision, 'updatedImageList': updated_name_list,
+                                      'pendingImageList': pending_name_list,
+                                      'failedImageList': failed_name_list})
+            events += 'event: updates\ndata: {0}\n\n'.format(update_data)
+        return events, image_counter, camera_is_connected, revision
+
     def do_POST(self):
         app = Application.shared_instance()
         config = app.get_config()
@@ -467,20 +2168,29 @@ class PhotoStreamHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         else:
             post_variables = {}
 
+        content_type = 'text/plain'
         try:
             # Connect hub API
             if path == '/connectHub.api':
                 hub_address = host
                 hub_port = post_variables['hubPort'][0]
                 hub_path = post_variables['hubPath'][0]
+                hub_scheme = post_variables.get('hubScheme', ['http'])[0]
 
                 hub_list = app.get_hub_list()
-                hub_list.add_hub(hub_address, hub_port, hub_path)
+                hub_list.add_hub(hub_address, hub_port, hub_path, hub_scheme == 'https')
 
-                data = "Established connection to hub"
-                "\"http://{0}:{1}{2}\"".format(hub_address, hub_port, hub_path)
+                data = "Established connection to hub " \
+                       "\"{0}://{1}:{2}{3}\"".format(hub_scheme, hub_address, hub_port, hub_path)
                 logger.log(Logger.LOG_LEVEL_INFO, data)
 
+            elif path == '/have.api':
+                # Batch query, which of the given hashes and names the session contains
+                shared_photo_list = app.get_phared_photo_list()
+                data = shared_photo_list.get_known_pictures_json(post_variables.get('hash', []),
+                                                                 post_variables.get('name', []))
+                content_type = 'text/x-json'
+
             elif path == '/shutdown.api':
                 client_address = host
                 command = post_variables['command'][0]
@@ -510,7 +2220,7 @@ class PhotoStreamHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
             self.send_response(200)
             self.send_header('Content-Length', '{0}'.format(len(data)))
-            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Type', content_type)
             self.send_header('Server', 'PictureStreamer')
             self.end_headers()
             self.wfile.write(data)
@@ -535,13 +2245,14 @@ class PhotoStreamHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         try:
             try:
                 client_image_counter = int(getvars['count'][0])
-            except KeyError:
+            except (KeyError, ValueError):
                 client_image_counter = 0
             requested_file_path = None
             requested_file_name = None
             requested_file_type = None
             data = None
             force_file_download = False
+            cache_control = 'no-cache'
             document_directory = 'ClientSideLib'
             if (path == '/') or (path == '/index.html'):
                 requested_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -569,72 +2280,862 @@ class PhotoStreamHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                                                    'jquery.js')
                 requested_file_type = 'text/javascript'
             elif path == '/data.json':
-                image_counter, name_list = shared_photo_list.get_counter_and_photo_list_till(client_image_counter)
-                if len(name_list) == 0:
-                    if client_image_counter > 0:
-                        delay = 21.0
-                    else:
-                        delay = 2.0
-                    notification_center = NotificationCenter.shared_instance()
-                    notification_center.wait_once_for_event_with_timeout(NOTIFY_IMAGELIST_UPDATE, delay)
+                # Optional paging: limit to the newest pictures, or to pictures older than before
+                limit = self.get_positive_integer_parameter(getvars, 'limit')
+                before_counter = self.get_positive_integer_parameter(getvars, 'before')
+                client_revision = self.get_revision_parameter(getvars)
+                notification_center = NotificationCenter.shared_instance()
+                generation = notification_center.get_generation(NOTIFY_IMAGELIST_UPDATE)
+                if (before_counter is None) and (self.wait_for_image_list_update is True) and \
+                        (shared_photo_list.has_news(client_image_counter, client_revision) is False):
+                    delay = self.get_image_list_update_delay(client_image_counter)
+                    self.server.change_parked_long_poll_count(1)
+                    try:
+                        notification_center.wait_for_event(NOTIFY_IMAGELIST_UPDATE, generation, delay)
+                    finally:
+                        self.server.change_parked_long_poll_count(-1)
                 requested_file_type = 'text/x-json'
-                connected = '0'
-                if shared_photo_list.get_camera_is_connected() is True:
-                    connected = '1'
-                image_counter, name_list = shared_photo_list.get_counter_and_photo_list_till(client_image_counter)
-                formatted_name_list = []
-                for name in name_list:
-                    formatted_name = '"{0}"'.format(name)
-                    formatted_name_list.append(formatted_name)
-                name_list_string = ', '.join(formatted_name_list)
-                data = '"isCameraConnected" : {0}, "imageCounter" : {1}, "imageList" : [ {2} ]'.format(connected,
-                                                                                                       image_counter,
-                                                                                                       name_list_string)
-                data = '{' + data + '}'
+                data = shared_photo_list.get_photo_list_json(client_image_counter, before_counter, limit,
+                                                             client_revision)
+            elif path == '/manifest.json':
+                # Pictures after the counter since, oldest first, clients page with the last counter received
+                limit = self.get_positive_integer_parameter(getvars, 'limit')
+                since_counter = self.get_positive_integer_parameter(getvars, 'since')
+                requested_file_type = 'text/x-json'
+                data = shared_photo_list.get_manifest_json(since_counter if since_counter is not None else 0, limit)
+            elif path == '/metrics':
+                requested_file_type = 'text/plain; version=0.0.4'
+                data = app.get_pipeline_metrics().get_prometheus_text()
+            elif path == '/events':
+                self.send_event_stream(client_image_counter,
+                                       self.get_revision_parameter(getvars))
+                return
+            elif path == '/archive.zip':
+                # The pictures after the counter since, kind selects the originals or the thumbnails
+                since_counter = self.get_positive_integer_parameter(getvars, 'since')
+                kind = getvars.get('kind', ['photo'])[0]
+                if kind not in self.ARCHIVE_FOLDER_KEYS:
+                    raise IOError
+                self.send_archive(since_counter if since_counter is not None else 0, kind)
+                return
             elif path.startswith('/thumb/'):
                 requested_file_type = 'image/jpeg'
                 requested_file_name = os.path.basename(path)
+                # A picture name never changes its content, unless its thumbnail is provisional
+                if shared_photo_list.is_provisional(requested_file_name) is False:
+                    cache_control = 'public, max-age=31536000, immutable'
                 requested_file_path = os.path.join(session_path, config.get('ThumbnailFolder'), requested_file_name)
+            elif path.startswith('/render/'):
+                # /render/<width>/<name>, renditions never change their content like thumbnails
+                path_components = path.split('/')
+                if (len(path_components) != 4) or not path_components[2].isdigit():
+                    raise IOError
+                requested_file_type = 'image/jpeg'
+                requested_file_name = os.path.basename(path)
+                requested_file_path = app.get_rendition_cache().get_rendition_path(int(path_components[2]),
+                                                                                   requested_file_name)
+                if requested_file_path is None:
+                    raise IOError
+                cache_control = 'public, max-age=31536000, immutable'
             elif path.startswith('/photo/'):
                 force_file_download = True
                 requested_file_type = 'image/jpeg'
                 requested_file_name = os.path.basename(path)
+                if EmbeddedPreviewReader.is_raw_file(requested_file_name):
+                    requested_file_type = 'application/octet-stream'
                 requested_file_path = os.path.join(session_path, config.get('PhotoFolder'), requested_file_name)
             if requested_file_path is not None:
-                f = open(requested_file_path)
-                data = f.read()
-                f.close()
-            elif data is None:
+                attachment_name = None
+                if force_file_download is True:
+                    attachment_name = requested_file_name
+                self.send_file(requested_file_path, requested_file_type, attachment_name, cache_control)
+                if path.startswith('/thumb/'):
+                    app.get_pipeline_metrics().record_timestamp(requested_file_name, PipelineMetrics.STAMP_FIRST_FETCH)
+            elif data is not None:
+                self.send_response(200)
+                self.send_header('Content-Length', '{0}'.format(len(data)))
+                self.send_header('Content-Type', requested_file_type)
+                self.send_header('Server', 'PictureStreamer')
+                self.end_headers()
+                self.wfile.write(data)
+            else:
                 raise IOError
-            self.send_response(200)
-            self.send_header('Content-Length', '{0}'.format(len(data)))
-            self.send_header('Content-Type', requested_file_type)
-            self.send_header('Server', 'PictureStreamer')
-            if force_file_download is True:
-                self.send_header('Content-Disposition', 'attachment;filename="{0}";'.format(requested_file_name))
-            self.end_headers()
-            self.wfile.write(data)
 
+        except socket.error:
+            # The client has gone away, while the response was sent
+            self.close_connection = 1
         except IOError:
             logger.log(Logger.LOG_LEVEL_INFO, 'HTTP ERROR 404: File Not Found: %s' % self.path)
             self.send_error(404, 'File Not Found: %s' % self.path)
 
+    def send_event_stream(self, client_image_counter, client_revision):
+        """
+        Pushes changes of the camera state and new pictures as Server-Sent
+        Events until the client disconnects. A comment line is sent as
+        heartbeat, if nothing has happened for EVENT_STREAM_HEARTBEAT_INTERVAL.
+        """
+        notification_center = NotificationCenter.shared_instance()
+        client_image_counter = self.get_event_stream_counter(client_image_counter,
+                                                             self.headers.getheader('last-event-id'))
+        client_camera_state = None
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Server', 'PictureStreamer')
+        self.end_headers()
+        self.wfile.flush()
+        try:
+            # Events go straight to the socket, so a vanished client
+            # doesn't leave them behind in the buffer of wfile
+            self.connection.sendall('retry: {0}\n\n'.format(self.EVENT_STREAM_RETRY_INTERVAL))
+            generation = notification_center.get_generation(NOTIFY_IMAGELIST_UPDATE)
+            while True:
+                events, client_image_counter, client_camera_state, client_revision = \
+                    self.create_server_sent_events(client_image_counter, client_camera_state, client_revision)
+                if events == '':
+                    events = ': heartbeat\n\n'
+                self.connection.sendall(events)
+                generation = notification_center.wait_for_event(NOTIFY_IMAGELIST_UPDATE,
+                                                                generation,
+                                                                self.EVENT_STREAM_HEARTBEAT_INTERVAL)
+        except socket.error:
+            # The client has gone away
+            return
+
+    def send_archive(self, since_counter, kind):
+        """
+        Streams the pictures with a counter greater than since_counter as ZIP
+        archive, oldest first. kind selects the originals or the thumbnails.
+        The pictures are selected, when the request arrives. X-Image-Counter
+        tells the client the counter to pass as since next time. Pictures
+        without file, like pending originals, and failed originals are left
+        out. The length of the archive isn't known in advance, so the end of
+        the response is marked by closing the connection.
+        """
+        app = Application.shared_instance()
+        shared_photo_list = app.get_phared_photo_list()
+        session_path = app.get_session_path()
+        folder_path = os.path.join(session_path, app.get_config().get(self.ARCHIVE_FOLDER_KEYS[kind]))
+        image_counter, name_list = shared_photo_list.get_counter_and_photo_list_till(since_counter)
+        name_list.reverse()
+        attachment_name = '{0}-{1}-{2}-{3}.zip'.format(os.path.basename(session_path), kind,
+                                                       since_counter + 1, image_counter)
+        self.close_connection = 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', 'attachment;filename="{0}";'.format(attachment_name))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Image-Counter', '{0}'.format(image_counter))
+        self.send_header('Server', 'PictureStreamer')
+        self.end_headers()
+        self.wfile.flush()
+        # Bypasses wfile like send_file_content, the archive goes straight to the socket
+        zip_writer = ZipStreamWriter(self.connection.sendall, self.FILE_CHUNK_SIZE)
+        for picture_name in name_list:
+            if (kind == 'photo') and shared_photo_list.is_original_failed(picture_name):
+                continue
+            try:
+                file_handler = open(os.path.join(folder_path, picture_name), 'rb')
+            except IOError:
+                continue
+            try:
+                file_status = os.fstat(file_handler.fileno())
+                zip_writer.add_file(picture_name, file_handler, file_status.st_size, file_status.st_mtime)
+            except socket.error:
+                raise
+            except (IOError, OSError) as error:
+                # The archive is broken already, the client sees it end too early
+                app.get_logger().log(Logger.LOG_LEVEL_ERROR,
+                                     'Archive aborted at "{0}": {1}'.format(picture_name, error))
+                return
+            finally:
+                file_handler.close()
+        zip_writer.close()
+
+    def send_file(self, file_path, content_type, attachment_name, cache_control):
+        """
+        Sends the file at file_path as response. Clients with a valid
+        cached copy get 304 Not Modified. A satisfiable single byte
+        range requested by the client is answered with 206 Partial Content,
+        so interrupted downloads can be resumed. If attachment_name is not
+        None, the client is asked to save the file under this name.
+        Raises IOError if the file can't be opened.
+        """
+        file_handler = open(file_path, 'rb')
+        try:
+            file_status = os.fstat(file_handler.fileno())
+            file_size = file_status.st_size
+            etag = self.create_etag(file_status)
+            last_modified = self.date_time_string(int(file_status.st_mtime))
+            if self.is_not_modified(etag, file_status.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.send_header('Cache-Control', cache_control)
+                self.send_header('Server', 'PictureStreamer')
+                self.end_headers()
+                return
+            try:
+                byte_range = self.get_requested_byte_range(file_size, etag, last_modified)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(file_size))
+                self.send_header('Content-Length', '0')
+                self.send_header('Server', 'PictureStreamer')
+                self.end_headers()
+                return
+            if byte_range is None:
+                first_byte = 0
+                last_byte = file_size - 1
+                self.send_response(200)
+            else:
+                first_byte, last_byte = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(first_byte, last_byte, file_size))
+            content_length = last_byte - first_byte + 1
+            self.send_header('Content-Length', '{0}'.format(content_length))
+            self.send_header('Content-Type', content_type)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Cache-Control', cache_control)
+            self.send_header('Server', 'PictureStreamer')
+            if attachment_name is not None:
+                self.send_header('Content-Disposition', 'attachment;filename="{0}";'.format(attachment_name))
+            self.end_headers()
+            self.send_file_content(file_handler, first_byte, content_length)
+        finally:
+            file_handler.close()
+
+    @staticmethod
+    def create_etag(file_status):
+        """
+        Returns a strong entity tag derived from size and modification time
+        of the file described by file_status.
+        """
+        return '"{0:x}-{1:x}"'.format(file_status.st_size, int(file_status.st_mtime * 1000000))
+
+    def is_not_modified(self, etag, modification_time):
+        """
+        Evaluates the If-None-Match and If-Modified-Since headers of the request.
+        Returns True if the copy cached by the client is still valid.
+        If-Modified-Since is only considered without If-None-Match.
+        """
+        if_none_match_header = self.headers.getheader('if-none-match')
+        if if_none_match_header is not None:
+            for client_etag in if_none_match_header.split(','):
+                client_etag = client_etag.strip()
+                if client_etag.startswith('W/'):
+                    client_etag = client_etag[2:]
+                if (client_etag == '*') or (client_etag == etag):
+                    return True
+            return False
+        if_modified_since_header = self.headers.getheader('if-modified-since')
+        if if_modified_since_header is not None:
+            date_tuple = email.utils.parsedate_tz(if_modified_since_header)
+            if date_tuple is not None:
+                return int(modification_time) <= email.utils.mktime_tz(date_tuple)
+        return False
+
+    def get_requested_byte_range(self, file_size, etag, last_modified):
+        """
+        Evaluates the Range and If-Range headers of the request.
+        Returns None if the whole file has to be sent, otherwise the
+        tuple (first_byte, last_byte) of the requested range.
+        Raises ValueError if the range can't be satisfied or if more
+        than one range has been requested.
+        """
+        range_header = self.headers.getheader('range')
+        if range_header is None:
+            return None
+        if_range_header = self.headers.getheader('if-range')
+        if (if_range_header is not None) and (if_range_header.strip() not in (etag, last_modified)):
+            return None
+        unit, separator, range_set = range_header.partition('=')
+        if (separator != '=') or (unit.strip().lower() != 'bytes'):
+            return None
+        range_list = [byte_range.strip() for byte_range in range_set.split(',') if byte_range.strip() != '']
+        if len(range_list) == 0:
+            return None
+        if len(range_list) > 1:
+            raise ValueError('Multiple ranges are not supported')
+        first, separator, last = range_list[0].partition('-')
+        first = first.strip()
+        last = last.strip()
+        if (separator != '-') or (first == last == ''):
+            return None
+        if ((first != '') and (not first.isdigit())) or ((last != '') and (not last.isdigit())):
+            return None
+        if first == '':
+            # Suffix range, addressing the last bytes of the file
+            suffix_length = int(last)
+            if suffix_length == 0:
+                raise ValueError('Empty suffix range')
+            first_byte = max(file_size - suffix_length, 0)
+            last_byte = file_size - 1
+        else:
+            first_byte = int(first)
+            last_byte = file_size - 1
+            if last != '':
+                if int(last) < first_byte:
+                    return None
+                last_byte = min(int(last), file_size - 1)
+        if first_byte >= file_size:
+            raise ValueError('Range starts beyond the end of the file')
+        return first_byte, last_byte
+
+    def send_file_content(self, file_handler, offset, length):
+        """
+        Streams length bytes starting at offset from file_handler to the client.
+        Plain sockets use sendfile, so the file content never enters Python
+        memory. SSL sockets have to encrypt in user space and get the content
+        in chunks of FILE_CHUNK_SIZE bytes instead. A client, which goes away
+        during the transfer, ends the response and closes the connection.
+        """
+        try:
+            self.wfile.flush()
+            if (sendfile is not None) and (not isinstance(self.connection, ssl.SSLSocket)):
+                socket_descriptor = self.connection.fileno()
+                file_descriptor = file_handler.fileno()
+                while length > 0:
+                    sent_bytes = sendfile(socket_descriptor, file_descriptor, offset, length)
+                    if sent_bytes == 0:
+                        break
+                    offset += sent_bytes
+                    length -= sent_bytes
+            else:
+                file_handler.seek(offset)
+                while length > 0:
+                    chunk = file_handler.read(min(length, self.FILE_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    # Bypasses wfile, which would keep the unsent rest of a broken transfer
+                    self.connection.sendall(chunk)
+                    length -= len(chunk)
+        except (OSError, socket.error) as error:
+            if error.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            self.close_connection = 1
+
+    def handle_one_request(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        except socket.error:
+            # The client has gone away, the rest of the response is dropped
+            self.close_connection = 1
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
     def log_message(self, message_format, *args):
         return
 
 
+# Asynchronous server classes
+
+
+class PrefixedRequestFile:
+    """
+    Read only file object, that returns the bytes of prefix first
+    and continues with the content of request_file afterwards.
+    """
+
+    def __init__(self, prefix, request_file):
+        self._prefix = StringIO.StringIO(prefix)
+        self._requestFile = request_file
+
+    def readline(self, size=-1):
+        line = self._prefix.readline(size)
+        if line.endswith('\n') or ((size >= 0) and (len(line) >= size)):
+            return line
+        if size >= 0:
+            size -= len(line)
+        return line + self._requestFile.readline(size)
+
+    def read(self, size=-1):
+        if size < 0:
+            return self._prefix.read() + self._requestFile.read()
+        data = self._prefix.read(size)
+        if len(data) < size:
+            data += self._requestFile.read(size - len(data))
+        return data
+
+    def close(self):
+        self._prefix.close()
+        self._requestFile.close()
+
+
+class AsyncPhotoStreamHttpHandler(PhotoStreamHttpHandler):
+    """
+    Handler for requests, whose head has already been read by the
+    event loop of AsyncHttpServer. The request is the tuple
+    (connection, request_head, wait_for_image_list_update).
+    """
+
+    def setup(self):
+        connection, request_head, self.wait_for_image_list_update = self.request
+        self.request = connection
+        PhotoStreamHttpHandler.setup(self)
+        self.rfile = PrefixedRequestFile(request_head, self.rfile)
+
+
+class WakeupPipe:
+    """
+    Event like object for the NotificationCenter, that makes a
+    pipe readable instead of waking up a waiting thread.
+    """
+
+    def __init__(self):
+        self._reader, self._writer = os.pipe()
+
+    def fileno(self):
+        return self._reader
+
+    def set(self):
+        os.write(self._writer, '.')
+
+    def clear(self):
+        os.read(self._reader, 4096)
+
+
+class AsyncHttpServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP server, that watches all connections in a single event loop
+    instead of spending a thread per connection. The loop accepts
+    connections, reads the request heads and parks requests to
+    /data.json without news until the image list gets updated or
+    the long poll times out. Event streams of /events are served by
+    the loop itself. All other requests are handed over to a fixed
+    number of worker threads running PhotoStreamHttpHandler. Downloads
+    of pictures, renditions, archives and static files get a pool of their own,
+    so slow downloads can't hold back the API requests.
+    """
+
+    REQUEST_HEAD_LIMIT = 65536
+    REQUEST_HEAD_TIMEOUT = 30.0
+
+    request_queue_size = socket.SOMAXCONN
+
+    KEY_CONNECTION = 'KEY_CONNECTION'
+    KEY_ADDRESS = 'KEY_ADDRESS'
+    KEY_HEAD = 'KEY_HEAD'
+    KEY_DEADLINE = 'KEY_DEADLINE'
+    KEY_STATE = 'KEY_STATE'
+    KEY_HANDSHAKE_DONE = 'KEY_HANDSHAKE_DONE'
+    KEY_IMAGE_COUNTER = 'KEY_IMAGE_COUNTER'
+    KEY_CAMERA_STATE = 'KEY_CAMERA_STATE'
+    KEY_IMAGE_REVISION = 'KEY_IMAGE_REVISION'
+
+    STATE_READING_HEAD = 'STATE_READING_HEAD'
+    STATE_PARKED = 'STATE_PARKED'
+    STATE_STREAMING = 'STATE_STREAMING'
+
+    DOWNLOAD_PATH_PREFIXES = ('/photo/', '/render/', '/thumb/', '/archive.zip')
+    STATIC_FILE_PATHS = ('/', '/index.html', '/favicon.png', '/index.css', '/index.js', '/jquery.js')
+
+    def __init__(self, server_address, ssl_cert_file_path, worker_count, download_worker_count):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, AsyncPhotoStreamHttpHandler)
+        self.socket.setblocking(0)
+        self._sslCertFilePath = ssl_cert_file_path
+        self._workerCount = worker_count
+        self._downloadWorkerCount = download_worker_count
+        self._jobQueue = Queue.Queue()
+        self._downloadQueue = Queue.Queue()
+        self._connectionDict = {}
+        self._poller = select.poll()
+        self._wakeupPipe = WakeupPipe()
+        self._busyWorkerLock = threading.Lock()
+        self._busyWorkerCount = 0
+
+    def serve_forever(self, poll_interval=0.5):
+        for job_queue, worker_count in ((self._jobQueue, self._workerCount),
+                                        (self._downloadQueue, self._downloadWorkerCount)):
+            for i in range(worker_count):
+                worker_thread = threading.Thread(target=self.work_queue, args=(job_queue,))
+                worker_thread.daemon = True
+                worker_thread.start()
+        NotificationCenter.shared_instance().assign_event_to_list(self._wakeupPipe, NOTIFY_IMAGELIST_UPDATE)
+        self._poller.register(self.socket, select.POLLIN)
+        self._poller.register(self._wakeupPipe, select.POLLIN)
+        while True:
+            try:
+                events = self._poller.poll(self.get_poll_timeout())
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for file_descriptor, event_mask in events:
+                if file_descriptor == self.socket.fileno():
+                    self.accept_connections()
+                elif file_descriptor == self._wakeupPipe.fileno():
+                    self._wakeupPipe.clear()
+                    self.handle_image_list_update()
+                elif file_descriptor in self._connectionDict:
+                    self.read_connection(file_descriptor)
+            self.handle_deadlines()
+
+    def get_poll_timeout(self):
+        """
+        Returns the milliseconds until the next connection deadline
+        or None, if there's no connection to watch.
+        """
+        if len(self._connectionDict) == 0:
+            return None
+        next_deadline = min(connection_dict[self.KEY_DEADLINE] for connection_dict in self._connectionDict.values())
+        return int(max(next_deadline - time.time(), 0) * 1000) + 1
+
+    def accept_connections(self):
+        while True:
+            try:
+                connection, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            connection.setblocking(0)
+            handshake_done = True
+            if self._sslCertFilePath != '':
+                connection = ssl.wrap_socket(connection,
+                                             certfile=self._sslCertFilePath,
+                                             server_side=True,
+                                             do_handshake_on_connect=False)
+                handshake_done = False
+            self._connectionDict[connection.fileno()] = {
+                self.KEY_CONNECTION: connection,
+                self.KEY_ADDRESS: client_address,
+                self.KEY_HEAD: '',
+                self.KEY_DEADLINE: time.time() + self.REQUEST_HEAD_TIMEOUT,
+                self.KEY_STATE: self.STATE_READING_HEAD,
+                self.KEY_HANDSHAKE_DONE: handshake_done}
+            self._poller.register(connection, select.POLLIN)
+
+    def read_connection(self, file_descriptor):
+        connection_dict = self._connectionDict[file_descriptor]
+        connection = connection_dict[self.KEY_CONNECTION]
+        try:
+            if connection_dict[self.KEY_HANDSHAKE_DONE] is False:
+                connection.do_handshake()
+                connection_dict[self.KEY_HANDSHAKE_DONE] = True
+                self._poller.modify(connection, select.POLLIN)
+            data = connection.recv(4096)
+            while (len(data) > 0) and isinstance(connection, ssl.SSLSocket) and (connection.pending() > 0):
+                data += connection.recv(connection.pending())
+        except ssl.SSLWantReadError:
+            self._poller.modify(connection, select.POLLIN)
+            return
+        except ssl.SSLWantWriteError:
+            self._poller.modify(connection, select.POLLOUT)
+            return
+        except socket.error:
+            data = ''
+        if (len(data) == 0) or (connection_dict[self.KEY_STATE] != self.STATE_READING_HEAD):
+            # The client has closed the connection or violates the protocol
+            self.close_connection(file_descriptor)
+            return
+        connection_dict[self.KEY_HEAD] += data
+        request_head = connection_dict[self.KEY_HEAD]
+        if '\r\n\r\n' in request_head or '\n\n' in request_head:
+            self.route_request(file_descriptor)
+        elif len(request_head) > self.REQUEST_HEAD_LIMIT:
+            self.close_connection(file_descriptor)
+
+    def route_request(self, file_descriptor):
+        connection_dict = self._connectionDict[file_descriptor]
+        request_line, header_lines = connection_dict[self.KEY_HEAD].split('\n', 1)
+        request_line = request_line.split()
+        if (len(request_line) < 2) or (request_line[0] != 'GET'):
+            self.dispatch_connection(file_descriptor)
+            return
+        scheme, netloc, path, params, query, fragment = urlparse.urlparse(request_line[1])
+        if path.startswith(self.DOWNLOAD_PATH_PREFIXES) or (path in self.STATIC_FILE_PATHS):
+            self.dispatch_connection(file_descriptor, self._downloadQueue)
+            return
+        if path not in ('/data.json', '/events'):
+            self.dispatch_connection(file_descriptor)
+            return
+        getvars = urlparse.parse_qs(query)
+        try:
+            client_image_counter = int(getvars['count'][0])
+        except (KeyError, ValueError):
+            client_image_counter = 0
+        client_revision = AsyncPhotoStreamHttpHandler.get_revision_parameter(getvars)
+        if path == '/events':
+            headers = mimetools.Message(StringIO.StringIO(header_lines), 0)
+            client_image_counter = AsyncPhotoStreamHttpHandler.get_event_stream_counter(
+                client_image_counter,
+                headers.getheader('last-event-id'))
+            self.start_event_stream(file_descriptor, client_image_counter, client_revision)
+            return
+        shared_photo_list = Application.shared_instance().get_phared_photo_list()
+        if shared_photo_list.has_news(client_image_counter, client_revision) or ('before' in getvars):
+            self.dispatch_connection(file_descriptor)
+            return
+        # Park the long poll until the image list gets updated or the delay is over
+        delay = AsyncPhotoStreamHttpHandler.get_image_list_update_delay(client_image_counter)
+        connection_dict[self.KEY_STATE] = self.STATE_PARKED
+        connection_dict[self.KEY_DEADLINE] = time.time() + delay
+
+    def start_event_stream(self, file_descriptor, client_image_counter, client_revision):
+        connection_dict = self._connectionDict[file_descriptor]
+        connection_dict[self.KEY_STATE] = self.STATE_STREAMING
+        connection_dict[self.KEY_IMAGE_COUNTER] = client_image_counter
+        connection_dict[self.KEY_CAMERA_STATE] = None
+        connection_dict[self.KEY_IMAGE_REVISION] = client_revision
+        head = 'HTTP/1.0 200 OK\r\n' + \
+               'Content-Type: text/event-stream\r\n' + \
+               'Cache-Control: no-cache\r\n' + \
+               'Server: PictureStreamer\r\n\r\n' + \
+               'retry: {0}\n\n'.format(AsyncPhotoStreamHttpHandler.EVENT_STREAM_RETRY_INTERVAL)
+        if self.send_to_stream(file_descriptor, head):
+            self.update_event_stream(file_descriptor)
+
+    def update_event_stream(self, file_descriptor):
+        connection_dict = self._connectionDict[file_descriptor]
+        events, image_counter, camera_is_connected, revision = AsyncPhotoStreamHttpHandler.create_server_sent_events(
+            connection_dict[self.KEY_IMAGE_COUNTER],
+            connection_dict[self.KEY_CAMERA_STATE],
+            connection_dict[self.KEY_IMAGE_REVISION])
+        connection_dict[self.KEY_IMAGE_COUNTER] = image_counter
+        connection_dict[self.KEY_CAMERA_STATE] = camera_is_connected
+        connection_dict[self.KEY_IMAGE_REVISION] = revision
+        connection_dict[self.KEY_DEADLINE] = time.time() + AsyncPhotoStreamHttpHandler.EVENT_STREAM_HEARTBEAT_INTERVAL
+        if events == '':
+            events = ': heartbeat\n\n'
+        self.send_to_stream(file_descriptor, events)
+
+    def send_to_stream(self, file_descriptor, data):
+        """
+        Writes data to an event stream without blocking the event loop.
+        Events are small, so a client, whose socket buffer can't take
+        them, is considered to be gone. It will reconnect and resume
+        with its last event id. Returns False, if the stream was closed.
+        """
+        connection = self._connectionDict[file_descriptor][self.KEY_CONNECTION]
+        try:
+            connection.sendall(data)
+        except socket.error:
+            self.close_connection(file_descriptor)
+            return False
+        return True
+
+    def handle_image_list_update(self):
+        for file_descriptor, connection_dict in self._connectionDict.items():
+            if connection_dict[self.KEY_STATE] == self.STATE_PARKED:
+                self.dispatch_connection(file_descriptor)
+            elif connection_dict[self.KEY_STATE] == self.STATE_STREAMING:
+                self.update_event_stream(file_descriptor)
+
+    def handle_deadlines(self):
+        now = time.time()
+        for file_descriptor, connection_dict in self._connectionDict.items():
+            if connection_dict[self.KEY_DEADLINE] > now:
+                continue
+            if connection_dict[self.KEY_STATE] == self.STATE_PARKED:
+                self.dispatch_connection(file_descriptor)
+            elif connection_dict[self.KEY_STATE] == self.STATE_STREAMING:
+                self.update_event_stream(file_descriptor)
+            else:
+                self.close_connection(file_descriptor)
+
+    def dispatch_connection(self, file_descriptor, job_queue=None):
+        connection_dict = self._connectionDict.pop(file_descriptor)
+        connection = connection_dict[self.KEY_CONNECTION]
+        self._poller.unregister(file_descriptor)
+        connection.setblocking(1)
+        request = (connection, connection_dict[self.KEY_HEAD], False)
+        if job_queue is None:
+            job_queue = self._jobQueue
+        job_queue.put((request, connection_dict[self.KEY_ADDRESS]))
+
+    def close_connection(self, file_descriptor):
+        connection_dict = self._connectionDict.pop(file_descriptor)
+        self._poller.unregister(file_descriptor)
+        connection_dict[self.KEY_CONNECTION].close()
+
+    def get_connection_count(self):
+        """
+        Returns the number of connections watched by the event loop or served by a worker.
+        """
+        return len(self._connectionDict) + self._busyWorkerCount
+
+    def get_parked_long_poll_count(self):
+        return len([connection_dict for connection_dict in self._connectionDict.values()
+                    if connection_dict[self.KEY_STATE] == self.STATE_PARKED])
+
+    def work_queue(self, job_queue):
+        while True:
+            request, client_address = job_queue.get()
+            with self._busyWorkerLock:
+                self._busyWorkerCount += 1
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request[0], client_address)
+            finally:
+                self.shutdown_request(request[0])
+                with self._busyWorkerLock:
+                    self._busyWorkerCount -= 1
+
+# Picture Metadata Journal class
+
+
+class PictureMetadataJournal:
+    """
+    Append-only log of the pictures of a session, kept in the session
+    folder as its index. The pictures are listed in the order they have
+    been added, with the size, modification time and content hash of their
+    original and the dimensions of pictures, whose thumbnail has been
+    created. Each record holds the picture name and the fields it sets,
+    so the index is written at ingest and read in one pass at startup.
+    The originals are hashed once and not on every start, an entry is only
+    trusted, while size and modification time of its picture are
+    unchanged. A lost line only causes the picture to be hashed or listed
+    again, so records are not synced. The log is compacted to one record
+    per picture, when it is loaded with more than twice as many records.
+    """
+
+    KEY_PICTURE = 'picture'
+    KEY_SIZE = 'size'
+    KEY_MODIFICATION_TIME = 'mtime'
+    KEY_HASH = 'hash'
+    KEY_HAS_THUMBNAIL = 'thumb'
+    KEY_WIDTH = 'width'
+    KEY_HEIGHT = 'height'
+
+    def __init__(self, journal_path):
+        self._journalPath = journal_path
+        self._lock = threading.Lock()
+        # Maps the picture names to the dicts of their fields, in the order they have been added
+        self._entryDict = collections.OrderedDict()
+        self.load()
+        self._fileHandler = open(self._journalPath, 'a')
+
+    def load(self):
+        record_count = 0
+        if os.path.isfile(self._journalPath):
+            with open(self._journalPath, 'r') as file_handler:
+                for line in file_handler:
+                    try:
+                        record = json.loads(line)
+                        entry = self._entryDict.setdefault(record.pop(self.KEY_PICTURE), {})
+                        entry.update(record)
+                        record_count += 1
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        continue
+        if record_count <= 2 * len(self._entryDict):
+            return
+        temporary_path = self._journalPath + '.tmp'
+        with open(temporary_path, 'w') as file_handler:
+            for picture_name, entry in self._entryDict.items():
+                file_handler.write(self.create_record(picture_name, entry) + '\n')
+            file_handler.flush()
+            os.fsync(file_handler.fileno())
+        os.rename(temporary_path, self._journalPath)
+
+    def create_record(self, picture_name, field_dict):
+        record = dict(field_dict)
+        record[self.KEY_PICTURE] = picture_name
+        return json.dumps(record)
+
+    def update_entry(self, picture_name, field_dict):
+        """
+        Records the fields of the picture, unless they are recorded already.
+        """
+        with self._lock:
+            is_known = picture_name in self._entryDict
+            entry = self._entryDict.setdefault(picture_name, {})
+            if (is_known is True) and all(entry.get(key) == value for key, value in field_dict.items()):
+                return
+            entry.update(field_dict)
+            self._fileHandler.write(self.create_record(picture_name, field_dict) + '\n')
+            self._fileHandler.flush()
+
+    def get_picture_list(self):
+        """
+        Returns the names of the recorded pictures in the order they have been added.
+        """
+        with self._lock:
+            picture_list = self._entryDict.keys()
+        return picture_list
+
+    def get_metadata(self, picture_name, file_size, modification_time):
+        """
+        Returns the recorded (size, modification time, content hash) of the
+        picture or None, if it is unknown or has changed since.
+        """
+        with self._lock:
+            entry = self._entryDict.get(picture_name, {})
+            metadata = entry.get(self.KEY_SIZE), entry.get(self.KEY_MODIFICATION_TIME), entry.get(self.KEY_HASH)
+        if (metadata[2] is None) or (metadata[0] != file_size) or (metadata[1] != modification_time):
+            return None
+        return metadata
+
+    def has_thumbnail(self, picture_name):
+        with self._lock:
+            has_thumbnail = self._entryDict.get(picture_name, {}).get(self.KEY_HAS_THUMBNAIL) is True
+        return has_thumbnail
+
+    def add_picture(self, picture_name):
+        self.update_entry(picture_name, {})
+
+    def add_metadata(self, picture_name, file_size, modification_time, content_hash):
+        self.update_entry(picture_name, {self.KEY_SIZE: file_size,
+                                         self.KEY_MODIFICATION_TIME: modification_time,
+                                         self.KEY_HASH: content_hash})
+
+    def set_thumbnail_created(self, picture_name, dimensions):
+        field_dict = {self.KEY_HAS_THUMBNAIL: True}
+        if dimensions is not None:
+            field_dict[self.KEY_WIDTH], field_dict[self.KEY_HEIGHT] = dimensions
+        self.update_entry(picture_name, field_dict)
+
 # Shared Photo List class
 
 class SharedPhotoList:
+    """
+    Append only list of picture names. The picture with counter n is
+    stored at index n - 1, so every query is a slice of the list.
+    Query results are ordered newest first. The JSON documents served
+    as /data.json are cached until the list or the camera state changes.
+    Pictures may be listed with a provisional thumbnail. Replacing it by
+    the final thumbnail appends the name to the update list, the length of
+    the update list is the revision clients pass to learn about replacements.
+    The widths of the renditions are listed for the srcset of the clients.
+    Pictures listed before their original has been downloaded are marked
+    as pending, the arrival of the original is recorded as update.
+    Pending pictures, whose original could not be downloaded, are marked
+    as failed instead, which is recorded as update as well.
+    The size, modification time and content hash of the originals are kept
+    for the manifest, which lets clients find the pictures they are missing.
+    New pictures and the metadata are recorded in the metadata_journal, if
+    one is given, the pictures of earlier runs are listed by add_pictures().
+    """
 
-    def __init__(self):
+    JSON_CACHE_SIZE = 64
+    HASH_ALGORITHM = 'sha256'
+
+    def __init__(self, rendition_width_list=(), metadata_journal=None):
         self._lock = threading.Lock()
+        self._metadataJournal = metadata_journal
+        self._renditionWidthList = list(rendition_width_list)
         self._photoList = []
-        self._counter = 0
+        self._provisionalSet = set()
+        self._pendingOriginalSet = set()
+        self._failedOriginalSet = set()
+        self._updateList = []
         self._cameraIsConnected = False
+        self._jsonCache = {}
+        # Maps the picture names to (size, modification time, content hash)
+        self._metadataDict = {}
+        self._hashDict = {}
 
     def set_camera_is_connected(self, is_connected):
         with self._lock:
+            if self._cameraIsConnected is not is_connected:
+                self._jsonCache.clear()
             self._cameraIsConnected = is_connected
 
     def get_camera_is_connected(self):
@@ -642,189 +3143,969 @@ class SharedPhotoList:
             is_connected = self._cameraIsConnected
         return is_connected
 
-    def add_picture(self, picture_name):
+    def add_picture(self, picture_name, is_provisional=False, is_original_pending=False):
         with self._lock:
-            self._photoList.insert(0, picture_name)
-            self._counter += 1
-            count = self._counter
+            self._photoList.append(picture_name)
+            if is_provisional is True:
+                self._provisionalSet.add(picture_name)
+            if is_original_pending is True:
+                self._pendingOriginalSet.add(picture_name)
+            self._jsonCache.clear()
+            count = len(self._photoList)
+        if self._metadataJournal is not None:
+            self._metadataJournal.add_picture(picture_name)
         return count
 
-    def get_counter(self):
+    def finalize_picture(self, picture_name):
+        """
+        Marks the thumbnail of a provisional picture as final.
+        Returns False, if the picture was not listed as provisional.
+        """
+        with self._lock:
+            if picture_name not in self._provisionalSet:
+                return False
+            self._provisionalSet.discard(picture_name)
+            self._updateList.append(picture_name)
+            self._jsonCache.clear()
+        return True
+
+    def set_provisional(self, picture_name):
+        """
+        Marks the thumbnail of a listed picture as provisional, while it is created again.
+        """
+        with self._lock:
+            self._provisionalSet.add(picture_name)
+
+    def set_original_available(self, picture_name):
+        """
+        Clears the pending mark of a picture, whose original has been downloaded.
+        Returns False, if the picture was not marked as pending.
+        """
+        with self._lock:
+            if picture_name not in self._pendingOriginalSet:
+                return False
+            self._pendingOriginalSet.discard(picture_name)
+            self._updateList.append(picture_name)
+            self._jsonCache.clear()
+        return True
+
+    def set_original_failed(self, picture_name, is_pending=True):
+        """
+        Marks a pending picture as failed, whose original could not be downloaded,
+        or with is_pending False a listed picture, whose original is broken.
+        Returns False, if the picture was not marked as pending or is marked as failed.
+        """
         with self._lock:
-            count = self._counter
+            if (is_pending is True) and (picture_name not in self._pendingOriginalSet):
+                return False
+            if picture_name in self._failedOriginalSet:
+                return False
+            self._pendingOriginalSet.discard(picture_name)
+            self._failedOriginalSet.add(picture_name)
+            self._updateList.append(picture_name)
+            self._jsonCache.clear()
+        return True
+
+    def set_picture_metadata(self, picture_name, file_size, modification_time, content_hash):
+        with self._lock:
+            self._metadataDict[picture_name] = (file_size, modification_time, content_hash)
+            self._hashDict[content_hash] = picture_name
+        if self._metadataJournal is not None:
+            self._metadataJournal.add_metadata(picture_name, file_size, modification_time, content_hash)
+
+    def has_picture_metadata(self, picture_name):
+        with self._lock:
+            has_metadata = picture_name in self._metadataDict
+        return has_metadata
+
+    def get_manifest_json(self, limiting_counter, limit=None):
+        """
+        Returns the /manifest.json document with the pictures with a counter
+        greater than limiting_counter, oldest first and at most limit of
+        them. Size, modification time and hash are null, until the original
+        has been downloaded and hashed.
+        """
+        with self._lock:
+            count = len(self._photoList)
+            first_index = min(max(limiting_counter, 0), count)
+            last_index = count
+            if limit is not None:
+                last_index = min(first_index + limit, count)
+            image_list = []
+            for index in range(first_index, last_index):
+                picture_name = self._photoList[index]
+                file_size, modification_time, content_hash = self._metadataDict.get(picture_name,
+                                                                                     (None, None, None))
+                image_list.append({'counter': index + 1,
+                                   'name': picture_name,
+                                   'size': file_size,
+                                   'mtime': modification_time,
+                                   'hash': content_hash})
+        return json.dumps({'imageCounter': count,
+                           'hashAlgorithm': self.HASH_ALGORITHM,
+                           'imageList': image_list})
+
+    def get_known_pictures_json(self, content_hash_list, picture_name_list):
+        """
+        Returns the /have.api document with the pictures of the session,
+        which match one of the given hashes or names.
+        """
+        with self._lock:
+            name_set = set(self._hashDict[content_hash] for content_hash in content_hash_list
+                           if content_hash in self._hashDict)
+            name_set.update(picture_name for picture_name in picture_name_list if picture_name in self._metadataDict)
+            image_list = []
+            for picture_name in sorted(name_set):
+                file_size, modification_time, content_hash = self._metadataDict[picture_name]
+                image_list.append({'name': picture_name,
+                                   'size': file_size,
+                                   'hash': content_hash})
+            count = len(self._photoList)
+        return json.dumps({'imageCounter': count,
+                           'hashAlgorithm': self.HASH_ALGORITHM,
+                           'imageList': image_list})
+
+    def get_pending_original_list(self):
+        with self._lock:
+            result = sorted(self._pendingOriginalSet)
+        return result
+
+    def get_failed_original_list(self):
+        with self._lock:
+            result = sorted(self._failedOriginalSet)
+        return result
+
+    def is_original_failed(self, picture_name):
+        with self._lock:
+            is_original_failed = picture_name in self._failedOriginalSet
+        return is_original_failed
+
+    def is_provisional(self, picture_name):
+        with self._lock:
+            is_provisional = picture_name in self._provisionalSet
+        return is_provisional
+
+    def is_original_pending(self, picture_name):
+        with self._lock:
+            is_original_pending = picture_name in self._pendingOriginalSet
+        return is_original_pending
+
+    def has_news(self, limiting_counter, limiting_revision):
+        """
+        Returns True, if there are pictures newer than limiting_counter or
+        thumbnail updates after limiting_revision. limiting_revision may be None.
+        """
+        with self._lock:
+            if len(self._photoList) > limiting_counter:
+                return True
+            if (limiting_revision is not None) and (len(self._updateList) > limiting_revision):
+                return True
+        return False
+
+    def get_revision_and_updated_photo_list(self, limiting_revision):
+        """
+        Returns the current revision and the names of the pictures updated after
+        limiting_revision. If limiting_revision is None, the list is empty.
+        """
+        with self._lock:
+            revision = len(self._updateList)
+            if limiting_revision is None:
+                return revision, []
+            result = self._updateList[min(limiting_revision, revision):]
+        return revision, result
+
+    def add_pictures(self, picture_name_list):
+        with self._lock:
+            self._photoList.extend(picture_name_list)
+            self._jsonCache.clear()
+            count = len(self._photoList)
         return count
 
-    def get_counter_and_photo_list_limeted_to(self, limit):
+    def get_counter(self):
         with self._lock:
-            result = []
-            count = 0
-            for fileName in self._photoList:
-                if count >= limit:
-                    break
-                result.append(fileName)
-                count += 1
-            count = self._counter
-        return count, result
+            count = len(self._photoList)
+        return count
+
+    def get_photo_list_slice(self, limiting_counter, before_counter, limit):
+        """
+        Returns the tuple (first_index, last_index) of the pictures with a counter
+        greater than limiting_counter and less than before_counter, reduced to
+        the newest limit pictures. before_counter and limit may be None.
+        Must be called with the lock held.
+        """
+        last_index = len(self._photoList)
+        if before_counter is not None:
+            last_index = min(max(before_counter - 1, 0), last_index)
+        first_index = min(max(limiting_counter, 0), last_index)
+        if limit is not None:
+            first_index = max(first_index, last_index - limit)
+        return first_index, last_index
 
     def get_counter_and_photo_list_till(self, limiting_counter):
         with self._lock:
-            result = []
-            count = self._counter
-            for fileName in self._photoList:
-                if count <= limiting_counter:
-                    break
-                result.append(fileName)
-                count -= 1
-            count = self._counter
+            count = len(self._photoList)
+            result = self._photoList[max(limiting_counter, 0):]
+        result.reverse()
         return count, result
 
+    def get_photo_list_json(self, limiting_counter, before_counter=None, limit=None, limiting_revision=None):
+        """
+        Returns the /data.json document with the camera state, the current
+        counter and the pictures selected like in get_photo_list_slice.
+        oldestImageCounter is the counter of the oldest listed picture, clients
+        pass it as before to page to older pictures. It is null for empty lists.
+        updatedImageList contains the pictures updated after limiting_revision.
+        """
+        cache_key = (limiting_counter, before_counter, limit, limiting_revision)
+        with self._lock:
+            data = self._jsonCache.get(cache_key)
+            if data is None:
+                first_index, last_index = self.get_photo_list_slice(limiting_counter, before_counter, limit)
+                name_list = self._photoList[first_index:last_index]
+                name_list.reverse()
+                oldest_image_counter = None
+                if len(name_list) > 0:
+                    oldest_image_counter = first_index + 1
+                updated_name_list = []
+                if limiting_revision is not None:
+                    updated_name_list = self._updateList[min(limiting_revision, len(self._updateList)):]
+                data = json.dumps({'isCameraConnected': int(self._cameraIsConnected),
+                                   'imageCounter': len(self._photoList),
+                                   'oldestImageCounter': oldest_image_counter,
+                                   'imageList': name_list,
+                                   'imageRevision': len(self._updateList),
+                                   'updatedImageList': updated_name_list,
+                                   'pendingImageList': sorted(self._pendingOriginalSet),
+                                   'failedImageList': sorted(self._failedOriginalSet),
+                                   'renditionWidthList': self._renditionWidthList})
+                if len(self._jsonCache) >= self.JSON_CACHE_SIZE:
+                    self._jsonCache.clear()
+                self._jsonCache[cache_key] = data
+        return data
+
+# Rendition Cache class
+
+
+class RenditionCache:
+    """
+    Disk cache of the renditions served as /render/<width>/<name>. A rendition
+    is created by a priority job of the thumbnail worker pool on its first
+    request, which takes turns with the thumbnails of new pictures.
+    Concurrent requests for it wait for that single job. The least
+    recently used renditions are removed, when the cache exceeds size_limit,
+    except for pinned renditions, which are being uploaded to a hub.
+    """
+
+    def __init__(self, worker_pool, width_list, size_limit):
+        app = Application.shared_instance()
+        self._config = app.get_config()
+        self._logger = app.get_logger()
+        self._sessionPath = app.get_session_path()
+        self._renditionPath = os.path.join(self._sessionPath, self._config.get('RenditionFolder'))
+        self._workerPool = worker_pool
+        self._widthList = width_list
+        self._sizeLimit = size_limit
+        self._lock = threading.Lock()
+        # Maps the paths of the cached renditions to their sizes, least recently used first
+        self._fileDict = collections.OrderedDict()
+        self._cacheSize = 0
+        self._pendingDict = {}
+        # Maps the paths of the pinned renditions to their pin counts
+        self._pinDict = {}
+        self.load_cached_renditions()
+
+    def load_cached_renditions(self):
+        file_list = []
+        for width in self._widthList:
+            folder = os.path.join(self._renditionPath, str(width))
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            for file_name in os.listdir(folder):
+                file_path = os.path.join(folder, file_name)
+                if file_name.endswith('.tmp'):
+                    # Left behind by an interrupted job
+                    os.remove(file_path)
+                    continue
+                file_stat = os.stat(file_path)
+                file_list.append((file_stat.st_mtime, file_path, file_stat.st_size))
+        file_list.sort()
+        with self._lock:
+            for modification_time, file_path, file_size in file_list:
+                self._fileDict[file_path] = file_size
+                self._cacheSize += file_size
+            self.remove_least_recently_used_renditions()
+
+    def remove_least_recently_used_renditions(self):
+        """
+        Must be called with the lock held.
+        """
+        # The most recently used rendition is kept, it has just been returned
+        for file_path in self._fileDict.keys()[:-1]:
+            if self._cacheSize <= self._sizeLimit:
+                break
+            if file_path in self._pinDict:
+                continue
+            self._cacheSize -= self._fileDict.pop(file_path)
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def pin_rendition(self, rendition_path):
+        """
+        Must be called with the lock held.
+        """
+        self._pinDict[rendition_path] = self._pinDict.get(rendition_path, 0) + 1
+
+    def unpin_rendition(self, rendition_path):
+        with self._lock:
+            pin_count = self._pinDict.pop(rendition_path) - 1
+            if pin_count > 0:
+                self._pinDict[rendition_path] = pin_count
+            else:
+                self.remove_least_recently_used_renditions()
+
+    def get_rendition_path(self, width, picture_name, is_priority=True, is_pinned=False):
+        """
+        Returns the path of the rendition with the given width, creating it
+        if necessary, or None, if the width is not offered or the picture
+        cannot be read. The rendition is created by a priority job, unless
+        is_priority is False. With is_pinned, the rendition is not removed,
+        until unpin_rendition() is called with its path.
+        """
+        if width not in self._widthList:
+            return None
+        picture_path = os.path.join(self._sessionPath, self._config.get('PhotoFolder'), picture_name)
+        rendition_path = os.path.join(self._renditionPath, str(width), picture_name)
+        with self._lock:
+            if rendition_path in self._fileDict:
+                self._fileDict[rendition_path] = self._fileDict.pop(rendition_path)
+                if is_pinned is True:
+                    self.pin_rendition(rendition_path)
+                return rendition_path
+            pending_event = self._pendingDict.get(rendition_path)
+            is_creating_rendition = pending_event is None
+            if is_creating_rendition is True:
+                pending_event = threading.Event()
+                self._pendingDict[rendition_path] = pending_event
+        if is_creating_rendition is False:
+            pending_event.wait()
+            with self._lock:
+                if rendition_path in self._fileDict:
+                    if is_pinned is True:
+                        self.pin_rendition(rendition_path)
+                    return rendition_path
+            return None
+        success = False
+        if os.path.isfile(picture_path):
+            job_dict = {ThumbnailCreationProcess.JOB_KEY_PICTURE_NAME: picture_name,
+                        ThumbnailCreationProcess.JOB_KEY_PICTURE_PATH: picture_path,
+                        ThumbnailCreationProcess.JOB_KEY_THUMBNAIL_PATH: rendition_path,
+                        ThumbnailCreationProcess.JOB_KEY_RENDITION_WIDTH: width,
+                        ThumbnailCreationProcess.JOB_KEY_PREVIEW_PATH:
+                        Application.shared_instance().get_preview_path(picture_name)}
+            result_dict = self._workerPool.run_job(job_dict, is_priority)
+            success = result_dict[ThumbnailCreationProcess.RESULT_KEY_SUCCESS]
+        with self._lock:
+            del self._pendingDict[rendition_path]
+            if success is True:
+                file_size = os.path.getsize(rendition_path)
+                self._fileDict[rendition_path] = file_size
+                self._cacheSize += file_size
+                if is_pinned is True:
+                    self.pin_rendition(rendition_path)
+                self.remove_least_recently_used_renditions()
+        pending_event.set()
+        if success is False:
+            self._logger.log(Logger.LOG_LEVEL_ERROR,
+                             'Could not create rendition of "{0}" with width {1}'.format(picture_name, width))
+            return None
+        return rendition_path
+
 # Hub List class
 
 
+class HubConnectionPool:
+    """
+    Persistent HTTP/1.1 connections to a hub, which are reused by all
+    uploads to it, over HTTPS if use_https is set. A request body is a
+    list of strings and (path, size) elements, the files are streamed in
+    chunks of CHUNK_SIZE bytes. The hub may have closed an idle connection
+    meanwhile, so a request on a reused connection, which fails before its
+    response has arrived, is repeated on a new connection.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    TIMEOUT = 60
+
+    def __init__(self, host, port, use_https=False, ssl_context=None):
+        self._host = host
+        self._port = port
+        self._useHttps = use_https
+        self._sslContext = ssl_context
+        self._lock = threading.Lock()
+        self._idleConnectionList = []
+
+    def get_url(self, selector):
+        scheme = 'https' if self._useHttps is True else 'http'
+        return '{0}://{1}:{2}{3}'.format(scheme, self._host, self._port, selector)
+
+    def create_connection(self):
+        if self._useHttps is True:
+            return httplib.HTTPSConnection(self._host, self._port, timeout=self.TIMEOUT, context=self._sslContext)
+        return httplib.HTTPConnection(self._host, self._port, timeout=self.TIMEOUT)
+
+    def get_connection(self):
+        """
+        Returns an idle connection or a new one and whether it is reused.
+        """
+        with self._lock:
+            if len(self._idleConnectionList) > 0:
+                return self._idleConnectionList.pop(), True
+        return self.create_connection(), False
+
+    def close(self):
+        with self._lock:
+            for connection in self._idleConnectionList:
+                connection.close()
+            del self._idleConnectionList[:]
+
+    @classmethod
+    def iterate_body(cls, part_list):
+        """
+        Yields the body made of part_list in chunks of at most CHUNK_SIZE
+        bytes, reading the files as it goes.
+        """
+        for part in part_list:
+            if not isinstance(part, tuple):
+                yield part
+                continue
+            path, size = part
+            with open(path, 'rb') as file_handler:
+                remaining_size = size
+                while remaining_size > 0:
+                    chunk = file_handler.read(min(remaining_size, cls.CHUNK_SIZE))
+                    if chunk == '':
+                        raise IOError('"{0}" has been truncated during the upload'.format(path))
+                    remaining_size -= len(chunk)
+                    yield chunk
+
+    def request(self, method, selector, header_dict, part_list, limit_bandwidth=None):
+        """
+        Sends a request with the body made of part_list, calling
+        limit_bandwidth with the size of each chunk before it is sent.
+        Returns (status, reason, headers, content) of the response.
+        Raises IOError or httplib.HTTPException, if the request failed.
+        """
+        while True:
+            connection, is_reused = self.get_connection()
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    # The body is sent in several writes, which must not wait for delayed ACKs
+                    connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                connection.putrequest(method, selector, skip_accept_encoding=True)
+                for header_name, header_value in header_dict.items():
+                    connection.putheader(header_name, header_value)
+                connection.endheaders()
+                for chunk in self.iterate_body(part_list):
+                    if limit_bandwidth is not None:
+                        limit_bandwidth(len(chunk))
+                    connection.send(chunk)
+                response = connection.getresponse()
+                content = response.read()
+            except socket.timeout:
+                connection.close()
+                raise
+            except (socket.error, httplib.BadStatusLine):
+                connection.close()
+                if is_reused is True:
+                    # Closed by the hub while it was idle
+                    continue
+                raise
+            except:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                with self._lock:
+                    self._idleConnectionList.append(connection)
+            return response.status, response.reason, response.getheaders(), content
+
+
+class HubUploadScheduler:
+    """
+    Orders the uploads to a hub. The thumbnails and renditions of all pending
+    pictures are sent before any original, the newest picture first. Up to
+    worker_count uploads run at once, but originals may only occupy all
+    but one of them, so a new thumbnail never waits behind a large file.
+    The upload rate of all workers together is limited to bandwidth_limit
+    bytes per second, unless it is 0.
+    """
+
+    ASSET_THUMBNAIL = 0
+    ASSET_RENDITION = 1
+    ASSET_PHOTO = 2
+
+    def __init__(self, worker_count, bandwidth_limit):
+        self._workerCount = worker_count
+        self._bandwidthLimit = bandwidth_limit
+        self._condition = threading.Condition()
+        self._smallAssetHeap = []
+        self._photoHeap = []
+        self._photoUploadCount = 0
+        self._wakeGeneration = 0
+        self._bandwidthLock = threading.Lock()
+        self._nextSendTime = 0.0
+
+    def add_picture(self, sequence_number, picture_name, asset_list):
+        with self._condition:
+            for asset in asset_list:
+                if asset == self.ASSET_PHOTO:
+                    heapq.heappush(self._photoHeap, (-sequence_number, asset, picture_name))
+                else:
+                    heapq.heappush(self._smallAssetHeap, (asset, -sequence_number, picture_name))
+            self._condition.notify_all()
+
+    def get_job(self):
+        """
+        Blocks until an upload may start, returns (asset, picture_name).
+        """
+        photo_upload_limit = max(self._workerCount - 1, 1)
+        with self._condition:
+            while True:
+                if len(self._smallAssetHeap) > 0:
+                    asset, negative_sequence_number, picture_name = heapq.heappop(self._smallAssetHeap)
+                    return asset, picture_name
+                if (len(self._photoHeap) > 0) and (self._photoUploadCount < photo_upload_limit):
+                    negative_sequence_number, asset, picture_name = heapq.heappop(self._photoHeap)
+                    self._photoUploadCount += 1
+                    return asset, picture_name
+                self._condition.wait()
+
+    def finish_job(self, asset):
+        with self._condition:
+            if asset == self.ASSET_PHOTO:
+                self._photoUploadCount -= 1
+                self._condition.notify_all()
+
+    def get_queue_length(self):
+        with self._condition:
+            queue_length = len(self._smallAssetHeap) + len(self._photoHeap)
+        return queue_length
+
+    def wait_for_retry(self, delay):
+        """
+        Sleeps for delay seconds or until wake() is called.
+        Returns True, if it has been woken.
+        """
+        with self._condition:
+            wake_generation = self._wakeGeneration
+            end_time = time.time() + delay
+            while self._wakeGeneration == wake_generation:
+                remaining_time = end_time - time.time()
+                if remaining_time <= 0:
+                    return False
+                self._condition.wait(remaining_time)
+        return True
+
+    def wake(self):
+        """
+        Ends the waits for a retry, when the hub has connected again.
+        """
+        with self._condition:
+            self._wakeGeneration += 1
+            self._condition.notify_all()
+
+    def limit_bandwidth(self, byte_count):
+        """
+        Called for every chunk sent, sleeps as long as the chunk takes
+        at the bandwidth limit.
+        """
+        if self._bandwidthLimit == 0:
+            return
+        with self._bandwidthLock:
+            now = time.time()
+            send_time = max(self._nextSendTime, now)
+            self._nextSendTime = send_time + float(byte_count) / self._bandwidthLimit
+        if send_time > now:
+            time.sleep(send_time - now)
+
+
+class HubUploadJournal:
+    """
+    Append-only log of the uploads to the hubs, kept in the session folder.
+    Uploads are recorded when they are queued and when they are done, so
+    the queued and in-flight uploads of every hub survive a restart and
+    are resumed, when the hub connects again. Queued uploads are synced to
+    disk, a lost done record only causes the upload to be repeated. A line
+    cut off by a crash is ignored, the log is compacted to the known hubs
+    and their pending uploads, when it is loaded and whenever it has grown
+    by COMPACTION_RECORD_COUNT records beyond twice its compacted size.
+    """
+
+    KEY_HUB = 'hub'
+    KEY_PICTURE = 'picture'
+    KEY_ASSET = 'asset'
+    KEY_SEQUENCE_NUMBER = 'sequence'
+    KEY_STATE = 'state'
+
+    STATE_CONNECTED = 'connected'
+    STATE_QUEUED = 'queued'
+    STATE_DONE = 'done'
+
+    COMPACTION_RECORD_COUNT = 4096
+
+    def __init__(self, journal_path):
+        self._journalPath = journal_path
+        self._lock = threading.Lock()
+        # Maps the hub addresses to their pending uploads, keyed by (picture name, asset)
+        self._pendingDict = {}
+        self._nextSequenceNumber = 0
+        self._fileHandler = None
+        self._recordCount = 0
+        self._compactedRecordCount = 0
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self._journalPath):
+            with open(self._journalPath, 'r') as file_handler:
+                for line in file_handler:
+                    try:
+                        record = json.loads(line)
+                        self.apply_record(record)
+                    except (ValueError, KeyError):
+                        continue
+        self.compact()
+
+    def compact(self):
+        """
+        Rewrites the log with the known hubs and their pending uploads.
+        Must be called with the lock held.
+        """
+        record_list = []
+        for hub_address, pending_upload_dict in sorted(self._pendingDict.items()):
+            record_list.append({self.KEY_HUB: hub_address, self.KEY_STATE: self.STATE_CONNECTED})
+            for (picture_name, asset), sequence_number in pending_upload_dict.items():
+                record_list.append({self.KEY_HUB: hub_address,
+                                    self.KEY_PICTURE: picture_name,
+                                    self.KEY_ASSET: asset,
+                                    self.KEY_SEQUENCE_NUMBER: sequence_number,
+                                    self.KEY_STATE: self.STATE_QUEUED})
+        temporary_path = self._journalPath + '.tmp'
+        with open(temporary_path, 'w') as file_handler:
+            for record in record_list:
+                file_handler.write(json.dumps(record) + '\n')
+            file_handler.flush()
+            os.fsync(file_handler.fileno())
+        os.rename(temporary_path, self._journalPath)
+        if self._fileHandler is not None:
+            self._fileHandler.close()
+        self._fileHandler = open(self._journalPath, 'a')
+        self._recordCount = len(record_list)
+        self._compactedRecordCount = len(record_list)
+
+    def apply_record(self, record):
+        hub_address = record[self.KEY_HUB]
+        pending_upload_dict = self._pendingDict.setdefault(hub_address, collections.OrderedDict())
+        state = record[self.KEY_STATE]
+        if state == self.STATE_QUEUED:
+            sequence_number = record[self.KEY_SEQUENCE_NUMBER]
+            pending_upload_dict[(record[self.KEY_PICTURE], record[self.KEY_ASSET])] = sequence_number
+            self._nextSequenceNumber = max(self._nextSequenceNumber, sequence_number + 1)
+        elif state == self.STATE_DONE:
+            pending_upload_dict.pop((record[self.KEY_PICTURE], record[self.KEY_ASSET]), None)
+
+    def write_records(self, record_list, sync):
+        """
+        Must be called with the lock held.
+        """
+        for record in record_list:
+            self.apply_record(record)
+        self._fileHandler.write(''.join(json.dumps(record) + '\n' for record in record_list))
+        self._fileHandler.flush()
+        if sync is True:
+            os.fsync(self._fileHandler.fileno())
+        self._recordCount += len(record_list)
+        if self._recordCount >= 2 * self._compactedRecordCount + self.COMPACTION_RECORD_COUNT:
+            self.compact()
+
+    def get_next_sequence_number(self):
+        with self._lock:
+            sequence_number = self._nextSequenceNumber
+        return sequence_number
+
+    def get_hub_list(self):
+        with self._lock:
+            hub_list = self._pendingDict.keys()
+        return hub_list
+
+    def get_pending_upload_list(self, hub_address):
+        """
+        Returns the pending uploads of the hub as (sequence_number, picture_name, asset) elements.
+        """
+        with self._lock:
+            pending_upload_dict = self._pendingDict.get(hub_address, {})
+            pending_upload_list = [(sequence_number, picture_name, asset)
+                                   for (picture_name, asset), sequence_number in pending_upload_dict.items()]
+        return pending_upload_list
+
+    def add_hub(self, hub_address):
+        with self._lock:
+            if hub_address not in self._pendingDict:
+                self.write_records([{self.KEY_HUB: hub_address, self.KEY_STATE: self.STATE_CONNECTED}], True)
+
+    def add_uploads(self, hub_address_list, sequence_number, picture_name, asset_list):
+        with self._lock:
+            self.write_records([{self.KEY_HUB: hub_address,
+                                 self.KEY_PICTURE: picture_name,
+                                 self.KEY_ASSET: asset,
+                                 self.KEY_SEQUENCE_NUMBER: sequence_number,
+                                 self.KEY_STATE: self.STATE_QUEUED}
+                                for hub_address in hub_address_list
+                                for asset in asset_list], True)
+
+    def finish_upload(self, hub_address, picture_name, asset):
+        with self._lock:
+            self.write_records([{self.KEY_HUB: hub_address,
+                                 self.KEY_PICTURE: picture_name,
+                                 self.KEY_ASSET: asset,
+                                 self.KEY_STATE: self.STATE_DONE}], False)
+
+
 class HubList:
 
     KEY_PORT = 'KEY_PORT'
     KEY_PATH = 'KEY_PATH'
-    KEY_QUEUE = 'KEY_QUEUE'
-    KEY_THREAD = 'KEY_THREAD'
+    KEY_SCHEDULER = 'KEY_SCHEDULER'
+    KEY_THREAD_LIST = 'KEY_THREAD_LIST'
+    KEY_USE_HTTPS = 'KEY_USE_HTTPS'
+    KEY_CONNECTION_POOL = 'KEY_CONNECTION_POOL'
+
+    FIELD_NAME_DICT = {HubUploadScheduler.ASSET_THUMBNAIL: 'thumb',
+                       HubUploadScheduler.ASSET_RENDITION: 'rendition',
+                       HubUploadScheduler.ASSET_PHOTO: 'photo'}
+
+    # Time stamps recorded, when a hub has accepted an asset, the first hub counts
+    METRICS_STAMP_DICT = {HubUploadScheduler.ASSET_THUMBNAIL: PipelineMetrics.STAMP_HUB_THUMBNAIL,
+                          HubUploadScheduler.ASSET_PHOTO: PipelineMetrics.STAMP_HUB_PHOTO}
+
+    RETRY_DELAY_MIN = 1
+    RETRY_DELAY_MAX = 300
+    # Client errors, after which the upload may succeed when repeated
+    RETRY_STATUS_LIST = (408, 429)
 
     def __init__(self):
         app = Application.shared_instance()
         self._config = app.get_config()
         self._logger = app.get_logger()
+        self._metrics = app.get_pipeline_metrics()
         self._sessionPath = app.get_session_path()
         self._lock = threading.Lock()
         self._hubDict = {}
-        self._queueList = []
+        self._journal = HubUploadJournal(os.path.join(self._sessionPath, self._config.get('HubJournalFile')))
+        self._nextSequenceNumber = self._journal.get_next_sequence_number()
+        self._assetList = [HubUploadScheduler.ASSET_THUMBNAIL]
+        if (self._config.get('HubRenditionUpload') is True) and (len(self._config.get('RenditionWidthList')) > 0):
+            self._assetList.append(HubUploadScheduler.ASSET_RENDITION)
+        self._assetList.append(HubUploadScheduler.ASSET_PHOTO)
 
     def add_picture_for_upload(self, target_file_name):
         with self._lock:
-            for uploadQueue in self._queueList:
-                uploadQueue.put(target_file_name)
+            sequence_number = self._nextSequenceNumber
+            self._nextSequenceNumber += 1
+            # Hubs known from the journal get the picture once they connect again
+            hub_address_list = self._journal.get_hub_list()
+            if len(hub_address_list) > 0:
+                self._journal.add_uploads(hub_address_list, sequence_number, target_file_name, self._assetList)
+            for hub_dict in self._hubDict.values():
+                hub_dict[self.KEY_SCHEDULER].add_picture(sequence_number, target_file_name, self._assetList)
+
+    def get_upload_queue_length_dict(self):
+        """
+        Returns the number of uploads waiting for each hub by its address.
+        """
+        with self._lock:
+            return dict((hub_address, hub_dict[self.KEY_SCHEDULER].get_queue_length())
+                        for hub_address, hub_dict in self._hubDict.items())
+
+    def create_connection_pool(self, hub_address, hub_port, use_https):
+        ssl_context = None
+        if use_https is True:
+            ca_file_path = self._config.get('HubCAFilePath')
+            ssl_context = ssl.create_default_context(cafile=ca_file_path if ca_file_path != '' else None)
+        return HubConnectionPool(hub_address, hub_port, use_https, ssl_context)
 
-    def add_hub(self, hub_address, hub_port, hub_path):
+    def add_hub(self, hub_address, hub_port, hub_path, use_https=False):
         with self._lock:
             if hub_address in self._hubDict.keys():
-                self._hubDict[hub_address][self.KEY_PORT] = hub_port
-                self._hubDict[hub_address][self.KEY_PATH] = hub_path
+                hub_dict = self._hubDict[hub_address]
+                if (hub_dict[self.KEY_PORT] != hub_port) or (hub_dict[self.KEY_USE_HTTPS] is not use_https):
+                    hub_dict[self.KEY_CONNECTION_POOL].close()
+                    hub_dict[self.KEY_CONNECTION_POOL] = self.create_connection_pool(hub_address, hub_port,
+                                                                                     use_https)
+                hub_dict[self.KEY_PORT] = hub_port
+                hub_dict[self.KEY_PATH] = hub_path
+                hub_dict[self.KEY_USE_HTTPS] = use_https
+                hub_dict[self.KEY_SCHEDULER].wake()
             else:
-                upload_queue = Queue.Queue()
-                worker_thread = threading.Thread(
-                    target=self.work_queue,
-                    args=(hub_address, 1))
-                worker_thread.daemon = True
-                self._hubDict[hub_address] = {
+                worker_count = self._config.get('HubUploadWorkerCount')
+                scheduler = HubUploadScheduler(worker_count, self._config.get('HubBandwidthLimit') * 1024)
+                self._journal.add_hub(hub_address)
+                pending_upload_list = self._journal.get_pending_upload_list(hub_address)
+                for sequence_number, picture_name, asset in pending_upload_list:
+                    scheduler.add_picture(sequence_number, picture_name, [asset])
+                if len(pending_upload_list) > 0:
+                    self._logger.log(Logger.LOG_LEVEL_INFO, 'Resuming {0} uploads to hub {1}'.format(
+                        len(pending_upload_list), hub_address))
+                hub_dict = {
                     self.KEY_PORT: hub_port,
                     self.KEY_PATH: hub_path,
-                    self.KEY_QUEUE: upload_queue,
-                    self.KEY_THREAD: worker_thread}
-                worker_thread.start()
-                self._queueList.append(upload_queue)
+                    self.KEY_USE_HTTPS: use_https,
+                    self.KEY_CONNECTION_POOL: self.create_connection_pool(hub_address, hub_port, use_https),
+                    self.KEY_SCHEDULER: scheduler,
+                    self.KEY_THREAD_LIST: []}
+                self._hubDict[hub_address] = hub_dict
+                for worker_index in range(worker_count):
+                    worker_thread = threading.Thread(
+                        target=self.work_queue,
+                        args=(hub_address, scheduler))
+                    worker_thread.daemon = True
+                    hub_dict[self.KEY_THREAD_LIST].append(worker_thread)
+                    worker_thread.start()
 
-    def work_queue(self, hub_address, nonsense):
-        with self._lock:
-            queue = self._hubDict[hub_address][self.KEY_QUEUE]
-        hub_is_offline = False
+    def work_queue(self, hub_address, scheduler):
         while True:
-            target_file_name = queue.get()
-            sleep_time = 0
-            while not self.upload_picture_to_hub(target_file_name, hub_address):
-                print('Could not upload file', target_file_name, 'to hub', hub_address)
-                sleep_time += 5
-                time.sleep(sleep_time)
-                if sleep_time > 60:
-                    hub_is_offline = True
-                    break
-            queue.task_done()
-            if hub_is_offline is True:
-                print('Hub', hub_address, 'is not reachable, deleting connection')
-                with self._lock:
-                    del self._hubDict[hub_address]
-                break
+            asset, target_file_name = scheduler.get_job()
+            retry_delay = self.RETRY_DELAY_MIN
+            while not self.upload_picture_to_hub(target_file_name, hub_address, asset, scheduler):
+                self._logger.log(Logger.LOG_LEVEL_WARN, 'Could not upload {0} of "{1}" to hub {2}, '
+                                 'retrying in {3}s'.format(self.FIELD_NAME_DICT[asset], target_file_name,
+                                                           hub_address, retry_delay))
+                if scheduler.wait_for_retry(retry_delay) is True:
+                    # The hub has connected again
+                    retry_delay = self.RETRY_DELAY_MIN
+                else:
+                    retry_delay = min(retry_delay * 2, self.RETRY_DELAY_MAX)
+            self._journal.finish_upload(hub_address, target_file_name, asset)
+            scheduler.finish_job(asset)
 
-    def upload_picture_to_hub(self, target_file_name, hub_address):
-        with self._lock:
-            port = self._hubDict[hub_address][self.KEY_PORT]
-            path = self._hubDict[hub_address][self.KEY_PATH]
+    def get_asset_path(self, target_file_name, asset):
+        """
+        Returns the path of the file to upload for asset or None, if it
+        is not available. A rendition is created by a normal job, so the
+        uploads don't hold back the renditions requested by clients, and
+        is pinned in the cache, until release_asset_path() is called.
+        """
+        if asset == HubUploadScheduler.ASSET_THUMBNAIL:
+            return os.path.join(self._sessionPath, self._config.get('ThumbnailFolder'), target_file_name)
+        if asset == HubUploadScheduler.ASSET_RENDITION:
+            rendition_width = min(self._config.get('RenditionWidthList'))
+            return Application.shared_instance().get_rendition_cache().get_rendition_path(rendition_width,
+                                                                                           target_file_name,
+                                                                                           is_priority=False,
+                                                                                           is_pinned=True)
+        return os.path.join(self._sessionPath, self._config.get('PhotoFolder'), target_file_name)
 
-        print 'Uploading', target_file_name, 'to', hub_address, ':', port, path
+    def release_asset_path(self, asset_path, asset):
+        if (asset == HubUploadScheduler.ASSET_RENDITION) and (asset_path is not None):
+            Application.shared_instance().get_rendition_cache().unpin_rendition(asset_path)
 
-        thumbnail_path = os.path.join(self._sessionPath, self._config.get('ThumbnailFolder'), target_file_name)
-        thumb_field_name = 'thumb'
-        thumb_file_name = target_file_name
-        try:
-            file_handler = open(thumbnail_path, 'rb')
-            thumb_value = file_handler.read()
-            file_handler.close()
-        except:
-            raise
+    def upload_picture_to_hub(self, target_file_name, hub_address, asset, scheduler):
+        with self._lock:
+            hub_dict = self._hubDict[hub_address]
+            path = hub_dict[self.KEY_PATH]
+            connection_pool = hub_dict[self.KEY_CONNECTION_POOL]
+
+        field_name = self.FIELD_NAME_DICT[asset]
+        self._logger.log(Logger.LOG_LEVEL_INFO, 'Uploading {0} of "{1}" to {2}'.format(
+            field_name, target_file_name, connection_pool.get_url(path)))
 
-        photo_path = os.path.join(self._sessionPath, self._config.get('PhotoFolder'), target_file_name)
-        photo_field_name = 'photo'
-        photo_file_name = target_file_name
+        asset_path = self.get_asset_path(target_file_name, asset)
         try:
-            file_handler = open(photo_path, 'rb')
-            photo_value = file_handler.read()
-            file_handler.close()
-        except:
-            raise
+            if (asset_path is None) or not os.path.isfile(asset_path):
+                # Retrying won't help, the upload is given up
+                self._logger.log(Logger.LOG_LEVEL_ERROR, 'Cannot upload {0} of "{1}", the file is missing'.format(
+                    field_name, target_file_name))
+                return True
 
-        fields = (('Filed1', 'Value1'),
-                  ('Filed1', 'Value2'))
-        files = ((thumb_field_name, thumb_file_name, thumb_value),
-                 (photo_field_name, photo_file_name, photo_value))
-        errcode, errmsg, headers, content = self.post_multipart_form(hub_address, port, path, fields, files)
-        print errcode, errmsg, headers, content
-        return True
+            fields = (('Filed1', 'Value1'),
+                      ('Filed1', 'Value2'))
+            files = ((field_name, target_file_name, asset_path),)
+            errcode, errmsg, headers, content = self.post_multipart_form(connection_pool, path, fields, files,
+                                                                         scheduler.limit_bandwidth)
+        finally:
+            self.release_asset_path(asset_path, asset)
+        if errcode is None:
+            return False
+        # Only a 2xx status means, that the hub has accepted the picture
+        if 200 <= errcode < 300:
+            self._logger.log(Logger.LOG_LEVEL_INFO, 'Hub {0} has accepted {1} of "{2}" ({3} {4})'.format(
+                hub_address, field_name, target_file_name, errcode, errmsg))
+            if asset in self.METRICS_STAMP_DICT:
+                self._metrics.record_timestamp(target_file_name, self.METRICS_STAMP_DICT[asset])
+            return True
+        if (400 <= errcode < 500) and (errcode not in self.RETRY_STATUS_LIST):
+            # Retrying won't help, the upload is given up
+            self._logger.log(Logger.LOG_LEVEL_ERROR, 'Hub {0} has refused {1} of "{2}" ({3} {4}): {5}'.format(
+                hub_address, field_name, target_file_name, errcode, errmsg, content))
+            return True
+        self._logger.log(Logger.LOG_LEVEL_WARN, 'Hub {0} has not accepted {1} of "{2}" ({3} {4})'.format(
+            hub_address, field_name, target_file_name, errcode, errmsg))
+        return False
 
-    def post_multipart_form(self, host, port, selector, fields, files):
+    def post_multipart_form(self, connection_pool, selector, fields, files, limit_bandwidth=None):
         """
-        Post fields and files to an http host as multipart/form-data.
+        Post fields and files to a hub as multipart/form-data.
         fields is a sequence of (name, value) elements for regular form fields.
-        files is a sequence of (name, filename, value) elements
-        for data to be uploaded as files
+        files is a sequence of (name, filename, path) elements
+        for files to be uploaded, which are streamed from disk
+        limit_bandwidth is called with the size of every chunk sent
         Return the server's response page.
         """
         try:
-            content_type, body = self.encode_multipart_formdata(fields, files)
-            http_object = httplib.HTTP(host, port)
-            http_object.putrequest('POST', selector)
-            http_object.putheader('Content-Type', content_type)
-            http_object.putheader('Content-Length', str(len(body)))
-            http_object.endheaders()
-            http_object.send(body)
-            errcode, errmsg, headers = http_object.getreply()
-            content = http_object.file.read()
-        except IOError:
+            content_type, part_list, content_length = self.encode_multipart_formdata(fields, files)
+            header_dict = {'Content-Type': content_type,
+                           'Content-Length': str(content_length)}
+            errcode, errmsg, headers, content = connection_pool.request('POST', selector, header_dict, part_list,
+                                                                        limit_bandwidth)
+        except (IOError, OSError, httplib.HTTPException):
             errcode, errmsg, headers, content = None, None, None, None
         return errcode, errmsg, headers, content
 
     def encode_multipart_formdata(self, fields, files):
         """
         fields is a sequence of (name, value) elements for regular form fields.
-        files is a sequence of (name, filename, value) elements for data to be
-        uploaded as files
-        Return (content_type, body) ready for httplib.HTTP instance
+        files is a sequence of (name, filename, path) elements for files to be
+        uploaded
+        Return (content_type, part_list, content_length), part_list holds the
+        strings of the body and a (path, size) element for each file
         """
         boundary = '----------ThIs_Is_tHe_bouNdaRY_$'
         crlf = '\r\n'
+        part_list = []
         body_list_of_lines = []
         for (key, value) in fields:
             body_list_of_lines.append('--' + boundary)
             body_list_of_lines.append('Content-Disposition: form-data; name="%s"' % key)
             body_list_of_lines.append('')
             body_list_of_lines.append(value)
-        for (key, filename, value) in files:
+        for (key, filename, path) in files:
             body_list_of_lines.append('--' + boundary)
             body_list_of_lines.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename))
             body_list_of_lines.append('Content-Type: %s' % 'application/octet-stream')
             body_list_of_lines.append('')
-            body_list_of_lines.append(value)
+            # The file takes the place of its value line
+            part_list.append(crlf.join(body_list_of_lines) + crlf)
+            part_list.append((path, os.path.getsize(path)))
+            body_list_of_lines = ['']
         body_list_of_lines.append('--' + boundary + '--')
         body_list_of_lines.append('')
-        body = crlf.join(body_list_of_lines)
+        part_list.append(crlf.join(body_list_of_lines))
+        content_length = sum(part[1] if isinstance(part, tuple) else len(part) for part in part_list)
         content_type = 'multipart/form-data; boundary=%s' % boundary
-        return content_type, body
+        return content_type, part_list, content_length
 
 # Teathering class
 
@@ -837,6 +4118,8 @@ class TetheringThread(threading.Thread):
         self._config = app.get_config()
         self._logger = app.get_logger()
         self._picture_list = app.get_phared_photo_list()
+        self._metadata_journal = app.get_metadata_journal()
+        self._metrics = app.get_pipeline_metrics()
         self._sessionPath = app.get_session_path()
         self._hubList = app.get_hub_list()
         self._notificationCenter = NotificationCenter.shared_instance()
@@ -844,55 +4127,240 @@ class TetheringThread(threading.Thread):
         self._tethering_result_queue = multiprocessing.Queue()
         self._tethering_process = None
         # Thumbnail creation
-        self._thumb_creator_job_queue = multiprocessing.Queue()
-        self._thumb_creator_result_queue = multiprocessing.Queue()
-        self._thumb_creator_process = None
+        worker_count = self._config.get('ThumbnailWorkerCount')
+        if worker_count == 0:
+            worker_count = multiprocessing.cpu_count()
+        # Created before the processes are started, so they share its memory
+        self._shared_buffer = None
+        if self._config.get('SharedBufferSize') > 0:
+            self._shared_buffer = SharedPictureBuffer(self._config.get('SharedBufferSize') * 1024 * 1024)
+        self._shared_slot_dict = {}
+        self._unwritten_picture_set = set()
+        # Pictures created from memory, whose original could not be written
+        self._failed_picture_set = set()
+        self._shared_lock = threading.Lock()
+        self._thumb_creator_pool = ThumbnailWorkerPool(self._logger,
+                                                       worker_count,
+                                                       self._config.get('ThumbnailQueueSize'),
+                                                       self._config.get('ThumbnailNewestFirst'),
+                                                       self._config.get('ThumbnailExifPreview'),
+                                                       self._shared_buffer)
         self._thumb_creator_result_receiver = None
 
+    def get_thumbnail_worker_pool(self):
+        return self._thumb_creator_pool
+
+    def create_tethering_process(self, process_class):
+        photo_path = os.path.join(self._sessionPath, self._config.get('PhotoFolder'))
+        thumbnail_path = os.path.join(self._sessionPath, self._config.get('ThumbnailFolder'))
+        counter = self._picture_list.get_counter()
+        return process_class(self._tethering_result_queue, photo_path, counter,
+                             thumbnail_path=thumbnail_path,
+                             preview_first=self._config.get('PreviewFirstIngest'),
+                             writer_count=self._config.get('IngestWriterCount'),
+                             write_queue_size=self._config.get('IngestQueueSize'),
+                             use_fsync=self._config.get('IngestFsync'),
+                             shared_buffer=self._shared_buffer)
+
     def tethering_watchdog(self):
         while True:
             if not self._tethering_process.is_alive():
                 self._logger.log(Logger.LOG_LEVEL_WARN, "Tethering process has crashed, restarting it")
-                photo_path = os.path.join(self._sessionPath, self._config.get('PhotoFolder'))
-                counter = self._picture_list.get_counter()
-                self._tethering_process = TetheringProcess(self._tethering_result_queue, photo_path, counter)
+                self._tethering_process = self.create_tethering_process(TetheringProcess)
                 self._tethering_process.start()
             time.sleep(5)
 
     def receive_thumb_creator_result(self):
         while True:
-            result_dict = self._thumb_creator_result_queue.get()
+            result_dict = self._thumb_creator_pool.get_result()
             picture_name = result_dict[ThumbnailCreationProcess.RESULT_KEY_PICTURE_NAME]
             success = result_dict[ThumbnailCreationProcess.RESULT_KEY_SUCCESS]
+            if result_dict[ThumbnailCreationProcess.RESULT_KEY_IS_PROVISIONAL] is True:
+                if self._picture_list.is_provisional(picture_name) is True:
+                    # Already listed with the preview from the camera
+                    continue
+                with self._shared_lock:
+                    if picture_name in self._failed_picture_set:
+                        continue
+                    self._picture_list.add_picture(picture_name, True,
+                                                   picture_name in self._unwritten_picture_set)
+                self._metrics.record_timestamp(picture_name, PipelineMetrics.STAMP_LISTED)
+                self._logger.log(Logger.LOG_LEVEL_INFO, 'Using embedded thumnail of "{0}"'.format(picture_name))
+                self._notificationCenter.fire_event(NOTIFY_IMAGELIST_UPDATE)
+                continue
+            retry_from_disk = False
+            is_ready_for_upload = False
+            with self._shared_lock:
+                shared_slot = self._shared_slot_dict.pop(picture_name, None)
+                if shared_slot is not None:
+                    self._shared_buffer.release(shared_slot)
+                original_has_failed = picture_name in self._failed_picture_set
+                self._failed_picture_set.discard(picture_name)
+                if success is True:
+                    self._logger.log(Logger.LOG_LEVEL_INFO, 'Created thumnail of "{0}"'.format(picture_name))
+                    if (self._picture_list.finalize_picture(picture_name) is False) and (original_has_failed is False):
+                        # Created from memory, the picture may not be written yet
+                        self._picture_list.add_picture(picture_name, False,
+                                                       picture_name in self._unwritten_picture_set)
+                    is_ready_for_upload = (not self._picture_list.is_original_pending(picture_name)) and \
+                                          (not self._picture_list.is_original_failed(picture_name)) and \
+                                          (original_has_failed is False)
+                elif (shared_slot is not None) and (original_has_failed is False):
+                    # Retried from disk, right now or once the picture has been written
+                    retry_from_disk = picture_name not in self._unwritten_picture_set
+                    self._unwritten_picture_set.discard(picture_name)
             if success is True:
-                self._logger.log(Logger.LOG_LEVEL_INFO, 'Created thumnail of "{0}"'.format(picture_name))
-                self._picture_list.add_picture(picture_name)
+                self._metrics.record_timestamps(picture_name,
+                                                result_dict[ThumbnailCreationProcess.RESULT_KEY_STAGE_TIMES])
+                if original_has_failed is False:
+                    self._metrics.record_timestamp(picture_name, PipelineMetrics.STAMP_LISTED)
+                self._metadata_journal.set_thumbnail_created(
+                    picture_name, result_dict[ThumbnailCreationProcess.RESULT_KEY_DIMENSIONS])
                 self._notificationCenter.fire_event(NOTIFY_IMAGELIST_UPDATE)
+                if is_ready_for_upload is True:
+                    self._hubList.add_picture_for_upload(picture_name)
             else:
                 self._logger.log(Logger.LOG_LEVEL_ERROR, 'Could not create thumbnail of "{0}"'.format(picture_name))
+                if retry_from_disk is True:
+                    self.process_picture(picture_name)
+
+    def handle_failed_picture(self, picture_name):
+        self._logger.log(Logger.LOG_LEVEL_ERROR, 'Could not download picture "{0}"'.format(picture_name))
+        with self._shared_lock:
+            self._unwritten_picture_set.discard(picture_name)
+            if picture_name in self._shared_slot_dict:
+                # Its thumbnail is still created from memory, it isn't listed unless its preview was
+                self._failed_picture_set.add(picture_name)
+            else:
+                # The preview from the camera remains its thumbnail
+                self._picture_list.finalize_picture(picture_name)
+            is_listed = self._picture_list.set_original_failed(picture_name)
+        if is_listed is True:
+            self._notificationCenter.fire_event(NOTIFY_IMAGELIST_UPDATE)
+
+    def handle_downloaded_picture(self, result_dict):
+        picture_name = result_dict[TetheringProcess.RESULT_KEY_PICTUE]
+        if picture_name is None:
+            return
+        if result_dict.get(TetheringProcess.RESULT_KEY_FAILED) is True:
+            self.handle_failed_picture(picture_name)
+            return
+        stage_times = result_dict.get(TetheringProcess.RESULT_KEY_STAGE_TIMES, {})
+        self._metrics.record_timestamps(picture_name, stage_times)
+        if result_dict.get(TetheringProcess.RESULT_KEY_IS_PREVIEW) is True:
+            source_file_path = result_dict[TetheringProcess.RESULT_KEY_SOURCE_PATH]
+            self._logger.log(Logger.LOG_LEVEL_INFO, 'New file "{0}" on camera'.format(source_file_path))
+            self._logger.log(Logger.LOG_LEVEL_INFO, 'Downloaded preview of picture "{0}"'.format(picture_name))
+            # Listed with the preview as thumbnail, until the picture has been downloaded
+            self._picture_list.add_picture(picture_name, True, True)
+            self._metrics.record_timestamp(picture_name, PipelineMetrics.STAMP_LISTED)
+            self._notificationCenter.fire_event(NOTIFY_IMAGELIST_UPDATE)
+            return
+        shared_slot = result_dict.get(TetheringProcess.RESULT_KEY_SHARED_SLOT)
+        if shared_slot is not None:
+            self._logger.log(Logger.LOG_LEVEL_INFO, 'Creating thumbnail of "{0}" from memory'.format(picture_name))
+            with self._shared_lock:
+                self._shared_buffer.register(shared_slot)
+                self._shared_slot_dict[picture_name] = shared_slot
+                self._unwritten_picture_set.add(picture_name)
+            self.process_picture(picture_name, shared_slot)
+            return
+        with self._shared_lock:
+            was_unwritten = picture_name in self._unwritten_picture_set
+            self._unwritten_picture_set.discard(picture_name)
+            original_was_pending = self._picture_list.set_original_available(picture_name)
+            # Uploaded once both the final thumbnail and the original exist
+            is_ready_for_upload = original_was_pending and not self._picture_list.is_provisional(picture_name)
+        if original_was_pending is True:
+            self._notificationCenter.fire_event(NOTIFY_IMAGELIST_UPDATE)
+            if is_ready_for_upload is True:
+                self._hubList.add_picture_for_upload(picture_name)
+        elif was_unwritten is False:
+            source_file_path = result_dict[TetheringProcess.RESULT_KEY_SOURCE_PATH]
+            self._logger.log(Logger.LOG_LEVEL_INFO, 'New file "{0}" on camera'.format(source_file_path))
+        self._picture_list.set_picture_metadata(picture_name,
+                                                result_dict[TetheringProcess.RESULT_KEY_FILE_SIZE],
+                                                result_dict[TetheringProcess.RESULT_KEY_MODIFICATION_TIME],
+                                                result_dict[TetheringProcess.RESULT_KEY_CONTENT_HASH])
+        self._logger.log(Logger.LOG_LEVEL_INFO,
+                         'Downloaded picture "{0}" (download {1:.3f}s, queued {2:.3f}s, write {3:.3f}s, '
+                         'hash {4:.3f}s)'.format(
+                             picture_name,
+                             PipelineMetrics.get_stage_duration(stage_times, PipelineMetrics.STAGE_DOWNLOAD),
+                             PipelineMetrics.get_stage_duration(stage_times, PipelineMetrics.STAGE_WRITE_QUEUE),
+                             PipelineMetrics.get_stage_duration(stage_times, PipelineMetrics.STAGE_WRITE),
+                             PipelineMetrics.get_stage_duration(stage_times, PipelineMetrics.STAGE_HASH)))
+        if was_unwritten is False:
+            self.process_picture(picture_name)
 
-    def process_picture(self, picture_name):
+    def create_thumbnail_job(self, picture_name, shared_slot=None):
         picture_path = os.path.join(self._sessionPath,
                                     self._config.get('PhotoFolder'),
                                     picture_name)
         thumbnail_path = os.path.join(self._sessionPath,
                                       self._config.get('ThumbnailFolder'),
                                       picture_name)
-        job_dict = {ThumbnailCreationProcess.JOB_KEY_PICTURE_NAME: picture_name,
-                    ThumbnailCreationProcess.JOB_KEY_PICTURE_PATH: picture_path,
-                    ThumbnailCreationProcess.JOB_KEY_THUMBNAIL_PATH: thumbnail_path}
-        self._thumb_creator_job_queue.put(job_dict)
+        return {ThumbnailCreationProcess.JOB_KEY_PICTURE_NAME: picture_name,
+                ThumbnailCreationProcess.JOB_KEY_PICTURE_PATH: picture_path,
+                ThumbnailCreationProcess.JOB_KEY_THUMBNAIL_PATH: thumbnail_path,
+                ThumbnailCreationProcess.JOB_KEY_PREVIEW_PATH:
+                Application.shared_instance().get_preview_path(picture_name),
+                ThumbnailCreationProcess.JOB_KEY_SHARED_SLOT: shared_slot}
 
-    def run_in_demo_mode(self):
+    def process_picture(self, picture_name, shared_slot=None):
+        self._thumb_creator_pool.add_job(self.create_thumbnail_job(picture_name, shared_slot))
+
+    @staticmethod
+    def is_complete_picture(picture_path):
+        if EmbeddedPreviewReader.is_raw_file(picture_path):
+            # Only the embedded preview of a RAW picture is read
+            return os.path.isfile(picture_path) and (os.path.getsize(picture_path) > 0)
+        return EmbeddedPreviewReader.is_complete_jpeg(picture_path)
+
+    def repair_existing_pictures(self):
+        """
+        Creates the missing, empty or truncated thumbnails of the pictures of
+        earlier runs again, newest first, by background jobs, which only run
+        while no thumbnail of a new picture is waiting. Pictures with an
+        empty or truncated original are marked as failed.
+        """
+        photo_path = os.path.join(self._sessionPath, self._config.get('PhotoFolder'))
+        thumbnail_path = os.path.join(self._sessionPath, self._config.get('ThumbnailFolder'))
+        repair_count = 0
+        for picture_name in reversed(Application.shared_instance().get_existing_picture_list()):
+            if self.is_complete_picture(os.path.join(photo_path, picture_name)) is False:
+                self._logger.log(Logger.LOG_LEVEL_WARN, 'Original of "{0}" is truncated'.format(picture_name))
+                if self._picture_list.set_original_failed(picture_name, False) is True:
+                    self._notificationCenter.fire_event(NOTIFY_IMAGELIST_UPDATE)
+            if EmbeddedPreviewReader.is_complete_jpeg(os.path.join(thumbnail_path, picture_name)) is True:
+                continue
+            self._picture_list.set_provisional(picture_name)
+            result_dict = self._thumb_creator_pool.run_background_job(self.create_thumbnail_job(picture_name))
+            if result_dict[ThumbnailCreationProcess.RESULT_KEY_SUCCESS] is False:
+                self._logger.log(Logger.LOG_LEVEL_ERROR,
+                                 'Could not repair thumbnail of "{0}"'.format(picture_name))
+                continue
+            self._metadata_journal.set_thumbnail_created(
+                picture_name, result_dict[ThumbnailCreationProcess.RESULT_KEY_DIMENSIONS])
+            # Recorded as update, so the clients load the thumbnail again
+            self._picture_list.finalize_picture(picture_name)
+            self._notificationCenter.fire_event(NOTIFY_IMAGELIST_UPDATE)
+            repair_count += 1
+        if repair_count > 0:
+            self._logger.log(Logger.LOG_LEVEL_INFO, 'Repaired {0} thumbnails of earlier runs'.format(repair_count))
+
+    def start_thumb_creator_pool(self):
         self._thumb_creator_result_receiver = threading.Thread(target=self.receive_thumb_creator_result)
         self._thumb_creator_result_receiver.setDaemon(True)
         self._thumb_creator_result_receiver.start()
-        self._thumb_creator_process = ThumbnailCreationProcess(self._thumb_creator_job_queue,
-                                                               self._thumb_creator_result_queue)
-        self._thumb_creator_process.start()
-        photo_path = os.path.join(self._sessionPath, self._config.get('PhotoFolder'))
-        counter = self._picture_list.get_counter()
-        self._tethering_process = DemoTetheringProcess(self._tethering_result_queue, photo_path, counter)
+        self._thumb_creator_pool.start()
+        repair_thread = threading.Thread(target=self.repair_existing_pictures)
+        repair_thread.setDaemon(True)
+        repair_thread.start()
+
+    def run_in_demo_mode(self):
+        self.start_thumb_creator_pool()
+        self._tethering_process = self.create_tethering_process(DemoTetheringProcess)
         self._tethering_process.start()
         while True:
             result_dict = self._tethering_result_queue.get()
@@ -905,24 +4373,11 @@ class TetheringThread(threading.Thread):
                     self._logger.log(Logger.LOG_LEVEL_INFO, 'Camera is connected')
                 else:
                     self._logger.log(Logger.LOG_LEVEL_WARN, 'No camera connected')
-            source_file_path = result_dict[DemoTetheringProcess.RESULT_KEY_SOURCE_PATH]
-            if source_file_path is not None:
-                self._logger.log(Logger.LOG_LEVEL_INFO, 'New file "{0}" on camera'.format(source_file_path))
-            picture_name = result_dict[DemoTetheringProcess.RESULT_KEY_PICTUE]
-            if picture_name is not None:
-                self._logger.log(Logger.LOG_LEVEL_INFO, 'Downloaded picture "{0}"'.format(picture_name))
-                self.process_picture(picture_name)
+            self.handle_downloaded_picture(result_dict)
 
     def run_in_productive_mode(self):
-        self._thumb_creator_result_receiver = threading.Thread(target=self.receive_thumb_creator_result)
-        self._thumb_creator_result_receiver.setDaemon(True)
-        self._thumb_creator_result_receiver.start()
-        self._thumb_creator_process = ThumbnailCreationProcess(self._thumb_creator_job_queue,
-                                                               self._thumb_creator_result_queue)
-        self._thumb_creator_process.start()
-        photo_path = os.path.join(self._sessionPath, self._config.get('PhotoFolder'))
-        counter = self._picture_list.get_counter()
-        self._tethering_process = TetheringProcess(self._tethering_result_queue, photo_path, counter)
+        self.start_thumb_creator_pool()
+        self._tethering_process = self.create_tethering_process(TetheringProcess)
         self._tethering_process.start()
         tethering_watchdog = threading.Thread(target=self.tethering_watchdog)
         tethering_watchdog.setDaemon(True)
@@ -938,13 +4393,7 @@ class TetheringThread(threading.Thread):
                     self._logger.log(Logger.LOG_LEVEL_INFO, 'Camera is connected')
                 else:
                     self._logger.log(Logger.LOG_LEVEL_WARN, 'No camera connected')
-            source_file_path = result_dict[TetheringProcess.RESULT_KEY_SOURCE_PATH]
-            if source_file_path is not None:
-                self._logger.log(Logger.LOG_LEVEL_INFO, 'New file "{0}" on camera'.format(source_file_path))
-            picture_name = result_dict[TetheringProcess.RESULT_KEY_PICTUE]
-            if picture_name is not None:
-                self._logger.log(Logger.LOG_LEVEL_INFO, 'Downloaded picture "{0}"'.format(picture_name))
-                self.process_picture(picture_name)
+            self.handle_downloaded_picture(result_dict)
 
     def run(self):
         run_in_demo_mode = self._config.get('RunInDemoMode')
@@ -976,20 +4425,20 @@ class Application:
         # Set member variables
         self._config = config
         self._logger = logger
-        self._sharedPhotoList = SharedPhotoList()
         self._sessionPath = self.create_capture_session_folder()
+        self._metadataJournal = PictureMetadataJournal(os.path.join(self._sessionPath,
+                                                                    self._config.get('MetadataJournalFile')))
+        self._sharedPhotoList = SharedPhotoList(self._config.get('RenditionWidthList'), self._metadataJournal)
+        self._pipelineMetrics = PipelineMetrics()
         self._hubList = None
         self._webserver = None
         self._zeroconfService = None
         self._teatherThread = None
-        # Add allready existing photos to list
-        photo_directory_path = os.path.join(self._sessionPath,
-                                            self._config.get('PhotoFolder'))
-        file_list = os.listdir(photo_directory_path)
-        file_list.sort()
-        for image_file_name in file_list:
-            if image_file_name.endswith(".jpg"):
-                self._sharedPhotoList.add_picture(image_file_name)
+        self._renditionCache = None
+        # Add allready existing photos to list, the broken ones are repaired in the background
+        self.remove_temporary_files()
+        self._existingPictureList = self.reconcile_existing_pictures()
+        self._sharedPhotoList.add_pictures(self._existingPictureList)
 
     def get_config(self):
         return self._config
@@ -1006,6 +4455,27 @@ class Application:
     def get_hub_list(self):
         return self._hubList
 
+    def get_rendition_cache(self):
+        return self._renditionCache
+
+    def get_pipeline_metrics(self):
+        return self._pipelineMetrics
+
+    def get_metadata_journal(self):
+        return self._metadataJournal
+
+    def get_existing_picture_list(self):
+        return self._existingPictureList
+
+    def get_preview_path(self, picture_name):
+        """
+        Returns the path of the JPEG preview extracted from a RAW picture,
+        or None, if picture_name is no RAW picture.
+        """
+        if not EmbeddedPreviewReader.is_raw_file(picture_name):
+            return None
+        return os.path.join(self._sessionPath, self._config.get('PreviewFolder'), picture_name + '.jpg')
+
     def create_capture_session_folder(self):
         folder = os.path.join(self._config.get('DataFolder'), self._config.get('SessionName'))
         if self._config.get('SessionName') == '':
@@ -1015,12 +4485,89 @@ class Application:
                     break
         thumbnail_path = os.path.os.path.join(folder, self._config.get('ThumbnailFolder'))
         photo_path = os.path.os.path.join(folder, self._config.get('PhotoFolder'))
+        preview_path = os.path.os.path.join(folder, self._config.get('PreviewFolder'))
         if not (os.path.exists(folder)):
             os.makedirs(folder)
             os.makedirs(thumbnail_path)
             os.makedirs(photo_path)
+        if not (os.path.exists(preview_path)):
+            # Sessions created by older versions have no preview folder
+            os.makedirs(preview_path)
         return folder
 
+    def remove_temporary_files(self):
+        """
+        Removes the files left behind by writes, which have been interrupted
+        before their temporary file has been renamed.
+        """
+        for folder_key in ('PhotoFolder', 'ThumbnailFolder', 'PreviewFolder'):
+            folder = os.path.join(self._sessionPath, self._config.get(folder_key))
+            for file_name in os.listdir(folder):
+                if file_name.endswith('.tmp'):
+                    try:
+                        os.remove(os.path.join(folder, file_name))
+                    except OSError:
+                        pass
+
+    def reconcile_existing_pictures(self):
+        """
+        Returns the pictures of earlier runs in the order of the metadata
+        journal. Only the names in the photo folder are compared with the
+        journal, pictures missing in the folder are left out, pictures
+        missing in the journal are added in the order of their names. Changed
+        pictures are found later, when the pictures are hashed.
+        """
+        photo_directory_path = os.path.join(self._sessionPath, self._config.get('PhotoFolder'))
+        file_name_set = set(file_name for file_name in os.listdir(photo_directory_path)
+                            if file_name.endswith('.jpg') or EmbeddedPreviewReader.is_raw_file(file_name))
+        picture_list = [picture_name for picture_name in self._metadataJournal.get_picture_list()
+                        if picture_name in file_name_set]
+        new_picture_list = sorted(file_name_set.difference(picture_list))
+        for picture_name in new_picture_list:
+            self._metadataJournal.add_picture(picture_name)
+        if len(new_picture_list) > 0:
+            self._logger.log(Logger.LOG_LEVEL_INFO, 'Indexed {0} pictures of earlier runs'.format(
+                len(new_picture_list)))
+        return picture_list + new_picture_list
+
+    def hash_existing_pictures(self):
+        """
+        Computes the manifest metadata of the pictures found at startup,
+        newest first, pictures downloaded later are hashed at ingest.
+        Pictures recorded in the metadata journal are only hashed again,
+        if their size or modification time has changed.
+        """
+        photo_directory_path = os.path.join(self._sessionPath, self._config.get('PhotoFolder'))
+        hash_count = 0
+        for picture_name in reversed(self._existingPictureList):
+            if self._sharedPhotoList.has_picture_metadata(picture_name) is True:
+                continue
+            picture_path = os.path.join(photo_directory_path, picture_name)
+            try:
+                file_stat = os.stat(picture_path)
+            except OSError:
+                continue
+            metadata = self._metadataJournal.get_metadata(picture_name, file_stat.st_size, file_stat.st_mtime)
+            if metadata is not None:
+                self._sharedPhotoList.set_picture_metadata(picture_name, *metadata)
+                continue
+            content_hash = hashlib.sha256()
+            try:
+                with open(picture_path, 'rb') as file_handler:
+                    file_stat = os.fstat(file_handler.fileno())
+                    while True:
+                        chunk = file_handler.read(1024 * 1024)
+                        if chunk == '':
+                            break
+                        content_hash.update(chunk)
+            except (IOError, OSError):
+                continue
+            self._sharedPhotoList.set_picture_metadata(picture_name, file_stat.st_size, file_stat.st_mtime,
+                                                       content_hash.hexdigest())
+            hash_count += 1
+        if hash_count > 0:
+            self._logger.log(Logger.LOG_LEVEL_INFO, 'Hashed {0} pictures of earlier runs'.format(hash_count))
+
     def run(self):
         self._logger.log(Logger.LOG_LEVEL_INFO, 'Application started')
         # Print Network information, if possible
@@ -1047,19 +4594,51 @@ class Application:
         # Start camera connection
         self._teatherThread = TetheringThread()
         self._teatherThread.start()
+        # Renditions are created by the thumbnail workers
+        self._renditionCache = RenditionCache(self._teatherThread.get_thumbnail_worker_pool(),
+                                              self._config.get('RenditionWidthList'),
+                                              self._config.get('RenditionCacheSize') * 1024 * 1024)
+        # The manifest lists the pictures of earlier runs, once they have been hashed
+        hash_thread = threading.Thread(target=self.hash_existing_pictures)
+        hash_thread.daemon = True
+        hash_thread.start()
         # Start webserver
-        self._webserver = ThreadingHttpServer(('', int(self._config.get('HttpPortNumber'))), PhotoStreamHttpHandler)
         ssl_cert_file_path = self._config.get('SSLCertPath')
-        if ssl_cert_file_path != '' and os.path.isfile(ssl_cert_file_path):
-            self._webserver.socket = ssl.wrap_socket(self._webserver.socket,
-                                                     certfile=ssl_cert_file_path,
-                                                     server_side=True)
+        if not os.path.isfile(ssl_cert_file_path):
+            ssl_cert_file_path = ''
+        if self._config.get('RunAsyncHttpServer') is True:
+            self._webserver = AsyncHttpServer(('', int(self._config.get('HttpPortNumber'))),
+                                              ssl_cert_file_path,
+                                              self._config.get('HttpWorkerCount'),
+                                              self._config.get('HttpDownloadWorkerCount'))
+        else:
+            self._webserver = ThreadingHttpServer(('', int(self._config.get('HttpPortNumber'))), PhotoStreamHttpHandler)
+            if ssl_cert_file_path != '':
+                self._webserver.socket = ssl.wrap_socket(self._webserver.socket,
+                                                         certfile=ssl_cert_file_path,
+                                                         server_side=True)
+        self.add_metrics_gauges()
         self._webserver.serve_forever()
 
+    def add_metrics_gauges(self):
+        self._pipelineMetrics.add_gauge('picture_streamer_thumbnail_queue_length',
+                                        'Jobs waiting for a thumbnail worker.',
+                                        self._teatherThread.get_thumbnail_worker_pool().get_queue_length)
+        self._pipelineMetrics.add_gauge('picture_streamer_hub_upload_queue_length',
+                                        'Uploads waiting for each hub.',
+                                        self._hubList.get_upload_queue_length_dict, 'hub')
+        self._pipelineMetrics.add_gauge('picture_streamer_active_connections',
+                                        'Open connections of the HTTP server.',
+                                        self._webserver.get_connection_count)
+        self._pipelineMetrics.add_gauge('picture_streamer_parked_long_polls',
+                                        'Requests to /data.json waiting for new pictures.',
+                                        self._webserver.get_parked_long_poll_count)
+
     def exit(self):
         self._zeroconfService.unpublish()
         self._webserver.socket.close()
         self._logger.log(Logger.LOG_LEVEL_INFO, 'Application closed')
+        self._logger.close()
 
 # Main function
 
@@ -1067,7 +4646,9 @@ class Application:
 def main(argv):
     config = Configuration()
     config.parse_arguments(argv)
-    logger = Logger(config.get('LogFilePath'), config.get('RunAsDaemon'))
+    logger = Logger(config.get('LogFilePath'), config.get('RunAsDaemon'), config.get('LogQueueSize'),
+                    config.get('LogRotationSize') * 1024 * 1024, config.get('LogRotationInterval') * 3600,
+                    config.get('LogBackupCount'), config.get('LogJsonFormat'))
     app = None
     try:
         app = Application.first_instance(config, logger)
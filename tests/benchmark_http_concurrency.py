@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# Concurrency benchmark of the HTTP servers of Picture Streamer.
+#
+# Starts picture-streamer.py once with the threaded and once with the
+# asynchronous server. Parks a number of /data.json long polls on each,
+# keeps a number of downloads of a large picture stalled and reports the
+# time it took to connect the long polls, the threads and memory of the
+# server and the latency of API requests meanwhile.
+#
+# Usage: python tests/benchmark_http_concurrency.py [CLIENTS] [STALLED DOWNLOADS]
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import select
+import tempfile
+import subprocess
+
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'picture-streamer.py')
+PICTURE_SIZE = 64 * 1024 * 1024
+LATENCY_SAMPLES = 20
+API_TIMEOUT = 5.0
+
+
+def read_process_status(pid):
+    status = {}
+    with open('/proc/{0}/status'.format(pid)) as file_handler:
+        for line in file_handler:
+            key, value = line.split(':', 1)
+            status[key] = value.strip()
+    return int(status['Threads']), int(status['VmRSS'].split()[0]) / 1024.0
+
+
+def request(port, path, timeout=30.0):
+    connection = socket.create_connection(('127.0.0.1', port), timeout)
+    try:
+        connection.sendall('GET {0} HTTP/1.0\r\nHost: localhost\r\n\r\n'.format(path))
+        response = ''
+        while True:
+            data = connection.recv(65536)
+            if data == '':
+                break
+            response += data
+    finally:
+        connection.close()
+    return response.split('\r\n\r\n', 1)[1]
+
+
+def wait_for_server(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return json.loads(request(port, '/data.json?count=0&limit=1', 2.0))
+        except (socket.error, IndexError, ValueError):
+            time.sleep(0.2)
+    raise RuntimeError('Server did not start')
+
+
+def open_requests(port, path, count, receive_buffer_size=None):
+    connection_list = []
+    for index in range(count):
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if receive_buffer_size is not None:
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+        connection.connect(('127.0.0.1', port))
+        connection.sendall('GET {0} HTTP/1.0\r\nHost: localhost\r\n\r\n'.format(path))
+        connection_list.append(connection)
+    return connection_list
+
+
+def count_unanswered(connection_list):
+    answered_set = set()
+    for chunk_start in range(0, len(connection_list), 512):
+        readable_list, writable_list, error_list = select.select(connection_list[chunk_start:chunk_start + 512],
+                                                                 [], [], 0)
+        answered_set.update(readable_list)
+    return len(connection_list) - len(answered_set)
+
+
+def run_benchmark(use_async_server, port, client_count, download_count):
+    data_path = tempfile.mkdtemp()
+    session_path = os.path.join(data_path, 'benchmark')
+    for folder in ('Photos', 'Thumbnails', 'Previews'):
+        os.makedirs(os.path.join(session_path, folder))
+    with open(os.path.join(session_path, 'Photos', 'benchmark.jpg'), 'wb') as file_handler:
+        file_handler.write(os.urandom(PICTURE_SIZE))
+    process = subprocess.Popen([sys.executable, SCRIPT_PATH,
+                                '-port', str(port),
+                                '-dir', data_path,
+                                '-session', 'benchmark',
+                                '-daemon', 'yes',
+                                '-async', 'yes' if use_async_server else 'no'],
+                               preexec_fn=os.setsid)
+    try:
+        image_counter = wait_for_server(port)['imageCounter']
+        idle_threads, idle_memory = read_process_status(process.pid)
+        # Small receive buffers let the downloads stall right away
+        download_list = open_requests(port, '/photo/benchmark.jpg', download_count, 4096)
+        connect_start_time = time.time()
+        poll_list = open_requests(port, '/data.json?count={0}'.format(image_counter), client_count)
+        connect_time = time.time() - connect_start_time
+        time.sleep(2.0)
+        threads, memory = read_process_status(process.pid)
+        latency_list = []
+        for sample in range(LATENCY_SAMPLES):
+            start_time = time.time()
+            try:
+                request(port, '/manifest.json?since=0', API_TIMEOUT)
+                latency_list.append((time.time() - start_time) * 1000)
+            except socket.timeout:
+                # The request is stuck behind the downloads
+                latency_list.append(float('inf'))
+        latency_list.sort()
+        result = {'connect': connect_time,
+                  'parked': count_unanswered(poll_list),
+                  'threads': threads - idle_threads,
+                  'memory': memory - idle_memory,
+                  'latency': latency_list[len(latency_list) // 2],
+                  'latency_max': latency_list[-1]}
+        for connection in download_list + poll_list:
+            connection.close()
+        return result
+    finally:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        shutil.rmtree(data_path, ignore_errors=True)
+
+
+def main(argv):
+    client_count = int(argv[0]) if len(argv) > 0 else 500
+    download_count = int(argv[1]) if len(argv) > 1 else 16
+    print '{0} parked long polls, {1} stalled downloads of {2} MB'.format(client_count, download_count,
+                                                                         PICTURE_SIZE / 1024 / 1024)
+    print '{0:<10} {1:>10} {2:>8} {3:>10} {4:>12} {5:>16} {6:>16}'.format('server', 'connect', 'parked',
+                                                                         '+threads', '+memory',
+                                                                         'API latency', 'API latency max')
+    for port, use_async_server in ((8901, False), (8902, True)):
+        result = run_benchmark(use_async_server, port, client_count, download_count)
+        print '{0:<10} {1:>8.1f} s {2:>8} {3:>10} {4:>9.1f} MB {5:>13.1f} ms {6:>13.1f} ms'.format(
+            'async' if use_async_server else 'threaded', result['connect'], result['parked'], result['threads'],
+            result['memory'], result['latency'], result['latency_max'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Writes the synthetic RAW fixtures of test_raw_previews.py.
+#
+# The containers have the structure of the real formats, but their raw
+# image data is a few bytes of lossless JPEG header only:
+#
+#   sample.CR2  little endian TIFF, the preview is the JPEG strip of IFD0,
+#               IFD1 holds the small thumbnail, IFD3 the lossless raw data
+#   sample.NEF  big endian TIFF, the preview is in the first of two SubIFDs,
+#               IFD0 holds the small thumbnail
+#   sample.RW2  TIFF with the Panasonic magic number, the preview is the
+#               JpgFromRaw entry
+#   sample.RAF  Fujifilm header with the offset and length of the preview
+#
+# Usage: python tests/fixtures/make_raw_fixtures.py
+
+
+import os
+import struct
+import StringIO
+import Image
+
+
+FIXTURE_PATH = os.path.dirname(os.path.realpath(__file__))
+
+TIFF_TYPE_UNDEFINED = 7
+TIFF_TYPE_SHORT = 3
+TIFF_TYPE_LONG = 4
+
+
+def create_jpeg(width, height, color):
+    jpeg_data = StringIO.StringIO()
+    Image.new('RGB', (width, height), color).save(jpeg_data, 'JPEG', quality=80)
+    return jpeg_data.getvalue()
+
+
+def create_lossless_jpeg_header(width, height):
+    # Raw image data of CR2 files starts like this, it must never be taken for a preview
+    return '\xff\xd8\xff\xc4' + struct.pack('>H', 4) + '\x00\x00' + \
+           '\xff\xc3' + struct.pack('>HBHHB', 11, 14, height, width, 2) + '\x00' * 6
+
+
+def create_tiff(byte_order, magic, ifd_list, blob_list):
+    """
+    Returns a TIFF container with the IFDs of ifd_list followed by the data
+    of blob_list. An IFD is the list of (tag, type, count, value) entries,
+    values ('ifd', n), ('blob', n) and ('length', n) are replaced by the
+    offset of an IFD or blob and by the length of a blob. Each IFD links to
+    the next one, the last one ends the chain.
+    """
+    offset = 8
+    ifd_offset_list = []
+    for entry_list in ifd_list:
+        ifd_offset_list.append(offset)
+        offset += 2 + 12 * len(entry_list) + 4
+    blob_offset_list = []
+    for blob in blob_list:
+        blob_offset_list.append(offset)
+        offset += len(blob)
+
+    def resolve(value):
+        if isinstance(value, tuple):
+            kind, index = value
+            if kind == 'ifd':
+                return ifd_offset_list[index]
+            if kind == 'blob':
+                return blob_offset_list[index]
+            return len(blob_list[index])
+        return value
+
+    tiff_data = magic + struct.pack(byte_order + 'I', ifd_offset_list[0])
+    for ifd_index, entry_list in enumerate(ifd_list):
+        tiff_data += struct.pack(byte_order + 'H', len(entry_list))
+        for tag, value_type, count, value in entry_list:
+            if (value_type == TIFF_TYPE_SHORT) and (count == 1):
+                tiff_data += struct.pack(byte_order + 'HHIHH', tag, value_type, count, resolve(value), 0)
+            else:
+                tiff_data += struct.pack(byte_order + 'HHII', tag, value_type, count, resolve(value))
+        next_ifd_offset = ifd_offset_list[ifd_index + 1] if ifd_index + 1 < len(ifd_list) else 0
+        tiff_data += struct.pack(byte_order + 'I', next_ifd_offset)
+    return tiff_data + ''.join(blob_list)
+
+
+def create_cr2(preview_data, thumbnail_data):
+    raw_data = create_lossless_jpeg_header(6000, 4000)
+    ifd_list = [[(0x0103, TIFF_TYPE_SHORT, 1, 6),
+                 (0x0111, TIFF_TYPE_LONG, 1, ('blob', 0)),
+                 (0x0117, TIFF_TYPE_LONG, 1, ('length', 0))],
+                [(0x0201, TIFF_TYPE_LONG, 1, ('blob', 1)),
+                 (0x0202, TIFF_TYPE_LONG, 1, ('length', 1))],
+                [(0x0103, TIFF_TYPE_SHORT, 1, 1)],
+                [(0x0103, TIFF_TYPE_SHORT, 1, 6),
+                 (0x0111, TIFF_TYPE_LONG, 1, ('blob', 2)),
+                 (0x0117, TIFF_TYPE_LONG, 1, ('length', 2))]]
+    return create_tiff('<', 'II*\x00', ifd_list, [preview_data, thumbnail_data, raw_data])
+
+
+def create_nef(preview_data, thumbnail_data):
+    # The SubIFD offsets are known, once the layout without them is fixed
+    ifd_list = [[(0x014A, TIFF_TYPE_LONG, 2, ('blob', 2)),
+                 (0x0201, TIFF_TYPE_LONG, 1, ('blob', 1)),
+                 (0x0202, TIFF_TYPE_LONG, 1, ('length', 1))],
+                [(0x0201, TIFF_TYPE_LONG, 1, ('blob', 0)),
+                 (0x0202, TIFF_TYPE_LONG, 1, ('length', 0))],
+                [(0x0103, TIFF_TYPE_SHORT, 1, 34713)]]
+    placeholder_data = create_tiff('>', 'MM\x00*', ifd_list, [preview_data, thumbnail_data, '\x00' * 8])
+    sub_ifd_data = struct.pack('>II', 8 + 2 + 3 * 12 + 4, 8 + 2 + 3 * 12 + 4 + 2 + 2 * 12 + 4)
+    nef_data = placeholder_data[:-8] + sub_ifd_data
+    # Only IFD0 is linked, the SubIFDs are reached through the SubIFDs entry
+    first_next_offset = 8 + 2 + 3 * 12
+    nef_data = nef_data[:first_next_offset] + struct.pack('>I', 0) + nef_data[first_next_offset + 4:]
+    return nef_data
+
+
+def create_rw2(preview_data):
+    ifd_list = [[(0x002E, TIFF_TYPE_UNDEFINED, len(preview_data), ('blob', 0))]]
+    return create_tiff('<', 'IIU\x00', ifd_list, [preview_data])
+
+
+def create_raf(preview_data):
+    header_data = 'FUJIFILMCCD-RAW 0201FF383501'
+    header_data += '\x00' * (84 - len(header_data))
+    preview_offset = 128
+    header_data += struct.pack('>II', preview_offset, len(preview_data))
+    header_data += '\x00' * (preview_offset - len(header_data))
+    return header_data + preview_data
+
+
+def main():
+    preview_data = create_jpeg(320, 213, (200, 30, 30))
+    thumbnail_data = create_jpeg(160, 120, (30, 30, 200))
+    fixture_dict = {'preview.jpg': preview_data,
+                    'sample.CR2': create_cr2(preview_data, thumbnail_data),
+                    'sample.NEF': create_nef(preview_data, thumbnail_data),
+                    'sample.RW2': create_rw2(preview_data),
+                    'sample.RAF': create_raf(preview_data)}
+    for file_name, data in sorted(fixture_dict.items()):
+        with open(os.path.join(FIXTURE_PATH, file_name), 'wb') as file_handler:
+            file_handler.write(data)
+        print '{0}: {1} bytes'.format(file_name, len(data))
+
+
+if __name__ == '__main__':
+    main()
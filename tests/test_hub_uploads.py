@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# Test of the hub uploads of Picture Streamer against a stand-in hub.
+#
+# The stand-in hub is a local HTTP/1.1 server, which counts the connections
+# it accepts and checks every multipart upload it receives. The uploads
+# have to share one persistent connection, recover from a connection the
+# hub has closed while it was idle and report the status of the hub.
+# The throughput with the pooled connection and with a new connection
+# per upload is printed.
+#
+# Usage: python tests/test_hub_uploads.py [UPLOADS]
+
+
+import os
+import sys
+import imp
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+
+picture_streamer = imp.load_source('picture_streamer',
+                                   os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                '..', 'picture-streamer.py'))
+
+UPLOAD_COUNT = 50
+PICTURE_SIZE = 256 * 1024
+
+
+class StandInHubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # The response is sent in one write like real servers do, separate writes of the
+    # status line and headers would wait for the delayed ACK of the client
+    wbufsize = 64 * 1024
+
+    def do_POST(self):
+        content_length = int(self.headers.getheader('Content-Length'))
+        body = self.rfile.read(content_length)
+        self.server.record_upload(body)
+        content = 'OK'
+        self.send_response(self.server.responseStatus)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        if self.server.closeAfterResponse is True:
+            # Like a hub, which drops idle connections without telling the client
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInHub(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHubHandler)
+        self.responseStatus = 200
+        self.closeAfterResponse = False
+        self._lock = threading.Lock()
+        self.connectionCount = 0
+        self.bodyList = []
+
+    def get_request(self):
+        request = BaseHTTPServer.HTTPServer.get_request(self)
+        with self._lock:
+            self.connectionCount += 1
+        return request
+
+    def record_upload(self, body):
+        with self._lock:
+            self.bodyList.append(body)
+
+
+class StandInHubList(picture_streamer.HubList):
+
+    def __init__(self):
+        # Only the multipart encoding is used, which needs no application
+        pass
+
+
+class HubUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temporaryPath = tempfile.mkdtemp()
+        self._picturePath = os.path.join(self._temporaryPath, 'picture.jpg')
+        self._pictureData = os.urandom(PICTURE_SIZE)
+        with open(self._picturePath, 'wb') as file_handler:
+            file_handler.write(self._pictureData)
+        self._hub = StandInHub()
+        self._hubThread = threading.Thread(target=self._hub.serve_forever)
+        self._hubThread.daemon = True
+        self._hubThread.start()
+        self._hubList = StandInHubList()
+
+    def tearDown(self):
+        self._hub.shutdown()
+        self._hub.server_close()
+        shutil.rmtree(self._temporaryPath, ignore_errors=True)
+
+    def create_connection_pool(self):
+        return picture_streamer.HubConnectionPool('127.0.0.1', self._hub.server_address[1])
+
+    def upload(self, connection_pool, picture_name='picture.jpg'):
+        return self._hubList.post_multipart_form(connection_pool, '/upload',
+                                                 (('Filed1', 'Value1'),),
+                                                 (('photo', picture_name, self._picturePath),))
+
+    def test_uploads_share_a_connection(self):
+        connection_pool = self.create_connection_pool()
+        for upload_index in range(UPLOAD_COUNT):
+            errcode, errmsg, headers, content = self.upload(connection_pool, 'picture{0}.jpg'.format(upload_index))
+            self.assertEqual(errcode, 200)
+            self.assertEqual(content, 'OK')
+        connection_pool.close()
+        self.assertEqual(self._hub.connectionCount, 1)
+        self.assertEqual(len(self._hub.bodyList), UPLOAD_COUNT)
+        for upload_index, body in enumerate(self._hub.bodyList):
+            self.assertIn('filename="picture{0}.jpg"'.format(upload_index), body)
+            self.assertIn(self._pictureData, body)
+
+    def test_reconnect_after_idle_close(self):
+        self._hub.closeAfterResponse = True
+        connection_pool = self.create_connection_pool()
+        for upload_index in range(3):
+            # Give the hub the time to close the connection, before it is reused
+            time.sleep(0.1)
+            self.assertEqual(self.upload(connection_pool)[0], 200)
+        connection_pool.close()
+        self.assertEqual(self._hub.connectionCount, 3)
+        self.assertEqual(len(self._hub.bodyList), 3)
+
+    def test_response_status(self):
+        connection_pool = self.create_connection_pool()
+        self._hub.responseStatus = 503
+        self.assertEqual(self.upload(connection_pool)[0], 503)
+        self._hub.responseStatus = 200
+        self.assertEqual(self.upload(connection_pool)[0], 200)
+        connection_pool.close()
+        # An error response doesn't cost the connection
+        self.assertEqual(self._hub.connectionCount, 1)
+
+    def test_unreachable_hub(self):
+        unused_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        unused_socket.bind(('127.0.0.1', 0))
+        port = unused_socket.getsockname()[1]
+        unused_socket.close()
+        self.assertIsNone(self.upload(picture_streamer.HubConnectionPool('127.0.0.1', port))[0])
+
+    def test_throughput(self):
+        result_list = []
+        for is_pooled in (False, True):
+            connection_pool = self.create_connection_pool()
+            connection_count = self._hub.connectionCount
+            start_time = time.time()
+            for upload_index in range(UPLOAD_COUNT):
+                self.assertEqual(self.upload(connection_pool)[0], 200)
+                if is_pooled is False:
+                    connection_pool.close()
+            duration = time.time() - start_time
+            connection_pool.close()
+            result_list.append((is_pooled, self._hub.connectionCount - connection_count, duration))
+        print
+        for is_pooled, connection_count, duration in result_list:
+            print '{0:<24} {1:>4} connections {2:>8.1f} uploads/s {3:>8.1f} MB/s'.format(
+                'pooled connection' if is_pooled is True else 'connection per upload', connection_count,
+                UPLOAD_COUNT / duration, UPLOAD_COUNT * PICTURE_SIZE / duration / 1024 / 1024)
+        self.assertEqual(result_list[0][1], UPLOAD_COUNT)
+        self.assertEqual(result_list[1][1], 1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        UPLOAD_COUNT = int(sys.argv.pop(1))
+    unittest.main()
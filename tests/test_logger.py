@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Test of the background Logger of Picture Streamer.
+#
+# Callers must not wait for the log file, not even when the writer is
+# stalled: messages beyond the queue are dropped, counted and reported in
+# the log. The log file is rotated by size and by age, keeps the given
+# number of backups and can be written as JSON lines. The time a caller
+# spends in log() is printed.
+#
+# Usage: python tests/test_logger.py [MESSAGES]
+
+
+import os
+import sys
+import imp
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+
+picture_streamer = imp.load_source('picture_streamer',
+                                   os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                '..', 'picture-streamer.py'))
+
+Logger = picture_streamer.Logger
+MESSAGE_COUNT = 20000
+
+
+class StalledLogger(Logger):
+
+    def __init__(self, *args, **kwargs):
+        self.writeEvent = threading.Event()
+        Logger.__init__(self, *args, **kwargs)
+
+    def write_message(self, log_time, log_level, log_message):
+        # Like a writer, which waits for a slow SD card
+        self.writeEvent.wait()
+        Logger.write_message(self, log_time, log_level, log_message)
+
+
+class LoggerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temporaryPath = tempfile.mkdtemp()
+        self._logFilePath = os.path.join(self._temporaryPath, 'picture-streamer.log')
+
+    def tearDown(self):
+        shutil.rmtree(self._temporaryPath, ignore_errors=True)
+
+    def read_log(self, file_path=None):
+        with open(file_path or self._logFilePath) as file_handler:
+            return file_handler.read().splitlines()
+
+    def test_messages(self):
+        logger = Logger(self._logFilePath, True)
+        for index in range(100):
+            logger.log(Logger.LOG_LEVEL_INFO, 'Message {0}'.format(index))
+        logger.close()
+        line_list = self.read_log()
+        self.assertEqual(len(line_list), 100)
+        self.assertTrue(line_list[0].endswith('] INFO: Message 0'))
+        self.assertTrue(line_list[-1].endswith('] INFO: Message 99'))
+
+    def test_stalled_writer(self):
+        logger = StalledLogger(self._logFilePath, True, 100)
+        logger.log(Logger.LOG_LEVEL_INFO, 'Message 0')
+        # The writer holds the first message, the queue takes the next 100
+        time.sleep(0.1)
+        start_time = time.time()
+        for index in range(1, MESSAGE_COUNT):
+            logger.log(Logger.LOG_LEVEL_INFO, 'Message {0}'.format(index))
+        duration = time.time() - start_time
+        self.assertEqual(logger.get_dropped_count(), MESSAGE_COUNT - 101)
+        logger.writeEvent.set()
+        time.sleep(0.2)
+        logger.log(Logger.LOG_LEVEL_INFO, 'Last message')
+        logger.close()
+        line_list = self.read_log()
+        self.assertEqual(len(line_list), 103)
+        # The drops are reported by the writer with the next message it takes
+        self.assertIn('WARNING: {0} log messages dropped'.format(MESSAGE_COUNT - 101), line_list[1])
+        self.assertTrue(line_list[-2].endswith('Message 100'))
+        self.assertTrue(line_list[-1].endswith('Last message'))
+        print '\n{0} messages logged with a stalled writer in {1:.3f}s, ' \
+              '{2:.1f} us per message'.format(MESSAGE_COUNT, duration, duration / MESSAGE_COUNT * 1000000)
+
+    def test_flush_by_level(self):
+        logger = Logger(self._logFilePath, True)
+        logger.log(Logger.LOG_LEVEL_INFO, 'Buffered')
+        time.sleep(0.2)
+        self.assertEqual(os.path.getsize(self._logFilePath), 0)
+        logger.log(Logger.LOG_LEVEL_ERROR, 'Flushed')
+        time.sleep(0.2)
+        self.assertEqual(len(self.read_log()), 2)
+        logger.log(Logger.LOG_LEVEL_INFO, 'Flushed after the interval')
+        time.sleep(Logger.FLUSH_INTERVAL + 0.2)
+        self.assertEqual(len(self.read_log()), 3)
+        logger.close()
+
+    def test_size_rotation(self):
+        logger = Logger(self._logFilePath, True, rotation_size=1000, backup_count=2)
+        for index in range(100):
+            logger.log(Logger.LOG_LEVEL_INFO, 'Message {0:04d}'.format(index))
+        logger.close()
+        self.assertEqual(sorted(os.listdir(self._temporaryPath)),
+                         ['picture-streamer.log', 'picture-streamer.log.1', 'picture-streamer.log.2'])
+        for file_name in os.listdir(self._temporaryPath):
+            self.assertLessEqual(os.path.getsize(os.path.join(self._temporaryPath, file_name)), 1000)
+        self.assertTrue(self.read_log()[-1].endswith('Message 0099'))
+        self.assertLess(self.read_log(self._logFilePath + '.2')[-1], self.read_log(self._logFilePath + '.1')[0])
+
+    def test_time_rotation(self):
+        logger = Logger(self._logFilePath, True, rotation_interval=0.5)
+        logger.log(Logger.LOG_LEVEL_INFO, 'Old message')
+        time.sleep(0.7)
+        logger.log(Logger.LOG_LEVEL_INFO, 'New message')
+        logger.close()
+        self.assertEqual(len(self.read_log()), 1)
+        self.assertTrue(self.read_log(self._logFilePath + '.1')[0].endswith('Old message'))
+
+    def test_json_format(self):
+        logger = Logger(self._logFilePath, True, is_json_format=True)
+        logger.log(Logger.LOG_LEVEL_FATAL, 'Broken "quotes"\nand lines')
+        logger.close()
+        line_list = self.read_log()
+        self.assertEqual(len(line_list), 1)
+        entry = json.loads(line_list[0])
+        self.assertEqual(entry['level'], 'FATAL ERROR')
+        self.assertEqual(entry['message'], 'Broken "quotes"\nand lines')
+        self.assertIn('T', entry['time'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        MESSAGE_COUNT = int(sys.argv.pop(1))
+    unittest.main()
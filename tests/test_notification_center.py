@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Stress test of the NotificationCenter of Picture Streamer.
+#
+# Thousands of waiters block on an event while it is fired rapidly. Every
+# waiter carries the generation it has seen, so no fire may get lost and
+# every waiter has to see the last generation. Waiters, which are never
+# woken up, have to return after their timeout.
+#
+# Usage: python tests/test_notification_center.py [WAITERS]
+
+
+import os
+import sys
+import imp
+import time
+import threading
+import unittest
+
+
+picture_streamer = imp.load_source('picture_streamer',
+                                   os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                '..', 'picture-streamer.py'))
+
+EVENT_NAME = picture_streamer.NOTIFY_IMAGELIST_UPDATE
+WAITER_COUNT = 2000
+FIRE_COUNT = 500
+
+
+class NotificationCenterStressTest(unittest.TestCase):
+
+    def setUp(self):
+        self._stackSize = threading.stack_size(256 * 1024)
+        self._notificationCenter = picture_streamer.NotificationCenter()
+
+    def tearDown(self):
+        threading.stack_size(self._stackSize)
+
+    def start_waiters(self, waiter_count, target, args=()):
+        thread_list = [threading.Thread(target=target, args=args) for waiter_index in range(waiter_count)]
+        for thread in thread_list:
+            thread.daemon = True
+            thread.start()
+        return thread_list
+
+    def test_no_fire_is_lost(self):
+        notification_center = self._notificationCenter
+        last_generation_list = []
+        wakeup_count_list = []
+        lock = threading.Lock()
+
+        def wait_for_last_fire():
+            # Like a client, that polls again with the generation it has seen
+            generation = notification_center.get_generation(EVENT_NAME)
+            wakeup_count = 0
+            while generation < FIRE_COUNT:
+                generation = notification_center.wait_for_event(EVENT_NAME, generation, 30.0)
+                wakeup_count += 1
+            with lock:
+                last_generation_list.append(generation)
+                wakeup_count_list.append(wakeup_count)
+
+        base_thread_count = threading.active_count()
+        thread_list = self.start_waiters(WAITER_COUNT, wait_for_last_fire)
+        time.sleep(0.5)
+        # Waiting doesn't create timer threads
+        self.assertEqual(threading.active_count(), base_thread_count + WAITER_COUNT)
+        start_time = time.time()
+        for fire_index in range(FIRE_COUNT):
+            notification_center.fire_event(EVENT_NAME)
+            if fire_index % 50 == 0:
+                time.sleep(0.001)
+        fire_time = time.time() - start_time
+        for thread in thread_list:
+            thread.join(30.0)
+        delivery_time = time.time() - start_time
+        self.assertEqual(len(last_generation_list), WAITER_COUNT)
+        self.assertTrue(all(generation == FIRE_COUNT for generation in last_generation_list))
+        print '\n{0} waiters, {1} fires in {2:.3f}s, all waiters saw the last fire after {3:.3f}s, ' \
+              'wakeups per waiter {4:.1f} on average'.format(WAITER_COUNT, FIRE_COUNT, fire_time, delivery_time,
+                                                             sum(wakeup_count_list) / float(WAITER_COUNT))
+
+    def test_fire_between_check_and_wait(self):
+        notification_center = self._notificationCenter
+        generation = notification_center.get_generation(EVENT_NAME)
+        notification_center.fire_event(EVENT_NAME)
+        start_time = time.time()
+        self.assertEqual(notification_center.wait_for_event(EVENT_NAME, generation, 10.0), generation + 1)
+        self.assertLess(time.time() - start_time, 0.1)
+
+    def test_timeouts(self):
+        notification_center = self._notificationCenter
+        timeout = 0.5
+        duration_list = []
+        lock = threading.Lock()
+
+        def wait_for_timeout():
+            start_time = time.time()
+            notification_center.wait_for_event(EVENT_NAME, notification_center.get_generation(EVENT_NAME),
+                                               timeout)
+            with lock:
+                duration_list.append(time.time() - start_time)
+
+        thread_list = self.start_waiters(WAITER_COUNT, wait_for_timeout)
+        for thread in thread_list:
+            thread.join(30.0)
+        self.assertEqual(len(duration_list), WAITER_COUNT)
+        # The timeout thread releases the waiters with a resolution of TIMEOUT_RESOLUTION
+        self.assertGreaterEqual(min(duration_list), timeout - 0.01)
+        self.assertLess(max(duration_list), timeout + 5.0)
+        print '\n{0} waiters timed out after {1:.3f}s to {2:.3f}s'.format(WAITER_COUNT, min(duration_list),
+                                                                        max(duration_list))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        WAITER_COUNT = int(sys.argv.pop(1))
+    unittest.main()
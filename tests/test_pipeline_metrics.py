@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Test of the pipeline metrics of Picture Streamer.
+#
+# Pictures collect time stamps on their way from the camera to the viewers
+# and hubs. Each stage and milestone has to be observed once per picture,
+# with the time stamps recorded first, and only for pictures tracked from
+# their camera event on. The document of /metrics has to follow the
+# Prometheus text format.
+#
+# Usage: python tests/test_pipeline_metrics.py
+
+
+import os
+import imp
+import unittest
+
+
+picture_streamer = imp.load_source('picture_streamer',
+                                   os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                '..', 'picture-streamer.py'))
+
+PipelineMetrics = picture_streamer.PipelineMetrics
+
+
+def parse_samples(text):
+    sample_dict = {}
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+        name, value = line.rsplit(' ', 1)
+        sample_dict[name] = value
+    return sample_dict
+
+
+class PipelineMetricsTest(unittest.TestCase):
+
+    def record_picture(self, metrics, picture_name, event_time, download_time):
+        metrics.record_timestamps(picture_name, {PipelineMetrics.STAMP_CAMERA_EVENT: event_time,
+                                                 PipelineMetrics.STAMP_DOWNLOAD_STARTED: event_time + 0.5})
+        metrics.record_timestamps(picture_name, {PipelineMetrics.STAMP_DOWNLOADED: event_time + 0.5 + download_time})
+
+    def test_quantiles(self):
+        metrics = PipelineMetrics()
+        for index in range(100):
+            self.record_picture(metrics, 'IMG_{0:04d}.JPG'.format(index), 1000.0, (index + 1) / 100.0)
+        sample_dict = parse_samples(metrics.get_prometheus_text())
+        for quantile in ('0.5', '0.95', '0.99'):
+            self.assertAlmostEqual(float(sample_dict['picture_streamer_stage_seconds{{stage="download",'
+                                                     'quantile="{0}"}}'.format(quantile)]), float(quantile))
+        self.assertEqual(sample_dict['picture_streamer_stage_seconds_count{stage="download"}'], '100')
+        self.assertAlmostEqual(float(sample_dict['picture_streamer_stage_seconds_sum{stage="download"}']), 50.5)
+        # Without samples the quantiles are unknown
+        self.assertEqual(sample_dict['picture_streamer_stage_seconds{stage="write",quantile="0.5"}'], 'NaN')
+        self.assertEqual(sample_dict['picture_streamer_stage_seconds_count{stage="write"}'], '0')
+
+    def test_first_timestamp_counts(self):
+        metrics = PipelineMetrics()
+        self.record_picture(metrics, 'IMG_0001.JPG', 1000.0, 1.0)
+        metrics.record_timestamp('IMG_0001.JPG', PipelineMetrics.STAMP_LISTED, 1002.0)
+        # Fetched by two viewers and listed again, when its thumbnail has been created
+        metrics.record_timestamp('IMG_0001.JPG', PipelineMetrics.STAMP_FIRST_FETCH, 1003.0)
+        metrics.record_timestamp('IMG_0001.JPG', PipelineMetrics.STAMP_FIRST_FETCH, 1010.0)
+        metrics.record_timestamp('IMG_0001.JPG', PipelineMetrics.STAMP_LISTED, 1005.0)
+        sample_dict = parse_samples(metrics.get_prometheus_text())
+        self.assertEqual(sample_dict['picture_streamer_milestone_seconds_count{milestone="listed"}'], '1')
+        self.assertEqual(sample_dict['picture_streamer_milestone_seconds{milestone="listed",quantile="0.5"}'],
+                         '2.0')
+        self.assertEqual(sample_dict['picture_streamer_milestone_seconds{milestone="first_fetch",quantile="0.5"}'],
+                         '3.0')
+        self.assertEqual(sample_dict['picture_streamer_stage_seconds{stage="first_fetch",quantile="0.5"}'], '1.0')
+        self.assertEqual(PipelineMetrics.get_stage_duration({PipelineMetrics.STAMP_WRITE_STARTED: 1.0,
+                                                             PipelineMetrics.STAMP_WRITTEN: 1.25},
+                                                            PipelineMetrics.STAGE_WRITE), 0.25)
+        self.assertEqual(PipelineMetrics.get_stage_duration({}, PipelineMetrics.STAGE_HASH), 0.0)
+
+    def test_untracked_pictures(self):
+        metrics = PipelineMetrics()
+        # Pictures of earlier runs and thumbnail repairs have no camera event
+        metrics.record_timestamps('OLD_0001.JPG', {PipelineMetrics.STAMP_THUMBNAIL_QUEUED: 1000.0,
+                                                   PipelineMetrics.STAMP_THUMBNAIL_STARTED: 1001.0})
+        metrics.record_timestamp('OLD_0001.JPG', PipelineMetrics.STAMP_FIRST_FETCH)
+        sample_dict = parse_samples(metrics.get_prometheus_text())
+        self.assertEqual(sample_dict['picture_streamer_stage_seconds_count{stage="thumbnail_queue"}'], '0')
+        self.assertEqual(sample_dict['picture_streamer_milestone_seconds_count{milestone="first_fetch"}'], '0')
+
+    def test_limits(self):
+        metrics = PipelineMetrics()
+        metrics.PICTURE_LIMIT = 10
+        for index in range(20):
+            self.record_picture(metrics, 'IMG_{0:04d}.JPG'.format(index), 1000.0, 1.0)
+        metrics.record_timestamp('IMG_0000.JPG', PipelineMetrics.STAMP_HASHED, 1002.0)
+        metrics.record_timestamp('IMG_0019.JPG', PipelineMetrics.STAMP_HASHED, 1002.0)
+        sample_dict = parse_samples(metrics.get_prometheus_text())
+        # The oldest pictures aren't tracked anymore
+        self.assertEqual(sample_dict['picture_streamer_milestone_seconds_count{milestone="stored"}'], '1')
+        self.assertEqual(sample_dict['picture_streamer_stage_seconds_count{stage="download"}'], '20')
+
+    def test_prometheus_format(self):
+        metrics = PipelineMetrics()
+        metrics.add_gauge('picture_streamer_thumbnail_queue_length', 'Jobs waiting.', lambda: 3)
+        metrics.add_gauge('picture_streamer_hub_upload_queue_length', 'Uploads waiting.',
+                          lambda: {'192.168.1.20': 5, u'hub "\\\n': 0}, 'hub')
+        text = metrics.get_prometheus_text()
+        self.assertTrue(text.endswith('\n'))
+        line_list = text.splitlines()
+        for metric_name, metric_type in (('picture_streamer_stage_seconds', 'summary'),
+                                         ('picture_streamer_milestone_seconds', 'summary'),
+                                         ('picture_streamer_thumbnail_queue_length', 'gauge'),
+                                         ('picture_streamer_hub_upload_queue_length', 'gauge')):
+            self.assertEqual(line_list.count('# TYPE {0} {1}'.format(metric_name, metric_type)), 1)
+        self.assertIn('picture_streamer_thumbnail_queue_length 3', line_list)
+        self.assertIn('picture_streamer_hub_upload_queue_length{hub="192.168.1.20"} 5', line_list)
+        self.assertIn('picture_streamer_hub_upload_queue_length{hub="hub \\"\\\\\\n"} 0', line_list)
+        for line in line_list:
+            if not line.startswith('#'):
+                float(line.rsplit(' ', 1)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
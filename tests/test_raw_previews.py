@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Test of the embedded preview extraction of Picture Streamer.
+#
+# Reads the previews of the synthetic RAW files in tests/fixtures, which
+# are written by tests/fixtures/make_raw_fixtures.py. Every container has
+# to return the exact bytes of preview.jpg, never the smaller thumbnail or
+# the raw image data. Broken files have to return None.
+#
+# Usage: python tests/test_raw_previews.py
+
+
+import os
+import imp
+import shutil
+import tempfile
+import unittest
+
+
+picture_streamer = imp.load_source('picture_streamer',
+                                   os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                '..', 'picture-streamer.py'))
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+RAW_FIXTURE_LIST = ('sample.CR2', 'sample.NEF', 'sample.RW2', 'sample.RAF')
+
+EmbeddedPreviewReader = picture_streamer.EmbeddedPreviewReader
+ThumbnailCreationProcess = picture_streamer.ThumbnailCreationProcess
+
+
+def read_fixture(file_name):
+    with open(os.path.join(FIXTURE_PATH, file_name), 'rb') as file_handler:
+        return file_handler.read()
+
+
+class RawPreviewTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temporaryPath = tempfile.mkdtemp()
+        self._previewData = read_fixture('preview.jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self._temporaryPath, ignore_errors=True)
+
+    def write_file(self, file_name, data):
+        file_path = os.path.join(self._temporaryPath, file_name)
+        with open(file_path, 'wb') as file_handler:
+            file_handler.write(data)
+        return file_path
+
+    def test_is_raw_file(self):
+        for file_name in RAW_FIXTURE_LIST + ('IMG_0001.cr2', 'DSC_0001.nef', 'DSCF0001.raf'):
+            self.assertTrue(EmbeddedPreviewReader.is_raw_file(file_name), file_name)
+        for file_name in ('preview.jpg', 'IMG_0001.JPG', 'MVI_0001.MOV', 'CR2'):
+            self.assertFalse(EmbeddedPreviewReader.is_raw_file(file_name), file_name)
+
+    def test_largest_preview(self):
+        for file_name in RAW_FIXTURE_LIST:
+            preview_data = EmbeddedPreviewReader.read_raw_preview(os.path.join(FIXTURE_PATH, file_name))
+            self.assertEqual(preview_data, self._previewData, file_name)
+
+    def test_truncated_file(self):
+        raw_data = read_fixture('sample.CR2')
+        self.assertIsNone(EmbeddedPreviewReader.read_raw_preview(self.write_file('short.CR2', raw_data[:300])))
+        self.assertIsNone(EmbeddedPreviewReader.read_raw_preview(self.write_file('header.CR2', raw_data[:12])))
+
+    def test_ifd_loop(self):
+        # IFD0 links to itself
+        raw_data = read_fixture('sample.RW2')
+        raw_data = raw_data[:8 + 2 + 12] + '\x08\x00\x00\x00' + raw_data[8 + 2 + 12 + 4:]
+        raw_data = raw_data[:8 + 2] + '\x00' * 12 + raw_data[8 + 2 + 12:]
+        self.assertIsNone(EmbeddedPreviewReader.read_raw_preview(self.write_file('loop.RW2', raw_data)))
+
+    def test_garbage(self):
+        for file_name in RAW_FIXTURE_LIST:
+            file_path = self.write_file(file_name, os.urandom(4096))
+            self.assertIsNone(EmbeddedPreviewReader.read_raw_preview(file_path), file_name)
+        self.assertIsNone(EmbeddedPreviewReader.read_raw_preview(self.write_file('empty.NEF', '')))
+        self.assertIsNone(EmbeddedPreviewReader.read_raw_preview(os.path.join(self._temporaryPath, 'missing.NEF')))
+
+    def test_thumbnail_of_raw_file(self):
+        thumbnail_process = ThumbnailCreationProcess(None, None)
+        for file_name in RAW_FIXTURE_LIST:
+            preview_path = os.path.join(self._temporaryPath, file_name + '.jpg')
+            thumbnail_path = os.path.join(self._temporaryPath, file_name + '.thumb.jpg')
+            picture_path = thumbnail_process.get_decodable_picture_path(os.path.join(FIXTURE_PATH, file_name),
+                                                                        preview_path)
+            self.assertEqual(picture_path, preview_path)
+            ThumbnailCreationProcess.save_scaled_picture(picture_path, thumbnail_path, (200, 200), 75)
+            thumbnail_image = picture_streamer.Image.open(thumbnail_path)
+            self.assertEqual(thumbnail_image.size, (200, 133), file_name)
+        with self.assertRaises(IOError):
+            thumbnail_process.get_decodable_picture_path(self.write_file('broken.CR2', os.urandom(4096)),
+                                                         os.path.join(self._temporaryPath, 'broken.jpg'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Test of the streamed ZIP archives of Picture Streamer.
+#
+# Archives written by ZipStreamWriter are read back with zipfile, which
+# has to find every file with its name, content and CRC. ZIP64 records
+# are tested with lowered limits, as real ones would take gigabytes. The
+# memory of the writer must not grow with the size of the files.
+#
+# Usage: python tests/test_zip_archive.py
+
+
+import os
+import imp
+import time
+import shutil
+import zipfile
+import tempfile
+import unittest
+import StringIO
+
+
+picture_streamer = imp.load_source('picture_streamer',
+                                   os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                '..', 'picture-streamer.py'))
+
+ZipStreamWriter = picture_streamer.ZipStreamWriter
+
+
+class SmallLimitZipStreamWriter(ZipStreamWriter):
+
+    ZIP64_LIMIT = 1000
+    ZIP64_COUNT_LIMIT = 3
+
+
+class CountingOutput:
+
+    def __init__(self):
+        self.size = 0
+        self.largestWrite = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.largestWrite = max(self.largestWrite, len(data))
+
+
+class ZipArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temporaryPath = tempfile.mkdtemp()
+        self._fileDict = {}
+
+    def tearDown(self):
+        shutil.rmtree(self._temporaryPath, ignore_errors=True)
+
+    def write_file(self, file_name, data):
+        file_path = os.path.join(self._temporaryPath, file_name)
+        with open(file_path, 'wb') as file_handler:
+            file_handler.write(data)
+        self._fileDict[file_name] = data
+        return file_path
+
+    def create_archive(self, writer_class, file_name_list):
+        output = StringIO.StringIO()
+        zip_writer = writer_class(output.write, 256)
+        for file_name in file_name_list:
+            with open(os.path.join(self._temporaryPath, file_name), 'rb') as file_handler:
+                file_status = os.fstat(file_handler.fileno())
+                zip_writer.add_file(file_name, file_handler, file_status.st_size, file_status.st_mtime)
+        zip_writer.close()
+        return output.getvalue()
+
+    def check_archive(self, archive_data, file_name_list):
+        archive = zipfile.ZipFile(StringIO.StringIO(archive_data))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), file_name_list)
+        for file_name in file_name_list:
+            info = archive.getinfo(file_name)
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(info.file_size, len(self._fileDict[file_name]))
+            self.assertEqual(archive.read(file_name), self._fileDict[file_name])
+        return archive
+
+    def test_archive(self):
+        file_name_list = ['IMG_{0:04d}.JPG'.format(index) for index in range(5)]
+        for index, file_name in enumerate(file_name_list):
+            self.write_file(file_name, os.urandom(index * 300))
+        archive = self.check_archive(self.create_archive(ZipStreamWriter, file_name_list), file_name_list)
+        modification_time = time.localtime(os.stat(os.path.join(self._temporaryPath, file_name_list[0])).st_mtime)
+        self.assertEqual(archive.getinfo(file_name_list[0]).date_time[:5], tuple(modification_time)[:5])
+
+    def test_unicode_name(self):
+        # Names read back from the session index are unicode
+        self._fileDict[u'Caf\xe9.jpg'] = os.urandom(100)
+        output = StringIO.StringIO()
+        zip_writer = ZipStreamWriter(output.write)
+        zip_writer.add_file(u'Caf\xe9.jpg', StringIO.StringIO(self._fileDict[u'Caf\xe9.jpg']), 100, time.time())
+        zip_writer.close()
+        self.check_archive(output.getvalue(), [u'Caf\xe9.jpg'])
+
+    def test_empty_archive(self):
+        archive_data = self.create_archive(ZipStreamWriter, [])
+        self.assertEqual(len(archive_data), 22)
+        self.check_archive(archive_data, [])
+
+    def test_zip64(self):
+        # Large files, offsets beyond the limit and more files than the classic end record can count
+        file_name_list = ['small.jpg', 'large.jpg', 'after.jpg', 'last.jpg']
+        self.write_file('small.jpg', os.urandom(100))
+        self.write_file('large.jpg', os.urandom(2000))
+        self.write_file('after.jpg', os.urandom(100))
+        self.write_file('last.jpg', '')
+        archive_data = self.create_archive(SmallLimitZipStreamWriter, file_name_list)
+        self.assertIn('PK\x06\x06', archive_data)
+        self.assertIn('PK\x06\x07', archive_data)
+        self.check_archive(archive_data, file_name_list)
+
+    def test_shortened_file(self):
+        # A file, that lost its end after its size was taken
+        self.write_file('short.jpg', os.urandom(1000))
+        self._fileDict['short.jpg'] = self._fileDict['short.jpg'][:600]
+        output = StringIO.StringIO()
+        zip_writer = ZipStreamWriter(output.write)
+        zip_writer.add_file('short.jpg', StringIO.StringIO(self._fileDict['short.jpg']), 1000, time.time())
+        zip_writer.close()
+        self.check_archive(output.getvalue(), ['short.jpg'])
+
+    def test_constant_memory(self):
+        file_size = 64 * 1024 * 1024
+        output = CountingOutput()
+        zip_writer = ZipStreamWriter(output.write)
+        with open('/dev/zero', 'rb') as file_handler:
+            zip_writer.add_file('zero.jpg', file_handler, file_size, time.time())
+        zip_writer.close()
+        self.assertGreater(output.size, file_size)
+        self.assertLessEqual(output.largestWrite, 64 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()